@@ -29,40 +29,42 @@
 # %%
 import pygmt
 
+from daynight import blend_region, grdimage_rgb
+from resolution import pick_resolution
+from tiling import blend_tiled
+
 # %%
-# Set the resolution to 2 arc minutes (30s used in abstract)
-res = "02m"
+# View the Earth from over New Orleans Ernest N. Morial Convention Center
+# General Perspective lon0/lat0/width+z<altitude>+a<azimuth>+t<tilt>+w<twist>+v<vwidth>/<vheight>
+projection = "G-90.0631825/29.9395386/25c+z3000+a345+t10+w-30+v90/60"
+# Use the coarsest resolution with a grid cell per pixel of the saved figure, but no
+# finer than 02m (the resolution of the benchmarks): this view asks for arc-seconds.
+# Set finest="30s" to make the figure of the abstract, blended in tiles below.
+res = pick_resolution("earth_day", "d", projection, dpi=300, finest="02m")
+# Process the grids in overlapping 30x30 degree tiles at 30s and finer resolutions
+# so that peak memory depends on the tile size rather than the global grid size
+tiled = res in ["30s", "15s"]
 
 # %%
 # Use the location of the Sun at 6.30am (sunrise) on 13 Dec 2021, Central Standard Time (UTC-6)
 # !gmt solar -C -o0:1 -I+d2021-12-13T06:30+z-6  # -8.95331142671	-23.1626971083
+sun_lon, sun_lat = -8.95331142671, -23.1626971083
 
 # %%
-# Make a global grid with a smooth 2-degree transition across day/night boundary.
-# !gmt grdmath -Rd -I$res -r -8.95331142671 -23.1626971083 2 DAYNIGHT = w.nc
-
-# %%
-# Create an intensity grid based on a DEM so that we can see structures in the oceans
-pygmt.grdgradient(
-    grid=f"@earth_relief_{res}", normalize="t0.5", azimuth=45, outgrid="intens.nc"
-)
-# Mask so that the DEM-based intensity is NaN on land
-# !gmt grdmath @earth_mask_$res 0 EQ 0 NAN intens.nc MUL = intens_ocean.nc
-
-# %%
-# Blend the earth_day and earth_night geotiffs using the weights, so that when w is 1
-# we get the earth_day, and then adjust colors based on the intensity.
-# !gmt grdmix @earth_day_$res @earth_night_$res -Ww.nc -Gview.tif -Iintens_ocean.nc
+# Make a global grid of weights with a smooth 2-degree transition across day/night
+# boundary, create an intensity grid based on a DEM so that we can see structures in
+# the oceans (NaN on land), and blend the earth_day and earth_night images using the
+# weights, so that when w is 1 we get the earth_day, and then adjust colors based on
+# the intensity.
+if tiled:
+    view = blend_tiled(res, sun_lon, sun_lat, region="d", tile_size=30)
+else:
+    view = blend_region(res, [-180, 180, -90, 90], sun_lon, sun_lat)
 
 # %%
 # Plot this image on an Earth with view from over New Orleans Ernest N. Morial Convention Center
 fig = pygmt.Figure()
-fig.grdimage(
-    grid="view.tif",
-    # General Perspective lon0/lat0/width+z<altitude>+a<azimuth>+t<tilt>+w<twist>+v<vwidth>/<vheight>
-    projection="G-90.0631825/29.9395386/25c+z3000+a345+t10+w-30+v90/60",
-    verbose="e",
-)
+grdimage_rgb(fig, view, projection=projection, verbose="e")
 fig.logo(position="jTR+w3c")
 fig.show()
 
@@ -0,0 +1,401 @@
+"""
+Animate the day/night terminator over the AGU 2021 venue.
+
+``abstract.py`` renders one view at sunrise. Here a sequence of frames from
+sunrise to sunset is rendered:
+
+1. The position of the Sun is computed for all frames at once with the NOAA
+   solar ephemeris (the algorithm of the NOAA solar calculator, accurate to
+   about a minute of time), replacing the hard-coded ``gmt solar`` output.
+2. The layers that do not change between frames (the day and night images
+   and the ocean intensity) are computed once and saved as ``.npy`` files
+   that the workers memory-map, so they are read from the page cache instead
+   of being copied into every process.
+3. Every frame only computes its day/night weights, blends the images and
+   renders them with ``grdimage``. Frames are spread over a process pool,
+   each worker with its own GMT session.
+4. Frames are streamed in order into ``ffmpeg`` as soon as they are ready, or
+   kept as a numbered PNG sequence.
+
+Run ``python animate.py --help`` for the options.
+"""
+import argparse
+import concurrent.futures
+import functools
+import multiprocessing
+import os
+import shutil
+import subprocess
+import tempfile
+
+import numpy as np
+import pygmt
+import xarray as xr
+
+from cache import cached_grdcut, cached_grdgradient
+from daynight import blend, daynight, grdimage_rgb, load_image, ocean_intensity
+
+# The Ernest N. Morial Convention Center and the view of abstract.py
+VENUE = (-90.0631825, 29.9395386)
+PROJECTION = "G-90.0631825/29.9395386/25c+z3000+a345+t10+w-30+v90/60"
+# Elevation of the center of the Sun at sunrise and sunset, in degrees
+# (atmospheric refraction and the radius of the solar disk)
+HORIZON = -0.833
+LAYERS = ["day", "night", "intensity", "lon", "lat"]
+
+
+def solar_position(times):
+    """
+    Compute the sub-solar point with the NOAA solar ephemeris.
+
+    Parameters
+    ----------
+    times : array-like of numpy.datetime64
+        UTC times.
+
+    Returns
+    -------
+    sun_lon, sun_lat : numpy.ndarray
+        Longitude and latitude of the point where the Sun is at the zenith,
+        like ``gmt solar -C -o0:1``.
+    """
+    times = np.asarray(times, dtype="datetime64[ns]")
+    days = (times - np.datetime64("2000-01-01T12:00")) / np.timedelta64(1, "D")
+    century = days / 36525
+    mean_longitude = np.deg2rad(
+        (280.46646 + century * (36000.76983 + century * 0.0003032)) % 360
+    )
+    anomaly = np.deg2rad(357.52911 + century * (35999.05029 - 0.0001537 * century))
+    eccentricity = 0.016708634 - century * (0.000042037 + 0.0000001267 * century)
+    center = (
+        np.sin(anomaly) * (1.914602 - century * (0.004817 + 0.000014 * century))
+        + np.sin(2 * anomaly) * (0.019993 - 0.000101 * century)
+        + np.sin(3 * anomaly) * 0.000289
+    )
+    omega = np.deg2rad(125.04 - 1934.136 * century)
+    apparent_longitude = np.deg2rad(
+        np.rad2deg(mean_longitude) + center - 0.00569 - 0.00478 * np.sin(omega)
+    )
+    obliquity = np.deg2rad(
+        23
+        + (
+            26
+            + (21.448 - century * (46.815 + century * (0.00059 - century * 0.001813)))
+            / 60
+        )
+        / 60
+        + 0.00256 * np.cos(omega)
+    )
+    declination = np.arcsin(np.sin(obliquity) * np.sin(apparent_longitude))
+    # Equation of time in minutes
+    var_y = np.tan(obliquity / 2) ** 2
+    equation_of_time = 4 * np.rad2deg(
+        var_y * np.sin(2 * mean_longitude)
+        - 2 * eccentricity * np.sin(anomaly)
+        + 4 * eccentricity * var_y * np.sin(anomaly) * np.cos(2 * mean_longitude)
+        - 0.5 * var_y**2 * np.sin(4 * mean_longitude)
+        - 1.25 * eccentricity**2 * np.sin(2 * anomaly)
+    )
+    minutes = (times - times.astype("datetime64[D]")) / np.timedelta64(1, "m")
+    sun_lon = -(minutes + equation_of_time - 720) / 4
+    return (sun_lon + 180) % 360 - 180, np.rad2deg(declination)
+
+
+def solar_elevation(times, lon, lat):
+    """
+    Compute the elevation of the Sun above the horizon in degrees.
+    """
+    sun_lon, sun_lat = np.deg2rad(solar_position(times))
+    lon, lat = np.deg2rad(lon), np.deg2rad(lat)
+    return np.rad2deg(
+        np.arcsin(
+            np.sin(lat) * np.sin(sun_lat)
+            + np.cos(lat) * np.cos(sun_lat) * np.cos(lon - sun_lon)
+        )
+    )
+
+
+def daylight_times(date, lon, lat, frames, utc_offset=0):
+    """
+    Space times evenly from sunrise to sunset.
+
+    Parameters
+    ----------
+    date : str
+        The local date, e.g. ``"2021-12-13"``.
+    lon, lat : float
+        The place.
+    frames : int
+        Number of times.
+    utc_offset : float
+        Offset of the local time zone from UTC in hours (e.g. -6 for CST).
+
+    Returns
+    -------
+    times : numpy.ndarray
+        UTC times as ``datetime64[s]``, to the nearest minute of sunrise and
+        sunset.
+    """
+    midnight = np.datetime64(date, "m") - np.timedelta64(round(utc_offset * 60), "m")
+    minutes = midnight + np.arange(24 * 60 + 1).astype("timedelta64[m]")
+    up = np.flatnonzero(solar_elevation(minutes, lon, lat) > HORIZON)
+    if up.size == 0:
+        raise ValueError(f"The Sun does not rise at ({lon}, {lat}) on {date}.")
+    sunrise, sunset = minutes[up[0]].astype("int64"), minutes[up[-1]].astype("int64")
+    seconds = np.rint(np.linspace(sunrise * 60, sunset * 60, frames)).astype("int64")
+    return seconds.astype("datetime64[s]")
+
+
+def static_layers(res, workdir, region="d", azimuth=45, normalize="t0.5"):
+    """
+    Compute the layers shared by all frames and save them to ``workdir``.
+
+    Writes ``day.npy`` and ``night.npy`` (uint8 RGB images), ``intensity.npy``
+    (the ocean intensity of :func:`daynight.ocean_intensity`, NaN on land)
+    and ``lon.npy`` and ``lat.npy``, as :func:`daynight.blend_region` would
+    compute them.
+    """
+    day = load_image(f"@earth_day_{res}", region=region)
+    night = load_image(f"@earth_night_{res}", region=region)
+    relief = cached_grdcut(grid=f"@earth_relief_{res}", region=region)
+    intensity = ocean_intensity(
+        cached_grdgradient(relief, normalize=normalize, azimuth=azimuth, f="g"),
+        cached_grdcut(grid=f"@earth_mask_{res}", region=region),
+    )
+    layers = dict(day=day, night=night, intensity=intensity, lon=day.lon, lat=day.lat)
+    for name, values in layers.items():
+        np.save(os.path.join(workdir, f"{name}.npy"), np.asarray(values))
+
+
+# Memory-mapped static layers of the current process (see _load_layers)
+_LAYERS = {}
+
+
+def _load_layers(workdir):
+    """
+    Memory-map the static layers in this process.
+    """
+    for name in LAYERS:
+        _LAYERS[name] = np.load(os.path.join(workdir, f"{name}.npy"), mmap_mode="r")
+
+
+def _init_worker(workdir):
+    """
+    Give a worker process its own GMT modern mode session and the layers.
+    """
+    # Sessions are named after the parent process by default, so the forked
+    # workers would share (and overwrite) the figures of one session
+    os.environ["GMT_SESSION_NAME"] = str(os.getpid())
+    pygmt.session_management.begin()
+    _load_layers(workdir)
+
+
+def render_frame(job, framedir, projection=PROJECTION, transition=2, dpi=100):
+    """
+    Blend and render one frame from the memory-mapped static layers.
+
+    Parameters
+    ----------
+    job : tuple
+        The frame number, its label and the sub-solar longitude and latitude.
+    framedir : str
+        Directory of the PNG frames.
+    projection : str
+        The projection of the view.
+    transition : float
+        Width of the day/night transition in degrees.
+    dpi : int
+        Resolution of the frames.
+
+    Returns
+    -------
+    fname : str
+        The PNG file of the frame.
+    """
+    number, label, sun_lon, sun_lat = job
+    lon, lat = _LAYERS["lon"], _LAYERS["lat"]
+    day, night = (
+        xr.DataArray(
+            _LAYERS[name],
+            coords={"band": [0, 1, 2], "lat": lat, "lon": lon},
+            dims=("band", "lat", "lon"),
+        )
+        for name in ["day", "night"]
+    )
+    weights = daynight(lon, lat, sun_lon, sun_lat, transition=transition)
+    rgb = blend(day, night, weights, _LAYERS["intensity"])
+    fig = pygmt.Figure()
+    grdimage_rgb(fig, rgb, projection=projection, verbose="e")
+    fig.text(
+        text=label,
+        position="TL",
+        offset="0.5c/-0.5c",
+        justify="TL",
+        font="16p,Helvetica-Bold,white",
+        no_clip=True,
+    )
+    fname = os.path.join(framedir, f"frame_{number:05d}.png")
+    fig.savefig(fname, dpi=dpi)
+    return fname
+
+
+def render_frames(jobs, workdir, framedir, workers=1, **kwargs):
+    """
+    Render frames in a process pool and yield their files in order.
+
+    Parameters
+    ----------
+    jobs : list of tuple
+        See :func:`render_frame`.
+    workdir : str
+        Directory of the static layers from :func:`static_layers`.
+    framedir : str
+        Directory of the PNG frames.
+    workers : int
+        Number of processes. Renders in the current process if 1 or less.
+    **kwargs
+        Passed to :func:`render_frame`.
+
+    Yields
+    ------
+    fname : str
+        The file of each frame, as soon as it and all frames before it are
+        ready.
+    """
+    render = functools.partial(render_frame, framedir=framedir, **kwargs)
+    if workers <= 1:
+        _load_layers(workdir)
+        yield from map(render, jobs)
+        return
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("fork"),
+        initializer=_init_worker,
+        initargs=(workdir,),
+    ) as pool:
+        yield from pool.map(render, jobs)
+
+
+def encode_video(frames, output, fps=12):
+    """
+    Stream PNG frames into ``ffmpeg`` as they arrive and make an H.264 video.
+
+    Each frame is deleted once it has been passed on.
+    """
+    process = subprocess.Popen(
+        [
+            "ffmpeg",
+            "-y",
+            "-loglevel",
+            "error",
+            "-f",
+            "image2pipe",
+            "-framerate",
+            str(fps),
+            "-i",
+            "-",
+            # H.264 in yuv420p needs even image dimensions
+            "-vf",
+            "scale=trunc(iw/2)*2:trunc(ih/2)*2",
+            "-pix_fmt",
+            "yuv420p",
+            output,
+        ],
+        stdin=subprocess.PIPE,
+    )
+    try:
+        for fname in frames:
+            with open(fname, "rb") as frame:
+                process.stdin.write(frame.read())
+            os.remove(fname)
+    finally:
+        process.stdin.close()
+        if process.wait() != 0:
+            raise RuntimeError(f"ffmpeg failed to write '{output}'.")
+
+
+def animate(
+    output,
+    date="2021-12-13",
+    utc_offset=-6,
+    frames=60,
+    res="10m",
+    workers=1,
+    dpi=100,
+    fps=12,
+):
+    """
+    Render the terminator from sunrise to sunset at the venue.
+
+    Parameters
+    ----------
+    output : str
+        A video file (e.g. ``"figures/terminator.mp4"``, needs ``ffmpeg``) or a
+        directory for the PNG frames.
+    date : str
+        Local date.
+    utc_offset : float
+        Offset of the local time zone from UTC in hours.
+    frames : int
+        Number of frames.
+    res : str
+        Resolution of the remote datasets.
+    workers : int
+        Number of processes rendering frames.
+    dpi : int
+        Resolution of the frames.
+    fps : int
+        Frames per second of the video.
+    """
+    times = daylight_times(date, *VENUE, frames=frames, utc_offset=utc_offset)
+    sun_lon, sun_lat = solar_position(times)
+    local = times + np.timedelta64(round(utc_offset * 3600), "s")
+    jobs = [
+        (number, f"{str(time)[:16].replace('T', ' ')} UTC{utc_offset:+g}", *sun)
+        for number, (time, sun) in enumerate(zip(local, zip(sun_lon, sun_lat)))
+    ]
+    video = os.path.splitext(output)[1] in [".mp4", ".mov", ".mkv", ".webm"]
+    if video and shutil.which("ffmpeg") is None:
+        raise RuntimeError("Making a video needs ffmpeg. Give a directory instead.")
+    with tempfile.TemporaryDirectory(prefix="agu2021-animate-") as workdir:
+        framedir = workdir if video else output
+        os.makedirs(framedir, exist_ok=True)
+        static_layers(res, workdir)
+        rendered = render_frames(jobs, workdir, framedir, workers=workers, dpi=dpi)
+        if video:
+            encode_video(rendered, output, fps=fps)
+        else:
+            for fname in rendered:
+                print(fname)
+
+
+def main():
+    """
+    Parse the command line and render the animation.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "output", help="video file (.mp4, .mov, .mkv, .webm) or frame directory"
+    )
+    parser.add_argument("--date", default="2021-12-13", help="local date")
+    parser.add_argument("--utc-offset", type=float, default=-6, help="in hours")
+    parser.add_argument("--frames", type=int, default=60)
+    parser.add_argument("--res", default="10m", help="resolution of the datasets")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--dpi", type=int, default=100)
+    parser.add_argument("--fps", type=int, default=12)
+    args = parser.parse_args()
+    animate(
+        args.output,
+        date=args.date,
+        utc_offset=args.utc_offset,
+        frames=args.frames,
+        res=args.res,
+        workers=args.workers,
+        dpi=args.dpi,
+        fps=args.fps,
+    )
+
+
+if __name__ == "__main__":
+    main()
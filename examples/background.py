@@ -21,35 +21,62 @@
 # - Black Marble: https://earthobservatory.nasa.gov/features/NightLights/page3.php
 
 # %%
-import pygmt
+import argparse
+import time
+
+from daynight import blend, daynight, load_image, save_png
+from tiling import blend_tiled, ocean_intensity_tiled
 
 # %%
-# Set the resolution to 2 arc minutes
-res = "05m"
+# Set the resolution to 5 arc minutes. Running as a script, the resolution and the
+# number of processes can be changed with `python background.py --res 01m --workers 4`.
+# Add `--shared` to load the base grids once into memory shared by the workers.
+parser = argparse.ArgumentParser()
+parser.add_argument("--res", default="05m")
+parser.add_argument("--workers", type=int, default=1)
+parser.add_argument("--shared", action="store_true")
+args = parser.parse_known_args()[0]
+res = args.res
+workers = args.workers
 region = "-270/90/-90/90"
+start = time.perf_counter()
 
 # %%
 # Use the location of the Sun at 09:00 on 13 Dec 2021, Central Standard Time (UTC-6)
 # !gmt solar -C -o0:1 -I+d2021-12-13T09:00+z-6  # -46.4410128416 -23.1694592154
+sun_lon, sun_lat = -46.4410128416, -23.1694592154
 
 # %%
-# Make a global grid with a smooth 2-degree transition across day/night boundary.
-# !gmt grdmath -R$region -I$res -r -46.4410128416 -23.1694592154 2 DAYNIGHT = weights.nc
-
-# %%
-# Cut grids to region
-pygmt.grdcut(grid=f"@earth_relief_{res}", region=region, outgrid="relief.nc")
-pygmt.grdcut(grid=f"@earth_day_{res}", region=region, outgrid="day.tif")
-pygmt.grdcut(grid=f"@earth_night_{res}", region=region, outgrid="night.tif")
-pygmt.grdcut(grid=f"@earth_mask_{res}", region=region, outgrid="mask.nc")
-
-# %%
-# Create an intensity grid based on a DEM so that we can see structures in the oceans
-pygmt.grdgradient(grid="relief.nc", normalize="t0.5", azimuth=45, outgrid="intens.nc")
-# Mask so that the DEM-based intensity is NaN on land
-# !gmt grdmath mask.nc 0 EQ 0 NAN intens.nc MUL = intens_ocean.nc
+# Blend the earth_day and earth_night images with weights that have a smooth 2-degree
+# transition across the day/night boundary, so that when w is 1 we get the earth_day,
+# and then adjust colors based on an intensity grid made from a DEM so that we can see
+# structures in the oceans (NaN on land). With one worker the intensity comes from a
+# single grdgradient over the region and the images are blended in blocks of rows.
+# With more, the cuts, gradients and blends run on 60x60 degree tiles spread over the
+# worker processes and are stitched in view.npy. Both give the same image.
+if workers > 1 or args.shared:
+    view = blend_tiled(
+        res,
+        sun_lon,
+        sun_lat,
+        region=region,
+        tile_size=60,
+        workers=workers,
+        shared=args.shared,
+    )
+else:
+    intens_ocean = ocean_intensity_tiled(res, region, tile_size=60)
+    weights = daynight(
+        intens_ocean.lon, intens_ocean.lat, sun_lon, sun_lat, transition=2
+    )
+    day = load_image(f"@earth_day_{res}", region=region)
+    night = load_image(f"@earth_night_{res}", region=region)
+    view = blend(day, night, weights, intens_ocean)
 
 # %%
-# Blend the earth_day and earth_night geotiffs using the weights, so that when w is 1
-# we get the earth_day, and then adjust colors based on the intensity.
-# !gmt grdmix day.tif night.tif -Wweights.nc -Gfigures/agu2021_background.png -Iintens_ocean.nc
+# Save the image
+save_png(view, "figures/agu2021_background.png")
+print(
+    f"Built the {res} background in {time.perf_counter() - start:.1f} s "
+    f"with {workers} worker(s)"
+)
@@ -0,0 +1,318 @@
+"""
+Render many figures headless in one process.
+
+Interactively, every ``fig.show()`` rasterizes the whole PostScript of the
+figure so far and every ``pygmt`` call starts and destroys a GMT API session.
+In batch mode:
+
+* ``Figure.show`` is a no-op, so figures are only rasterized by
+  ``Figure.savefig``, optionally with another DPI or format;
+* all ``pygmt.clib.Session`` objects of a thread share one GMT API session
+  that is created once and kept open. A session whose module call failed is
+  destroyed and the next one starts afresh;
+* every example runs in a clean scope: the GMT modern mode session and the
+  warm session are ended after it, so the defaults it changed with
+  ``pygmt.config`` and its figures do not leak into the next example.
+
+Run ``python batch.py abstract.py venus_harmonics.py [--dpi 150] [--format
+jpg]`` to render examples in one process, with the time from ``Figure()`` to
+the end of ``savefig`` of every figure. ``--compare`` first runs the examples
+the usual way in another process, with ``show`` rasterizing a PNG like in a
+notebook and a new session per call, and prints both latencies (``make
+latency``). ``build.py --batch`` runs the notebooks in batch mode through an
+IPython startup file.
+"""
+import argparse
+import atexit
+import functools
+import json
+import os
+import runpy
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+
+class BatchRenderer:
+    """
+    Patch PyGMT for batch rendering and time every saved figure.
+
+    Parameters
+    ----------
+    dpi : int or None
+        Resolution of the raster images made by ``savefig``. Uses the value
+        given to ``savefig`` if None.
+    fmt : str or None
+        Extension of the saved figures (e.g. ``"pdf"``), replacing the one in
+        the name given to ``savefig``. Keeps it if None.
+    batch : bool
+        If False, only time the figures: ``show`` rasterizes a PNG preview
+        like in a notebook and every call opens a new session.
+    """
+
+    def __init__(self, dpi=None, fmt=None, batch=True):
+        self.dpi = dpi
+        self.fmt = fmt
+        self.batch = batch
+        self.figures = []
+        self._local = threading.local()
+        self._patches = []
+
+    def _patch(self, owner, name, replacement):
+        self._patches.append((owner, name, getattr(owner, name)))
+        setattr(owner, name, replacement)
+
+    def _warm_session(self, enter, exit_):
+        @functools.wraps(enter)
+        def warm_enter(session):
+            pointer = getattr(self._local, "pointer", None)
+            if pointer is None:
+                enter(session)
+                self._local.pointer = session.session_pointer
+                self._local.failed = False
+            else:
+                session.session_pointer = pointer
+            self._local.depth = getattr(self._local, "depth", 0) + 1
+            return session
+
+        @functools.wraps(exit_)
+        def warm_exit(session, exc_type, exc_value, traceback):
+            self._local.depth -= 1
+            if exc_type is not None:
+                self._local.failed = True
+            # Sessions nested in this one (e.g. the grdinfo call of the
+            # DataArray accessor) share its pointer, so a session left in an
+            # unknown state by an error is only destroyed by the outermost one
+            if self._local.depth == 0 and self._local.failed:
+                self._local.pointer = None
+                exit_(session, exc_type, exc_value, traceback)
+
+        return warm_enter, warm_exit
+
+    def _timed_figure(self, init):
+        @functools.wraps(init)
+        def wrapper(fig, *args, **kwargs):
+            fig._batch_timing = dict(start=time.perf_counter(), shows=0)
+            init(fig, *args, **kwargs)
+
+        return wrapper
+
+    def _counted_show(self):
+        def show(
+            fig, dpi=300, width=500, method=None
+        ):  # pylint: disable=unused-argument
+            if hasattr(fig, "_batch_timing"):
+                fig._batch_timing["shows"] += 1
+            if not self.batch:
+                fig._preview(  # pylint: disable=protected-access
+                    fmt="png", dpi=dpi, anti_alias=True, as_bytes=True
+                )
+
+        return show
+
+    def _batch_savefig(self, savefig):
+        @functools.wraps(savefig)
+        def wrapper(fig, fname, *args, **kwargs):
+            if self.fmt:
+                fname = f"{os.path.splitext(fname)[0]}.{self.fmt}"
+            if self.dpi:
+                kwargs["dpi"] = self.dpi
+            result = savefig(fig, fname, *args, **kwargs)
+            if hasattr(fig, "_batch_timing"):
+                self.figures.append(
+                    dict(
+                        figure=fname,
+                        seconds=time.perf_counter() - fig._batch_timing["start"],
+                        shows=fig._batch_timing["shows"],
+                    )
+                )
+            return result
+
+        return wrapper
+
+    def install(self):
+        """
+        Turn on batch mode.
+        """
+        import pygmt  # pylint: disable=import-outside-toplevel
+
+        session = pygmt.clib.Session
+        if self.batch:
+            warm_enter, warm_exit = self._warm_session(
+                session.__enter__, session.__exit__
+            )
+            self._patch(session, "__enter__", warm_enter)
+            self._patch(session, "__exit__", warm_exit)
+        self._patch(pygmt.Figure, "__init__", self._timed_figure(pygmt.Figure.__init__))
+        self._patch(pygmt.Figure, "show", self._counted_show())
+        self._patch(pygmt.Figure, "savefig", self._batch_savefig(pygmt.Figure.savefig))
+        atexit.register(self.uninstall)
+
+    def uninstall(self):
+        """
+        Restore PyGMT and close the warm session of this thread.
+        """
+        while self._patches:
+            owner, name, original = self._patches.pop()
+            setattr(owner, name, original)
+        self._close()
+
+    def _close(self):
+        """
+        Destroy the warm session of this thread, if any.
+        """
+        pointer = getattr(self._local, "pointer", None)
+        if pointer is not None:
+            import pygmt  # pylint: disable=import-outside-toplevel
+
+            session = pygmt.clib.Session()
+            session.session_pointer = pointer
+            session.destroy()
+            self._local.pointer = None
+
+    def reset(self):
+        """
+        Start the next example with the GMT state of a new process.
+
+        Ends the GMT modern mode session, which drops the figures and the
+        defaults set with ``pygmt.config`` outside of a ``with`` block, closes
+        the warm session that keeps the defaults in memory and begins a new
+        modern mode session like ``import pygmt`` does.
+        """
+        import pygmt  # pylint: disable=import-outside-toplevel
+
+        pygmt.end()
+        self._close()
+        pygmt.begin()
+
+
+def enable(dpi=None, fmt=None):
+    """
+    Turn on batch mode for the rest of the process.
+
+    Returns
+    -------
+    renderer : BatchRenderer
+        Its ``figures`` list the latency of every saved figure.
+    """
+    renderer = BatchRenderer(dpi=dpi, fmt=fmt)
+    renderer.install()
+    return renderer
+
+
+def run_examples(examples, batch=True, dpi=None, fmt=None):
+    """
+    Run example scripts one after the other in this process.
+
+    Every example starts with the GMT defaults of a new process (see
+    :meth:`BatchRenderer.reset`).
+
+    Parameters
+    ----------
+    examples : list of str
+        The example scripts.
+    batch : bool
+        Use batch mode. Otherwise ``show`` rasterizes a PNG preview and every
+        call opens a new session, as when running the notebooks.
+    dpi, fmt : int or str or None
+        See :class:`BatchRenderer`.
+
+    Returns
+    -------
+    figures : list of dict
+        The ``example``, ``figure``, latency in ``seconds`` and number of
+        ``shows`` of every saved figure.
+    """
+    renderer = BatchRenderer(dpi=dpi, fmt=fmt, batch=batch)
+    renderer.install()
+    figures = []
+    try:
+        for fname in examples:
+            sys.argv = [fname]
+            try:
+                runpy.run_path(fname, run_name="__main__")
+            finally:
+                renderer.reset()
+            figures.extend(dict(example=fname, **figure) for figure in renderer.figures)
+            renderer.figures.clear()
+    finally:
+        renderer.uninstall()
+    return figures
+
+
+def print_figures(figures, before=None):
+    """
+    Print the latency of every figure, next to a previous run if given.
+    """
+    previous = {
+        os.path.splitext(figure["figure"])[0]: figure["seconds"]
+        for figure in before or []
+    }
+    rows = [
+        (
+            figure["figure"],
+            figure["shows"],
+            previous.get(os.path.splitext(figure["figure"])[0], float("nan")),
+            figure["seconds"],
+        )
+        for figure in figures
+    ]
+    if rows:
+        rows.append(
+            (
+                "median",
+                "",
+                statistics.median(row[2] for row in rows),
+                statistics.median(row[3] for row in rows),
+            )
+        )
+    print(f"{'figure':<40}{'shows':>6}{'before [s]':>12}{'batch [s]':>11}")
+    for name, shows, old, new in rows:
+        print(f"{name:<40}{shows:>6}{old:>12.2f}{new:>11.2f}")
+
+
+def main():
+    """
+    Render examples in batch mode and report the latency per figure.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("examples", nargs="+", help="example scripts to run")
+    parser.add_argument("--dpi", type=int, help="resolution of the saved figures")
+    parser.add_argument("--format", help="extension of the saved figures, e.g. pdf")
+    parser.add_argument(
+        "--compare", action="store_true", help="also time the usual way first"
+    )
+    parser.add_argument("--no-batch", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--json", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    # Never open the figures in an external viewer
+    os.environ.setdefault("PYGMT_USE_EXTERNAL_DISPLAY", "false")
+
+    before = None
+    if args.compare:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            output = os.path.join(tmpdir, "before.json")
+            subprocess.run(
+                [sys.executable, __file__, "--no-batch", "--json", output]
+                + (["--dpi", str(args.dpi)] if args.dpi else [])
+                + (["--format", args.format] if args.format else [])
+                + args.examples,
+                check=True,
+            )
+            with open(output) as record:
+                before = json.load(record)
+    figures = run_examples(
+        args.examples, batch=not args.no_batch, dpi=args.dpi, fmt=args.format
+    )
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(figures, output)
+        return
+    print_figures(figures, before)
+
+
+if __name__ == "__main__":
+    main()
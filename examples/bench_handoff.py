@@ -0,0 +1,70 @@
+"""
+Compare text files and virtual files for passing the GCMT catalog to GMT.
+
+The text path writes the catalog with ``to_csv`` and lets ``coupe`` parse
+the file again. The virtual file path hands the DataFrame columns to
+``coupe`` with :func:`catalog.virtualfile_from_catalog`. Both plot the full
+catalog on the cross-section of the focal mechanism example.
+
+Run with ``python bench_handoff.py [--repeat N]``.
+"""
+import argparse
+import statistics
+import time
+
+import pygmt
+
+from catalog import load_catalog, virtualfile_from_catalog
+
+COUPE = "-Aa-75.02/-33.5/-63.65/-31+w100k -Q -Sc0.5c+f0 -Wfaint"
+
+
+def _new_figure():
+    """
+    Create a figure with the cross-section frame of the example.
+    """
+    fig = pygmt.Figure()
+    fig.basemap(region=[0, 1100, 0, 190], projection="X22c/-7c", frame=True)
+    return fig
+
+
+def text_handoff(catalog, fname="bench_handoff.txt"):
+    """
+    Write the catalog as text and plot it with ``coupe`` from the file.
+    """
+    _new_figure()
+    start = time.perf_counter()
+    catalog.to_csv(fname, sep=" ", header=False, index=False)
+    with pygmt.clib.Session() as lib:
+        lib.call_module("coupe", f"{fname} {COUPE}")
+    return time.perf_counter() - start
+
+
+def virtual_handoff(catalog):
+    """
+    Plot the catalog with ``coupe`` from a virtual file.
+    """
+    _new_figure()
+    start = time.perf_counter()
+    with pygmt.clib.Session() as lib:
+        with virtualfile_from_catalog(lib, catalog) as fname:
+            lib.call_module("coupe", f"{fname} {COUPE}")
+    return time.perf_counter() - start
+
+
+def main():
+    """
+    Time both paths and print the median of several runs.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--repeat", type=int, default=5, help="number of runs")
+    args = parser.parse_args()
+    catalog = load_catalog("@GCMT_1976-2017_meca.gmt")
+    print(f"{len(catalog)} events")
+    for name, handoff in [("text", text_handoff), ("virtual", virtual_handoff)]:
+        times = [handoff(catalog) for _ in range(args.repeat)]
+        print(f"{name:>8}: {statistics.median(times):.3f} s (median of {len(times)})")
+
+
+if __name__ == "__main__":
+    main()
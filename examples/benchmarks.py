@@ -0,0 +1,628 @@
+"""
+Benchmark the examples stage by stage and compare against a baseline.
+
+Each example runs headless in its own process, with ``Figure.show`` turned
+into a no-op, a fresh cache directory (see ``cache.py``) and a temporary
+working directory, so the figures in ``figures/`` are left alone. The
+remote datasets are replaced by synthetic fixtures of the same size that are
+generated once in ``.bench/fixtures`` (``AGU2021_FIXTURE_DIR``), so nothing
+is downloaded.
+
+Time and memory are attributed to stages by wrapping the functions of the
+example modules and ``Session.call_module``:
+
+fetch
+    Looking up remote files (:func:`cache.cached_which`).
+cut
+    Cutting grids and reading the cuts (``grdcut``, :func:`cache._fill`).
+gradient
+    Gradients and shading intensities (``grdgradient``).
+blend
+    Day/night weights and blending (:func:`daynight.blend`, ``grdmix``).
+evaluate
+    Spherical harmonic synthesis (:func:`harmonics.sph2grd_multi`).
+render
+    All other GMT modules (``grdimage``, ``coast``, ``colorbar``, ...).
+savefig
+    :meth:`pygmt.Figure.savefig` and ``psconvert``.
+other
+    Everything else done by the example.
+
+Nested stages are exclusive: the time of a ``grdcut`` inside a gradient
+computation counts as ``cut`` only. For every stage the wall time, CPU time
+(of all threads of the process) and peak resident memory while the stage was
+running are recorded. Memory is sampled from ``/proc/self/status`` and does
+not include worker processes, so the examples run with one worker.
+
+Run ``python benchmarks.py --save-baseline`` once, then ``python
+benchmarks.py --baseline`` after an upgrade: the exit status is 1 if a stage
+got slower or used more memory than the thresholds allow.
+
+``python benchmarks.py --check-workers 4`` runs ``background.py`` on the
+fixtures with one and with four workers, prints both run times and exits
+with status 1 if the saved figures are not byte-identical.
+"""
+import argparse
+import contextlib
+import datetime
+import functools
+import importlib
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+import xarray as xr
+
+from build import code_cells
+
+BENCH_DIR = ".bench"
+FIXTURE_DIR = os.path.join(BENCH_DIR, "fixtures")
+RESULTS = os.path.join(BENCH_DIR, "results.json")
+BASELINE = os.path.join(BENCH_DIR, "baseline.json")
+EXAMPLES = ["abstract.py", "background.py", "venus_harmonics.py"]
+# Default resolutions of abstract.py and background.py
+RESOLUTIONS = ["02m", "05m"]
+METRICS = ["wall_s", "cpu_s", "peak_rss_mb"]
+
+# Functions of the example modules timed as a stage
+PROBES = [
+    ("cache", "cached_which", "fetch"),
+    ("cache", "_fill", "cut"),
+    ("cache", "cached_grdgradient", "gradient"),
+    ("cache", "cached_grd2cpt", "render"),
+    ("daynight", "load_image", "cut"),
+    ("daynight", "daynight", "blend"),
+    ("daynight", "ocean_intensity", "gradient"),
+    ("daynight", "blend", "blend"),
+    ("daynight", "grdimage_rgb", "render"),
+    ("daynight", "save_png", "savefig"),
+    ("harmonics", "sph2grd_multi", "evaluate"),
+    ("tiling", "cut_grids", "cut"),
+    ("tiling", "ocean_intensity_tiled", "gradient"),
+    ("tiling", "blend_tiled", "blend"),
+]
+# Stage of the GMT modules called through Session.call_module (others: render)
+MODULE_STAGES = {
+    "which": "fetch",
+    "grdcut": "cut",
+    "grdgradient": "gradient",
+    "grdmath": "blend",
+    "grdmix": "blend",
+    "sph2grd": "evaluate",
+    "psconvert": "savefig",
+}
+
+
+def current_rss():
+    """
+    Return the resident memory of this process in megabytes.
+
+    Falls back to the peak resident memory where ``/proc`` is not available.
+    """
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource  # pylint: disable=import-outside-toplevel
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class StageRecorder:
+    """
+    Accumulate wall time, CPU time and peak memory per stage.
+
+    Use :meth:`stage` to enter a stage. Time is charged to the innermost
+    stage only, and a thread samples the memory every ``interval`` seconds
+    while the recorder is running.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stages = {}
+        self._stack = ["other"]
+        self._mark = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler = None
+
+    def _record(self, stage):
+        return self.stages.setdefault(
+            stage, dict(wall_s=0.0, cpu_s=0.0, peak_rss_mb=0.0, calls=0)
+        )
+
+    def _charge(self):
+        """
+        Charge the time since the last mark to the current stage.
+        """
+        wall, cpu = time.perf_counter(), time.process_time()
+        record = self._record(self._stack[-1])
+        record["wall_s"] += wall - self._mark[0]
+        record["cpu_s"] += cpu - self._mark[1]
+        record["peak_rss_mb"] = max(record["peak_rss_mb"], current_rss())
+        self._mark = (wall, cpu)
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            rss = current_rss()
+            with self._lock:
+                record = self._record(self._stack[-1])
+                record["peak_rss_mb"] = max(record["peak_rss_mb"], rss)
+
+    def start(self):
+        """
+        Start the clock and the memory sampler.
+        """
+        self._mark = (time.perf_counter(), time.process_time())
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+        self._sampler.start()
+
+    def stop(self):
+        """
+        Charge the remaining time and stop the memory sampler.
+        """
+        with self._lock:
+            self._charge()
+        self._stop.set()
+        self._sampler.join()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Charge the time spent in the context to a stage.
+        """
+        with self._lock:
+            self._charge()
+            self._stack.append(name)
+            self._record(name)["calls"] += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._charge()
+                self._stack.pop()
+
+    def wrap(self, func, name):
+        """
+        Return a version of a function that runs in a stage.
+        """
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with self.stage(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+
+def install_probes(recorder):
+    """
+    Wrap the functions in ``PROBES``, ``Session.call_module`` and
+    ``Figure.savefig`` so that they record their stage.
+
+    Functions are replaced in every example module that imported them, so
+    the probes must be installed before the example runs.
+    """
+    import pygmt  # pylint: disable=import-outside-toplevel
+
+    modules = [
+        importlib.import_module(name) for name in {name for name, _, _ in PROBES}
+    ]
+    for module_name, name, stage in PROBES:
+        original = getattr(sys.modules[module_name], name)
+        wrapper = recorder.wrap(original, stage)
+        for module in modules:
+            if getattr(module, name, None) is original:
+                setattr(module, name, wrapper)
+
+    call_module = pygmt.clib.Session.call_module
+
+    @functools.wraps(call_module)
+    def staged_call_module(self, module, args):
+        with recorder.stage(MODULE_STAGES.get(module, "render")):
+            return call_module(self, module, args)
+
+    pygmt.clib.Session.call_module = staged_call_module
+    pygmt.Figure.savefig = recorder.wrap(pygmt.Figure.savefig, "savefig")
+    pygmt.Figure.show = lambda self, *args, **kwargs: None
+
+
+def versions():
+    """
+    Describe the software the benchmark ran with.
+    """
+    import pygmt  # pylint: disable=import-outside-toplevel
+
+    with pygmt.clib.Session() as lib:
+        gmt = lib.info["version"]
+    return dict(
+        python=platform.python_version(),
+        numpy=np.__version__,
+        xarray=xr.__version__,
+        pygmt=pygmt.__version__,
+        gmt=gmt,
+        machine=platform.machine(),
+        system=platform.system(),
+        cpus=os.cpu_count(),
+    )
+
+
+def run_one(fname, workers=None, figures=None):
+    """
+    Run an example in this process and record its stages.
+
+    The code cells are executed one after the other in a temporary working
+    directory that links to ``data/`` and has an empty ``figures/``.
+
+    Parameters
+    ----------
+    fname : str
+        The example.
+    workers : int or None
+        Pass ``--workers`` to the example (e.g. ``background.py``).
+    figures : str or None
+        Copy the saved figures to this directory.
+
+    Returns
+    -------
+    record : dict
+        ``stages`` with the metrics of every stage, ``total`` and ``meta``.
+    """
+    examples = os.path.abspath(os.path.dirname(__file__) or ".")
+    sys.path.insert(0, examples)
+    recorder = StageRecorder()
+    install_probes(recorder)
+    cells = code_cells(os.path.join(examples, fname))
+    namespace = dict(__name__="__main__", __file__=os.path.join(examples, fname))
+    sys.argv = [fname] + ([] if workers is None else ["--workers", str(workers)])
+    with tempfile.TemporaryDirectory(prefix="agu2021-bench-") as workdir:
+        os.symlink(os.path.join(examples, "data"), os.path.join(workdir, "data"))
+        os.mkdir(os.path.join(workdir, "figures"))
+        os.chdir(workdir)
+        start = time.perf_counter(), time.process_time()
+        recorder.start()
+        try:
+            for cell in cells:
+                exec(
+                    compile(cell, fname, "exec"), namespace
+                )  # pylint: disable=exec-used
+        finally:
+            recorder.stop()
+            os.chdir(examples)
+        if figures:
+            shutil.copytree(os.path.join(workdir, "figures"), figures)
+    total = dict(
+        wall_s=time.perf_counter() - start[0],
+        cpu_s=time.process_time() - start[1],
+        peak_rss_mb=max(record["peak_rss_mb"] for record in recorder.stages.values()),
+    )
+    return dict(stages=recorder.stages, total=total, meta=versions())
+
+
+def _smooth_field(shape, rng, degrees=16):
+    """
+    Sum random separable waves to make a smooth global field in [-1, 1].
+    """
+    nlat, nlon = shape
+    rlat = np.linspace(-np.pi / 2, np.pi / 2, nlat, dtype="float32")[:, np.newaxis]
+    rlon = np.linspace(-np.pi, np.pi, nlon, dtype="float32")[np.newaxis, :]
+    field = np.zeros(shape, dtype="float32")
+    for degree in range(1, degrees + 1):
+        phase_lat, phase_lon = rng.uniform(0, 2 * np.pi, size=2)
+        field += (
+            np.cos(degree * rlat + phase_lat) * np.cos(degree * rlon + phase_lon)
+        ) / degree
+    return field / np.abs(field).max()
+
+
+def _write_grid(values, fname):
+    """
+    Write a global pixel-registered grid to netCDF.
+    """
+    nlat, nlon = values.shape
+    spacing = 360 / nlon
+    grid = xr.DataArray(
+        values,
+        coords={
+            "lat": np.linspace(-90 + spacing / 2, 90 - spacing / 2, nlat),
+            "lon": np.linspace(-180 + spacing / 2, 180 - spacing / 2, nlon),
+        },
+        dims=("lat", "lon"),
+    )
+    grid.to_dataset(name="z").assign_attrs(node_offset=1).to_netcdf(fname)
+
+
+def _write_image(bands, fname):
+    """
+    Combine three uint8 bands into a GeoTIFF with ``grdmix -C``.
+    """
+    import pygmt  # pylint: disable=import-outside-toplevel
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        names = [os.path.join(tmpdir, f"{band}.nc") for band in "rgb"]
+        for values, name in zip(bands, names):
+            _write_grid(values, name)
+        with pygmt.clib.Session() as lib:
+            lib.call_module("grdmix", f"{' '.join(names)} -C -G{fname}")
+
+
+def make_fixtures(directory=FIXTURE_DIR, resolutions=RESOLUTIONS, seed=2021):
+    """
+    Generate the synthetic remote datasets the examples need.
+
+    For each resolution this writes ``earth_relief_<res>.nc``,
+    ``earth_mask_<res>.nc``, ``earth_day_<res>.tif`` and
+    ``earth_night_<res>.tif`` with the size of the real datasets, and
+    ``VenusTopo180.txt`` with random coefficients that decay like the real
+    ones. Existing files are kept.
+    """
+    os.makedirs(directory, exist_ok=True)
+    for res in resolutions:
+        paths = {
+            name: os.path.join(directory, f"earth_{name}_{res}.{extension}")
+            for name, extension in [
+                ("relief", "nc"),
+                ("mask", "nc"),
+                ("day", "tif"),
+                ("night", "tif"),
+            ]
+        }
+        if all(os.path.exists(path) for path in paths.values()):
+            continue
+        print(f"Generating the {res} fixtures in {directory}")
+        rng = np.random.default_rng(seed)
+        size = int(res[:2]) / {"d": 1, "m": 60, "s": 3600}[res[-1]]
+        shape = (round(180 / size), round(360 / size))
+        relief = 6000 * _smooth_field(shape, rng) - 1500
+        relief += rng.normal(scale=100, size=shape).astype("float32")
+        land = relief > 0
+        _write_grid(relief, paths["relief"])
+        _write_grid(land.astype("uint8"), paths["mask"])
+        shade = np.clip(relief / 30 + 128, 0, 255).astype("uint8")
+        _write_image(
+            [
+                np.where(land, shade, 20).astype("uint8"),
+                np.where(land, 140, 60).astype("uint8"),
+                np.where(land, 60, 160).astype("uint8"),
+            ],
+            paths["day"],
+        )
+        lights = (land & (rng.random(shape) > 0.98)).astype("uint8") * 230
+        _write_image([lights, lights, (lights * 0.7).astype("uint8")], paths["night"])
+    venus = os.path.join(directory, "VenusTopo180.txt")
+    if not os.path.exists(venus):
+        rng = np.random.default_rng(seed)
+        degree, order = np.tril_indices(181)
+        scale = 1e3 * np.maximum(degree, 1) ** -1.5
+        coefs = rng.normal(size=(2, degree.size)) * scale
+        coefs[1, order == 0] = 0
+        coefs[:, 0] = [6051e3, 0]
+        np.savetxt(venus, np.column_stack([degree, order, *coefs]), fmt="%d %d %g %g")
+
+
+def run_benchmarks(examples, repeat=1):
+    """
+    Run every example ``repeat`` times in its own process.
+
+    Returns
+    -------
+    results : dict
+        Per example, the median of each metric over the runs.
+    """
+    results = dict(meta=None, examples={})
+    for fname in examples:
+        runs = [_run_process(fname) for _ in range(repeat)]
+        results["meta"] = runs[0]["meta"]
+        results["examples"][fname] = dict(
+            total=_median([run["total"] for run in runs]),
+            stages={
+                stage: _median([run["stages"].get(stage, {}) for run in runs])
+                for stage in sorted({stage for run in runs for stage in run["stages"]})
+            },
+            runs=len(runs),
+        )
+    results["meta"]["date"] = datetime.datetime.now().isoformat(timespec="seconds")
+    return results
+
+
+def _run_process(fname, *options):
+    """
+    Run an example with :func:`run_one` in a new process, on the fixtures and
+    with a fresh cache.
+    """
+    env = dict(
+        os.environ,
+        AGU2021_FIXTURE_DIR=os.path.abspath(FIXTURE_DIR),
+        PYGMT_USE_EXTERNAL_DISPLAY="false",
+    )
+    env.pop("AGU2021_OFFLINE_DIR", None)
+    with tempfile.TemporaryDirectory(prefix="agu2021-cache-") as cache:
+        output = os.path.join(cache, "record.json")
+        process = subprocess.run(
+            [sys.executable, __file__, "--run-one", fname, "--output", output]
+            + list(options),
+            capture_output=True,
+            text=True,
+            env=dict(env, AGU2021_CACHE_DIR=cache),
+        )
+        if process.returncode != 0:
+            raise RuntimeError(f"{fname} failed:\n{process.stdout}{process.stderr}")
+        with open(output) as record:
+            return json.load(record)
+
+
+def check_workers(fname="background.py", workers=4):
+    """
+    Check that an example saves the same figures with one and several workers.
+
+    The example runs on the fixtures with ``--workers 1`` and with
+    ``--workers <workers>`` and the saved figures are compared byte by byte.
+
+    Returns
+    -------
+    mismatches : list of str
+        One description per figure that differs or is missing.
+    """
+    with tempfile.TemporaryDirectory(prefix="agu2021-workers-") as tmpdir:
+        figures = {}
+        for count in (1, workers):
+            figures[count] = os.path.join(tmpdir, str(count))
+            record = _run_process(
+                fname, "--workers", str(count), "--figures", figures[count]
+            )
+            print(f"{fname} with {count} worker(s): {record['total']['wall_s']:.1f} s")
+        mismatches = []
+        names = set(os.listdir(figures[1])) | set(os.listdir(figures[workers]))
+        for name in sorted(names):
+            paths = [os.path.join(figures[count], name) for count in (1, workers)]
+            if not all(os.path.exists(path) for path in paths):
+                mismatches.append(f"{name} is missing with one of the worker counts")
+                continue
+            with open(paths[0], "rb") as first, open(paths[1], "rb") as second:
+                if first.read() != second.read():
+                    mismatches.append(f"{name} differs with 1 and {workers} workers")
+    return mismatches
+
+
+def _median(records):
+    """
+    Take the median of each metric over several runs (missing means 0).
+    """
+    return {
+        metric: statistics.median(record.get(metric, 0.0) for record in records)
+        for metric in METRICS
+    }
+
+
+def compare(results, baseline, time_threshold=0.2, memory_threshold=0.2):
+    """
+    Find the stages that got slower or use more memory than the baseline.
+
+    A metric regresses if it grew by more than the threshold (a fraction)
+    and by more than 0.05 s or 20 MB, so that tiny stages do not fail on
+    noise.
+
+    Returns
+    -------
+    regressions : list of str
+        One description per regression.
+    """
+    limits = dict(
+        wall_s=(time_threshold, 0.05),
+        cpu_s=(time_threshold, 0.05),
+        peak_rss_mb=(memory_threshold, 20),
+    )
+    regressions = []
+    for fname, result in results["examples"].items():
+        if fname not in baseline["examples"]:
+            continue
+        reference = baseline["examples"][fname]
+        rows = [("total", result["total"], reference["total"])] + [
+            (stage, metrics, reference["stages"].get(stage))
+            for stage, metrics in result["stages"].items()
+        ]
+        for stage, metrics, old in rows:
+            if old is None:
+                continue
+            for metric, (threshold, minimum) in limits.items():
+                new, before = metrics[metric], old[metric]
+                if new > before * (1 + threshold) and new - before > minimum:
+                    regressions.append(
+                        f"{fname} {stage} {metric}: {before:.3g} -> {new:.3g}"
+                    )
+    return regressions
+
+
+def print_results(results):
+    """
+    Print a table of the stages of every example.
+    """
+    for fname, result in results["examples"].items():
+        print(f"\n{fname} (median of {result['runs']} runs)")
+        print(f"  {'stage':<10}{'wall [s]':>10}{'cpu [s]':>10}{'peak [MB]':>11}")
+        for stage, metrics in [*result["stages"].items(), ("total", result["total"])]:
+            print(
+                f"  {stage:<10}{metrics['wall_s']:>10.2f}{metrics['cpu_s']:>10.2f}"
+                f"{metrics['peak_rss_mb']:>11.0f}"
+            )
+
+
+def main():
+    """
+    Parse the command line, run the benchmarks and check for regressions.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "examples", nargs="*", default=EXAMPLES, help="examples to run [%(default)s]"
+    )
+    parser.add_argument("--repeat", type=int, default=1, help="runs per example")
+    parser.add_argument("--output", default=RESULTS, help="results file")
+    parser.add_argument(
+        "--baseline",
+        nargs="?",
+        const=BASELINE,
+        help=f"compare against a baseline [{BASELINE}]",
+    )
+    parser.add_argument(
+        "--save-baseline", action="store_true", help="store the results as baseline"
+    )
+    parser.add_argument("--time-threshold", type=float, default=0.2)
+    parser.add_argument("--memory-threshold", type=float, default=0.2)
+    parser.add_argument(
+        "--check-workers",
+        type=int,
+        metavar="N",
+        help="check that background.py saves the same figure with 1 and N workers",
+    )
+    parser.add_argument("--run-one", help=argparse.SUPPRESS)
+    parser.add_argument("--workers", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--figures", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one:
+        record = run_one(args.run_one, workers=args.workers, figures=args.figures)
+        with open(args.output, "w") as output:
+            json.dump(record, output)
+        return
+
+    make_fixtures()
+    if args.check_workers:
+        mismatches = check_workers(workers=args.check_workers)
+        for mismatch in mismatches:
+            print(f"  {mismatch}")
+        sys.exit(1 if mismatches else 0)
+    results = run_benchmarks(args.examples, repeat=args.repeat)
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w") as output:
+        json.dump(results, output, indent=1)
+    print_results(results)
+    if args.save_baseline:
+        shutil.copyfile(args.output, BASELINE)
+        print(f"\nSaved the baseline to {BASELINE}")
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            regressions = compare(
+                results,
+                json.load(baseline),
+                time_threshold=args.time_threshold,
+                memory_threshold=args.memory_threshold,
+            )
+        print(f"\n{len(regressions)} regression(s) against {args.baseline}")
+        for regression in regressions:
+            print(f"  {regression}")
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
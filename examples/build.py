@@ -0,0 +1,375 @@
+"""
+Rebuild the example figures that are out of date.
+
+Every example is a ``py:percent`` script paired with a notebook. The inputs
+of an example are:
+
+* the code cells of the script (markdown cells do not change the figures);
+* the local modules it imports, recursively (e.g. ``daynight.py``);
+* the local data files it names (e.g. ``data/cwu.final_nam14.vel``);
+* the remote datasets it names (e.g. ``@earth_relief_01m``), by name;
+* the ``AGU2021_*`` and ``GMT*`` environment variables.
+
+Their hashes are combined into one digest per example and recorded in
+``.build/manifest.json`` together with the hashes of the figures the example
+wrote. An example runs again only if its digest changed or one of its
+figures is missing or was modified. Figures are also kept in a
+content-addressed store in ``.build/artifacts``, so going back to a
+previous set of inputs restores the figures without running anything.
+Intermediate grids (cuts, gradients, CPTs) are memoized by ``cache.py``.
+
+Examples are independent and run in parallel with ``--jobs``, each executed
+as a notebook with ``jupytext --execute``. With ``--batch``, the kernels run in
+the batch mode of ``batch.py`` (through an IPython startup file), so
+``fig.show()`` does not rasterize the figures and each kernel keeps one GMT
+session open. Run ``python build.py --help`` for the options.
+"""
+import argparse
+import ast
+import concurrent.futures
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import time
+
+BUILD_DIR = ".build"
+MANIFEST = os.path.join(BUILD_DIR, "manifest.json")
+ARTIFACTS = os.path.join(BUILD_DIR, "artifacts")
+FIGURE = re.compile(r"figures/[\w.-]+\.png")
+IPYTHON_DIR = os.path.join(BUILD_DIR, "ipython")
+STARTUP = "import batch\n\nbatch.enable()\n"
+
+
+def file_hash(fname, blocksize=2**20):
+    """
+    Return the SHA-256 hex digest of a file.
+    """
+    digest = hashlib.sha256()
+    with open(fname, "rb") as source:
+        for block in iter(lambda: source.read(blocksize), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def is_example(fname):
+    """
+    Check whether a script is a jupytext ``py:percent`` example.
+    """
+    with open(fname, encoding="utf-8") as script:
+        return "\n#       format_name: percent\n" in script.read(1000)
+
+
+def code_cells(fname):
+    """
+    Return the source of the code cells of a ``py:percent`` script.
+
+    The jupytext header and the markdown cells are left out.
+    """
+    cells, current, markdown = [], [], True
+    with open(fname, encoding="utf-8") as script:
+        for line in script:
+            if line.startswith("# %%"):
+                if not markdown:
+                    cells.append("".join(current).strip())
+                current, markdown = [], "[markdown]" in line
+            else:
+                current.append(line)
+    if not markdown:
+        cells.append("".join(current).strip())
+    return cells
+
+
+def _strings(tree):
+    """
+    Collect the string constants of a syntax tree, including f-string parts.
+    """
+    return [
+        node.value
+        for node in ast.walk(tree)
+        if isinstance(node, ast.Constant) and isinstance(node.value, str)
+    ]
+
+
+def find_inputs(fname, seen=None):
+    """
+    Find the local modules, data files and remote datasets a script uses.
+
+    Parameters
+    ----------
+    fname : str
+        The script.
+    seen : set or None
+        Modules already visited while following imports.
+
+    Returns
+    -------
+    inputs : dict
+        ``modules``, ``data`` and ``remote`` sets and the ``figures`` the
+        script writes.
+    """
+    seen = set() if seen is None else seen
+    with open(fname, encoding="utf-8") as script:
+        tree = ast.parse(script.read(), filename=fname)
+    inputs = dict(modules=set(), data=set(), remote=set(), figures=set())
+    strings = _strings(tree)
+    for value in strings:
+        if re.match(r"@\w", value):
+            inputs["remote"].add(value)
+        elif value.startswith("data/") and os.path.isfile(value):
+            inputs["data"].add(value)
+        inputs["figures"].update(FIGURE.findall(value))
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names.update(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            names.add(node.module)
+    for name in sorted(names):
+        module = f"{name}.py"
+        if not os.path.isfile(module) or module in seen:
+            continue
+        seen.add(module)
+        inputs["modules"].add(module)
+        found = find_inputs(module, seen)
+        for kind in ["modules", "data", "remote"]:
+            inputs[kind].update(found[kind])
+    return inputs
+
+
+def input_digest(fname, inputs):
+    """
+    Combine the hashes of all inputs of an example into one digest.
+    """
+    record = dict(
+        cells=hashlib.sha256("\n\n".join(code_cells(fname)).encode()).hexdigest(),
+        modules={module: file_hash(module) for module in sorted(inputs["modules"])},
+        data={data: file_hash(data) for data in sorted(inputs["data"])},
+        remote=sorted(inputs["remote"]),
+        environ={
+            name: value
+            for name, value in sorted(os.environ.items())
+            if name.startswith(("AGU2021_", "GMT"))
+        },
+        python=sys.version_info[:2],
+    )
+    return hashlib.sha256(json.dumps(record, sort_keys=True).encode()).hexdigest()
+
+
+def load_manifest():
+    """
+    Read the build manifest, or return an empty one.
+    """
+    if not os.path.exists(MANIFEST):
+        return dict(examples={}, history={})
+    with open(MANIFEST) as manifest:
+        return json.load(manifest)
+
+
+def save_manifest(manifest):
+    """
+    Atomically write the build manifest.
+    """
+    os.makedirs(BUILD_DIR, exist_ok=True)
+    with open(MANIFEST + ".tmp", "w") as output:
+        json.dump(manifest, output, indent=1, sort_keys=True)
+    os.replace(MANIFEST + ".tmp", MANIFEST)
+
+
+def store_artifact(fname):
+    """
+    Copy a file into the content-addressed store and return its hash.
+    """
+    digest = file_hash(fname)
+    path = os.path.join(ARTIFACTS, digest)
+    if not os.path.exists(path):
+        os.makedirs(ARTIFACTS, exist_ok=True)
+        shutil.copyfile(fname, path + ".tmp")
+        os.replace(path + ".tmp", path)
+    return digest
+
+
+def restore_artifacts(outputs):
+    """
+    Copy stored figures back into place. Returns False if any is missing.
+    """
+    paths = {
+        fname: os.path.join(ARTIFACTS, digest) for fname, digest in outputs.items()
+    }
+    if not outputs or not all(os.path.exists(path) for path in paths.values()):
+        return False
+    for fname, path in paths.items():
+        shutil.copyfile(path, fname)
+    return True
+
+
+def up_to_date(record, digest):
+    """
+    Check that a recorded build matches the inputs and its figures are intact.
+    """
+    if record is None or record["digest"] != digest:
+        return False
+    return all(
+        os.path.exists(fname) and file_hash(fname) == output
+        for fname, output in record["outputs"].items()
+    )
+
+
+def write_startup():
+    """
+    Write the IPython startup file that turns on batch mode in the kernels.
+    """
+    startup = os.path.join(IPYTHON_DIR, "profile_default", "startup")
+    os.makedirs(startup, exist_ok=True)
+    with open(os.path.join(startup, "00-batch.py"), "w") as output:
+        output.write(STARTUP)
+
+
+def run_example(fname, batch=False):
+    """
+    Execute an example as a notebook and return its log and run time.
+
+    With ``batch=True``, the kernel runs in the batch mode of ``batch.py``
+    (see :func:`write_startup`).
+    """
+    env = dict(os.environ, PYGMT_USE_EXTERNAL_DISPLAY="false")
+    if batch:
+        env.update(IPYTHONDIR=os.path.abspath(IPYTHON_DIR))
+    start = time.perf_counter()
+    notebook = os.path.join(BUILD_DIR, "notebooks", fname.replace(".py", ".ipynb"))
+    os.makedirs(os.path.dirname(notebook), exist_ok=True)
+    process = subprocess.run(
+        [
+            "jupytext",
+            "--to",
+            "ipynb",
+            "--execute",
+            "--run-path",
+            ".",
+            "--output",
+            notebook,
+            fname,
+        ],
+        capture_output=True,
+        text=True,
+        env=env,
+    )
+    return (
+        process.returncode,
+        process.stdout + process.stderr,
+        (time.perf_counter() - start),
+    )
+
+
+def build(examples, jobs=1, force=False, dry_run=False, batch=False):
+    """
+    Rebuild the outdated examples.
+
+    Parameters
+    ----------
+    examples : list of str
+        The example scripts to consider.
+    jobs : int
+        Number of examples run at the same time.
+    force : bool
+        Run all examples even if they are up to date.
+    dry_run : bool
+        Only report what would be done.
+    batch : bool
+        Run the examples in the batch mode of ``batch.py``.
+
+    Returns
+    -------
+    failed : list of str
+        The examples that raised an error.
+    """
+    manifest = load_manifest()
+    pending = {}
+    for fname in examples:
+        inputs = find_inputs(fname)
+        digest = input_digest(fname, inputs)
+        record = manifest["examples"].get(fname)
+        if not force and up_to_date(record, digest):
+            print(f"{fname}: up to date")
+        elif (
+            not force
+            and not dry_run
+            and restore_artifacts(manifest["history"].get(digest, {}))
+        ):
+            manifest["examples"][fname] = dict(
+                digest=digest, outputs=manifest["history"][digest]
+            )
+            print(f"{fname}: restored figures from {ARTIFACTS}")
+        else:
+            print(f"{fname}: {'would run' if dry_run else 'running'}")
+            pending[fname] = (digest, inputs)
+    save_manifest(manifest)
+    if dry_run:
+        return []
+
+    if batch:
+        write_startup()
+    failed = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+        futures = {
+            pool.submit(run_example, fname, batch=batch): fname for fname in pending
+        }
+        for future in concurrent.futures.as_completed(futures):
+            fname = futures[future]
+            code, log, seconds = future.result()
+            digest, inputs = pending[fname]
+            if code != 0:
+                failed.append(fname)
+                print(f"{fname}: failed after {seconds:.1f} s\n{log}")
+                continue
+            outputs = {
+                figure: store_artifact(figure)
+                for figure in sorted(inputs["figures"])
+                if os.path.exists(figure)
+            }
+            manifest["examples"][fname] = dict(digest=digest, outputs=outputs)
+            manifest["history"][digest] = outputs
+            save_manifest(manifest)
+            print(
+                f"{fname}: built {', '.join(outputs) or 'no figures'} in {seconds:.1f} s"
+            )
+    return failed
+
+
+def main():
+    """
+    Parse the command line and run the build.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "examples", nargs="*", help="example scripts to build [all examples]"
+    )
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="parallel runs")
+    parser.add_argument("--force", action="store_true", help="rebuild everything")
+    parser.add_argument(
+        "-n", "--dry-run", action="store_true", help="only show what would run"
+    )
+    parser.add_argument(
+        "--batch", action="store_true", help="run the examples in batch mode"
+    )
+    args = parser.parse_args()
+    examples = args.examples or sorted(
+        fname
+        for fname in os.listdir(".")
+        if fname.endswith(".py") and is_example(fname)
+    )
+    failed = build(
+        examples,
+        jobs=args.jobs,
+        force=args.force,
+        dry_run=args.dry_run,
+        batch=args.batch,
+    )
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,454 @@
+"""
+Cache cuts of the remote datasets on local disk.
+
+The examples cut the same regions of the same remote grids on every run.
+:func:`cached_grdcut` stores each cut as a file named after the hash of its
+dataset, resolution, region, registration and file format, so later runs
+(and the worker processes of the tiled pipelines) read the cut instead of
+downloading and cutting again.
+
+Products derived from grids (gradients, shading intensities and CPTs) are
+stored in the same cache under the hash of the input grid and of the
+arguments, so that changing the styling of a figure does not compute the
+illumination again.
+
+The cache is configured with environment variables:
+
+``AGU2021_CACHE_DIR``
+    Directory of the cache [``~/.cache/agu2021``].
+``AGU2021_CACHE_MAX_MB``
+    Size cap in megabytes [4096]. The least recently used cuts are removed
+    when the cache grows past it.
+``AGU2021_OFFLINE_DIR``
+    Run without network access. Missing cuts are copied from this directory
+    (e.g. a copy of the cache directory of a machine that ran the examples)
+    and remote files are looked up in it by name (``@VenusTopo180.txt`` is
+    read from ``VenusTopo180.txt``). Nothing is downloaded.
+``AGU2021_FIXTURE_DIR``
+    Replace the remote datasets with local files of the same name, e.g.
+    ``earth_relief_05m.nc`` for ``@earth_relief_05m`` (see
+    ``benchmarks.py``). Cuts of fixtures are cached separately.
+
+Entries are written atomically and recency is tracked with the modification
+time of the files, so several processes can share the cache.
+"""
+import hashlib
+import json
+import os
+import re
+import shutil
+import weakref
+
+import numpy as np
+import pygmt
+import xarray as xr
+
+# The shading argument of grdimage: [+]a<azimuth> and/or +n<normalization>
+SHADING = re.compile(r"^\+?(?:a(?P<azimuth>[^+]+))?(?:\+n(?P<normalize>[^+]+))?$")
+
+# Remote dataset names such as @earth_relief_01m or @earth_day_05m_p
+REMOTE_DATASET = re.compile(
+    r"^@(?P<dataset>[a-z_]+?)_(?P<res>\d{2}[dms])(?:_(?P<registration>[gp]))?"
+    r"(?P<modifiers>\+.*)?$"
+)
+
+# The cache entries of the grids opened by _load_grid, by id of the grid: the
+# derived products of these grids are keyed on the entry instead of the values
+_SOURCES = {}
+
+
+def cache_dir():
+    """
+    Return the cache directory, creating it if needed.
+    """
+    path = os.environ.get("AGU2021_CACHE_DIR") or os.path.join(
+        os.path.expanduser("~"), ".cache", "agu2021"
+    )
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def offline_dir():
+    """
+    Return the directory used in offline mode, or None if online.
+    """
+    return os.environ.get("AGU2021_OFFLINE_DIR") or None
+
+
+def fixture_file(name):
+    """
+    Return the local fixture that replaces a remote file, or None.
+
+    Fixtures are looked up in ``AGU2021_FIXTURE_DIR`` by the name of the
+    remote file without the ``@``, with or without its registration suffix
+    and with an optional ``.nc`` or ``.tif`` extension. Modifiers such as
+    ``+b0`` are kept.
+    """
+    directory = os.environ.get("AGU2021_FIXTURE_DIR")
+    if not directory or not name.startswith("@"):
+        return None
+    base, plus, modifiers = name[1:].partition("+")
+    for stem in dict.fromkeys([base, re.sub(r"_[gp]$", "", base)]):
+        for extension in ["", ".nc", ".tif"]:
+            path = os.path.join(directory, stem + extension)
+            if os.path.isfile(path):
+                return path + plus + modifiers
+    raise FileNotFoundError(f"No fixture for '{name}' in '{directory}'.")
+
+
+def _normalize_region(region):
+    """
+    Convert a region to a list of floats, keeping ``"d"`` and ``"g"``.
+    """
+    if region is None or region in ("d", "g"):
+        return region
+    if isinstance(region, str):
+        region = region.split("/")
+    return [float(value) for value in region]
+
+
+def cut_key(grid, region=None, registration=None, suffix=".nc"):
+    """
+    Describe a cut by its dataset, resolution, region, registration and format.
+
+    Remote datasets are identified by name. Local files are also identified
+    by their size and modification time so that edited files are cut again.
+
+    Returns
+    -------
+    key : dict
+    """
+    match = REMOTE_DATASET.match(grid)
+    if match:
+        key = dict(
+            dataset=match.group("dataset"),
+            res=match.group("res"),
+            registration=match.group("registration") or registration,
+            modifiers=match.group("modifiers"),
+        )
+    elif grid.startswith("@"):
+        key = dict(dataset=grid, registration=registration)
+    else:
+        stat = os.stat(grid)
+        key = dict(
+            dataset=os.path.abspath(grid),
+            size=stat.st_size,
+            mtime_ns=stat.st_mtime_ns,
+            registration=registration,
+        )
+    if grid.startswith("@") and os.environ.get("AGU2021_FIXTURE_DIR"):
+        key.update(fixtures=os.path.abspath(os.environ["AGU2021_FIXTURE_DIR"]))
+    key.update(region=_normalize_region(region), format=suffix)
+    return key
+
+
+def _entry_name(key):
+    """
+    Return the file name of a cache entry.
+    """
+    digest = hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+    return digest[:32] + key["format"]
+
+
+def _copy_atomic(source, destination):
+    """
+    Copy a file so that readers never see a partial destination.
+    """
+    partial = f"{destination}.{os.getpid()}.partial"
+    shutil.copyfile(source, partial)
+    os.replace(partial, destination)
+
+
+def evict(max_mb=None, keep=()):
+    """
+    Remove the least recently used entries until the cache fits its cap.
+
+    Parameters
+    ----------
+    max_mb : float or None
+        Size cap in megabytes. Uses ``AGU2021_CACHE_MAX_MB`` if None.
+    keep : list of str
+        Paths of entries that must not be removed.
+    """
+    if max_mb is None:
+        max_mb = float(os.environ.get("AGU2021_CACHE_MAX_MB", 4096))
+    entries = []
+    with os.scandir(cache_dir()) as scan:
+        for entry in scan:
+            if entry.is_file() and ".partial" not in entry.name:
+                stat = entry.stat()
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_mb * 2**20:
+            break
+        if path in keep:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass  # Removed by another process
+        total -= size
+
+
+def _fill(grid, region, registration, suffix):
+    """
+    Return the path of the cache entry of a cut, making the cut if needed.
+    """
+    key = cut_key(grid, region, registration, suffix)
+    path = os.path.join(cache_dir(), _entry_name(key))
+    if os.path.exists(path):
+        os.utime(path)
+        return path
+    offline = offline_dir()
+    if offline and os.path.exists(os.path.join(offline, _entry_name(key))):
+        _copy_atomic(os.path.join(offline, _entry_name(key)), path)
+    elif offline and grid.startswith("@"):
+        raise FileNotFoundError(f"Cut {key} is not available offline in '{offline}'.")
+    else:
+        match = REMOTE_DATASET.match(grid)
+        if registration and match and not match.group("registration"):
+            grid = (
+                f"@{match.group('dataset')}_{match.group('res')}_{registration}"
+                f"{match.group('modifiers') or ''}"
+            )
+        partial = f"{path}.{os.getpid()}.partial{suffix}"
+        pygmt.grdcut(grid=fixture_file(grid) or grid, region=region, outgrid=partial)
+        os.replace(partial, path)
+    evict(keep=[path])
+    return path
+
+
+def cut_path(grid, region=None, registration=None):
+    """
+    Return the path of the netCDF cache entry of a cut, making it if needed.
+
+    See :func:`cached_grdcut` for the parameters.
+    """
+    return _fill(grid, region, registration, ".nc")
+
+
+def cached_grdcut(grid, region=None, registration=None, outgrid=None):
+    """
+    Cut a grid like :func:`pygmt.grdcut`, going through the local cache.
+
+    Parameters
+    ----------
+    grid : str
+        A remote dataset (e.g. ``"@earth_relief_01m"``, optionally with
+        ``+b<band>``) or a grid file.
+    region : str or list or None
+        The region to cut. Keeps the whole grid if None.
+    registration : str or None
+        ``"g"`` or ``"p"`` to pick the registration of a remote dataset
+        whose name does not specify it.
+    outgrid : str or None
+        Copy the cut to this file (its extension sets the format) instead of
+        returning it.
+
+    Returns
+    -------
+    result : xarray.DataArray or None
+        The cut if ``outgrid`` is None.
+    """
+    suffix = os.path.splitext(outgrid)[1] if outgrid else ".nc"
+    path = _fill(grid, region, registration, suffix)
+    if outgrid:
+        _copy_atomic(path, outgrid)
+        return None
+    return _load_grid(path)
+
+
+def _load_grid(path):
+    """
+    Open a grid from the cache without reading its values.
+
+    The values are read from the file when they are first used, so subsets
+    only read their own rows. An open entry stays readable if it is evicted
+    or replaced by another process.
+    """
+    result = xr.open_dataarray(path)
+    _ = result.gmt  # Read the registration while the file is there
+    ident = id(result)
+    _SOURCES[ident] = (
+        weakref.ref(result, lambda _: _SOURCES.pop(ident, None)),
+        os.path.basename(path),
+    )
+    return result
+
+
+def _source_entry(grid):
+    """
+    Return the name of the cache entry a grid was opened from, or None.
+
+    Subsets and other grids computed from an opened grid are new objects and
+    have no entry.
+    """
+    ref, name = _SOURCES.get(id(grid), (None, None))
+    if ref is not None and ref() is grid:
+        return name
+    return None
+
+
+def cached_which(name):
+    """
+    Return the local path of a remote file (e.g. ``"@VenusTopo180.txt"``).
+
+    Downloads the file with :func:`pygmt.which` online, and looks it up by
+    name in ``AGU2021_OFFLINE_DIR`` offline. Fixtures take precedence and
+    other names are returned as is.
+    """
+    if not name.startswith("@"):
+        return name
+    if fixture_file(name):
+        return fixture_file(name)
+    offline = offline_dir()
+    if offline:
+        path = os.path.join(offline, name[1:])
+        if not os.path.exists(path):
+            raise FileNotFoundError(
+                f"'{name}' is not available offline in '{offline}'."
+            )
+        return path
+    return pygmt.which(name, download="c")
+
+
+def grid_hash(grid):
+    """
+    Return a hash of the values, coordinates and registration of a grid.
+
+    Grids opened from the cache (by :func:`cached_grdcut` or the ``cached_*``
+    products) are hashed by the name of their entry, which is itself the hash
+    of the cut or of the product, so that their values are not read. They
+    must not be modified in place. Other grids are hashed by value.
+    """
+    entry = _source_entry(grid)
+    if entry is not None:
+        digest = hashlib.sha256(f"entry {entry}".encode())
+    else:
+        digest = hashlib.sha256(f"{grid.dims} {grid.shape} {grid.dtype}".encode())
+        for dim in grid.dims:
+            digest.update(np.ascontiguousarray(grid[dim].to_numpy()).tobytes())
+    digest.update(f"{grid.gmt.registration} {grid.gmt.gtype}".encode())
+    if entry is None:
+        digest.update(np.ascontiguousarray(grid.to_numpy()).tobytes())
+    return digest.hexdigest()
+
+
+def _memoize(operation, grid, suffix, compute, params):
+    """
+    Return the cache entry of a product derived from a grid, computing it if
+    needed.
+
+    ``compute`` is called with the path where the product must be written.
+    """
+    key = dict(operation=operation, grid=grid_hash(grid), params=params, format=suffix)
+    return cached_entry(key, compute)
+
+
+def cached_entry(key, compute):
+    """
+    Return the path of the cache entry described by a key, computing it if
+    needed.
+
+    ``key`` is a JSON serializable dict whose ``format`` is the extension of
+    the entry. ``compute`` is called with the path where the entry must be
+    written.
+    """
+    path = os.path.join(cache_dir(), _entry_name(key))
+    if os.path.exists(path):
+        os.utime(path)
+        return path
+    partial = f"{path}.{os.getpid()}.partial{key['format']}"
+    compute(partial)
+    os.replace(partial, path)
+    evict(keep=[path])
+    return path
+
+
+def cached_grdgradient(grid, **kwargs):
+    """
+    Compute :func:`pygmt.grdgradient` of a grid, or read it from the cache.
+
+    Results are keyed on the hash of the grid (see :func:`grid_hash`) and
+    the arguments, so changing either computes the gradient again.
+
+    Parameters
+    ----------
+    grid : xarray.DataArray
+        The input grid.
+    **kwargs
+        Arguments of :func:`pygmt.grdgradient` other than ``grid`` and
+        ``outgrid``.
+
+    Returns
+    -------
+    gradient : xarray.DataArray
+    """
+
+    def compute(outgrid):
+        pygmt.grdgradient(grid=grid, outgrid=outgrid, **kwargs)
+
+    return _load_grid(_memoize("grdgradient", grid, ".nc", compute, kwargs))
+
+
+def cached_shading(grid, shading, projection=None):
+    """
+    Compute the intensity grid that ``grdimage`` makes for a shading argument.
+
+    Passing the result as ``shading`` to :meth:`pygmt.Figure.grdimage` skips
+    the illumination when the grid and the shading have not changed. Like
+    ``grdimage``, the gradient is computed in geographic coordinates (``-fg``)
+    when the grid or the map projection is geographic.
+
+    Parameters
+    ----------
+    grid : xarray.DataArray
+        The grid to plot.
+    shading : str
+        A ``grdimage`` shading such as ``"+a120+nt1.5"`` or
+        ``"a45+nt0.75"``. The azimuth defaults to -45 and the normalization to
+        ``t1``, as in GMT.
+    projection : str or None
+        The projection of the map (e.g. ``"G90/30/12c"``). Only the grid type
+        decides if None.
+
+    Returns
+    -------
+    intensity : xarray.DataArray
+    """
+    match = SHADING.match(shading)
+    if match is None:
+        raise ValueError(f"Unsupported shading '{shading}'.")
+    kwargs = dict(
+        azimuth=match.group("azimuth") or "-45",
+        normalize=match.group("normalize") or "t1",
+    )
+    # Linear (x) and polar (p) are the only Cartesian projections
+    if grid.gmt.gtype == 1 or (projection and projection[0] not in "xXpP"):
+        kwargs.update(f="g")
+    return cached_grdgradient(grid, **kwargs)
+
+
+def cached_grd2cpt(grid, **kwargs):
+    """
+    Make a CPT with :func:`pygmt.grd2cpt`, or read it from the cache.
+
+    Parameters
+    ----------
+    grid : xarray.DataArray
+        The grid the CPT is made for.
+    **kwargs
+        Arguments of :func:`pygmt.grd2cpt` other than ``grid`` and
+        ``output``.
+
+    Returns
+    -------
+    cpt : str
+        Path of the CPT file, to pass as ``cmap``.
+    """
+
+    def compute(output):
+        pygmt.grd2cpt(grid=grid, output=output, **kwargs)
+
+    return _memoize("grd2cpt", grid, ".cpt", compute, kwargs)
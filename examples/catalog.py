@@ -0,0 +1,504 @@
+"""
+Select earthquakes along profiles from the GCMT focal mechanism catalog.
+
+``pygmt.select(L="profile.txt+d100k+p")`` computes the distance from every
+event to the profile, and the focal mechanism example runs it twice to get
+the events inside and outside the corridor. Here the catalog is bucketed
+once into a grid of geographic cells (the index can be saved next to the
+working files and reused), and a profile only checks the events in the cells
+that can reach its corridor. Inside and outside sets come from the same pass.
+"""
+import hashlib
+import os
+
+import numpy as np
+import pandas as pd
+
+from cache import cached_which
+
+# Columns of the GMT meca format with the Global CMT convention (-Sc)
+COLUMNS = [
+    "longitude",
+    "latitude",
+    "depth",
+    "strike1",
+    "dip1",
+    "rake1",
+    "strike2",
+    "dip2",
+    "rake2",
+    "mantissa",
+    "exponent",
+    "plot_longitude",
+    "plot_latitude",
+    "event_name",
+]
+
+# The numeric columns read by coupe and meca -Sc
+MECA_COLUMNS = COLUMNS[:13]
+
+# Data types that GMT takes as virtual file vectors without a copy
+VECTOR_DTYPES = [np.dtype(name) for name in ("float64", "float32", "int64", "int32")]
+
+# GMT's default mean Earth radius (authalic radius of WGS-84), in km
+EARTH_RADIUS = 6371.0071809
+
+
+def load_catalog(data="@GCMT_1976-2017_meca.gmt"):
+    """
+    Read a focal mechanism catalog in the GMT ``meca`` Global CMT format.
+
+    Parameters
+    ----------
+    data : str
+        The catalog file. Remote files are downloaded first (see
+        :func:`cache.cached_which`).
+
+    Returns
+    -------
+    catalog : pandas.DataFrame
+        One row per event with the columns in ``COLUMNS`` (without
+        ``event_name`` if the file has no event titles).
+    """
+    catalog = pd.read_csv(
+        cached_which(data),
+        sep=r"\s+",
+        comment="#",
+        header=None,
+        names=COLUMNS,
+        dtype={13: str},
+    )
+    if catalog["event_name"].isna().all():
+        catalog = catalog.drop(columns="event_name")
+    return catalog
+
+
+def moment_magnitude(catalog):
+    """
+    Compute the moment magnitude of the events of a catalog.
+
+    Uses ``Mw = 2/3 (log10(M0) - 16.1)`` with the scalar moment ``M0`` in
+    dyne-cm given by the ``mantissa`` and ``exponent`` columns.
+
+    Returns
+    -------
+    magnitude : numpy.ndarray
+    """
+    log_moment = np.log10(catalog["mantissa"].to_numpy()) + catalog["exponent"]
+    return 2 / 3 * (np.asarray(log_moment, dtype="float64") - 16.1)
+
+
+def virtualfile_from_catalog(lib, catalog):
+    """
+    Wrap the focal mechanism columns of a catalog in a GMT virtual file.
+
+    The numeric ``MECA_COLUMNS`` are handed to GMT as vectors that point to
+    the memory of the DataFrame columns, so nothing is formatted as text or
+    parsed back. The integer ``exponent`` column is passed as it is. A
+    column is only copied if it is not contiguous or GMT does not take its
+    data type.
+
+    Parameters
+    ----------
+    lib : pygmt.clib.Session
+        The open GMT session.
+    catalog : pandas.DataFrame
+        Catalog from :func:`load_catalog` or a selection from it.
+
+    Returns
+    -------
+    file_context : contextlib._GeneratorContextManager
+        Yields the name of the virtual file to pass to ``coupe`` or ``meca``.
+    """
+    columns = []
+    for name in MECA_COLUMNS:
+        values = catalog[name].to_numpy()
+        if values.dtype not in VECTOR_DTYPES or not values.flags.c_contiguous:
+            values = np.ascontiguousarray(values, dtype="float64")
+        columns.append(values)
+    return lib.virtualfile_from_vectors(*columns)
+
+
+def unit_vectors(lon, lat):
+    """
+    Convert longitudes and latitudes in degrees to 3-D unit vectors.
+
+    Returns an array of shape ``(..., 3)``.
+    """
+    lon = np.deg2rad(np.asarray(lon, dtype="float64"))
+    lat = np.deg2rad(np.asarray(lat, dtype="float64"))
+    return np.stack(
+        [np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=-1
+    )
+
+
+def _dot(first, second):
+    """
+    Return the dot products of unit vectors along the last axis.
+    """
+    return np.einsum("...i,...i->...", first, second)
+
+
+def segment_geometry(points, start, end):
+    """
+    Locate unit vectors relative to great-circle arcs between two points.
+
+    The arc ends broadcast against the points, so a single arc or one arc per
+    point can be given.
+
+    Parameters
+    ----------
+    points : numpy.ndarray
+        Unit vectors of shape ``(npoints, 3)``.
+    start, end : numpy.ndarray
+        Unit vectors of the ends of the arcs, of shape ``(3,)`` or
+        ``(npoints, 3)``.
+
+    Returns
+    -------
+    along : numpy.ndarray
+        Angle in radians from ``start`` to the foot of the perpendicular from
+        each point to the great circle, positive towards ``end``.
+    across : numpy.ndarray
+        Signed angle in radians from the great circle, positive to the left
+        of the direction of travel.
+    length : float or numpy.ndarray
+        Angle in radians between ``start`` and ``end``.
+    """
+    normal = np.cross(start, end)
+    sine = np.linalg.norm(normal, axis=-1)
+    normal = normal / sine[..., np.newaxis]
+    across = np.arcsin(np.clip(_dot(points, normal), -1, 1))
+    # Project on the plane of the great circle and measure from the start
+    along = np.arctan2(_dot(points, np.cross(normal, start)), _dot(points, start))
+    length = np.arctan2(sine, _dot(start, end))
+    return along, across, length
+
+
+def _segment_distance(points, start, end):
+    """
+    Return the angular distance from unit vectors to a great-circle arc.
+    """
+    along, across, length = segment_geometry(points, start, end)
+    to_ends = np.minimum(
+        np.arccos(np.clip(_dot(points, start), -1, 1)),
+        np.arccos(np.clip(_dot(points, end), -1, 1)),
+    )
+    return np.where((along >= 0) & (along <= length), np.abs(across), to_ends)
+
+
+def _profile_vectors(profile):
+    """
+    Convert a profile (array of longitude, latitude rows) to unit vectors.
+    """
+    profile = np.asarray(profile, dtype="float64")
+    return unit_vectors(profile[:, 0], profile[:, 1])
+
+
+def corridor_mask(lon, lat, profile, width):
+    """
+    Find the points within a distance of a profile, like ``select -L+d+p``.
+
+    A point is inside if, for any segment of the profile, it is at most
+    ``width`` km from the great circle through the segment and its
+    perpendicular projection falls between the segment ends.
+
+    Parameters
+    ----------
+    lon, lat : numpy.ndarray
+        Coordinates of the points in degrees.
+    profile : array-like
+        ``(npoints, 2)`` longitudes and latitudes of the profile vertices.
+    width : float
+        Maximum distance from the profile in km.
+
+    Returns
+    -------
+    inside : numpy.ndarray
+        Boolean array.
+    """
+    points = unit_vectors(lon, lat)
+    vertices = _profile_vectors(profile)
+    inside = np.zeros(len(points), dtype=bool)
+    for start, end in zip(vertices[:-1], vertices[1:]):
+        along, across, length = segment_geometry(points, start, end)
+        inside |= (
+            (np.abs(across) * EARTH_RADIUS <= width) & (along >= 0) & (along <= length)
+        )
+    return inside
+
+
+class SpatialIndex:
+    """
+    Bucket points into a grid of geographic cells.
+
+    Points are sorted by cell so that the members of a cell are a contiguous
+    slice of ``order``. Only occupied cells are stored.
+
+    Parameters
+    ----------
+    lon, lat : numpy.ndarray
+        Coordinates of the points in degrees.
+    cell_size : float
+        Size of the cells in degrees.
+    """
+
+    def __init__(self, lon, lat, cell_size=1.0):
+        self.cell_size = float(cell_size)
+        self.checksum = self._checksum(lon, lat)
+        cells = self._cell_ids(lon, lat)
+        self.order = np.argsort(cells, kind="stable")
+        self.cells, self.starts, self.counts = np.unique(
+            cells[self.order], return_index=True, return_counts=True
+        )
+        self._centers = None
+
+    @staticmethod
+    def _checksum(lon, lat):
+        """
+        Fingerprint the coordinates that the index was built for.
+        """
+        digest = hashlib.sha1(np.ascontiguousarray(lon, dtype="float64").tobytes())
+        digest.update(np.ascontiguousarray(lat, dtype="float64").tobytes())
+        return digest.hexdigest()
+
+    def _cell_ids(self, lon, lat):
+        """
+        Return the cell number of each point.
+        """
+        ncols = round(360 / self.cell_size)
+        col = np.floor((np.asarray(lon) % 360) / self.cell_size).astype("int64")
+        row = np.floor((np.asarray(lat) + 90) / self.cell_size).astype("int64")
+        return np.minimum(row, round(180 / self.cell_size) - 1) * ncols + col % ncols
+
+    def _cell_centers(self):
+        """
+        Return the longitude and latitude of the centers of the occupied cells.
+        """
+        ncols = round(360 / self.cell_size)
+        row, col = np.divmod(self.cells, ncols)
+        return (col + 0.5) * self.cell_size, (row + 0.5) * self.cell_size - 90
+
+    def _near_cells(self, starts, ends, width):
+        """
+        Find the occupied cells that may reach the corridor of each segment.
+
+        Cells are first screened against a cap around the middle of each
+        segment with one matrix product, then by their distance to the
+        segment. Returns the segment and cell numbers of the matching pairs,
+        sorted by segment.
+        """
+        if self._centers is None:
+            self._centers = unit_vectors(*self._cell_centers())
+        # No point of a cell is farther from its center than half the diagonal
+        # of a cell at the equator
+        reach = width / EARTH_RADIUS + np.deg2rad(self.cell_size) / np.sqrt(2)
+        middles = starts + ends
+        middles /= np.linalg.norm(middles, axis=-1, keepdims=True)
+        half = np.arccos(np.clip(_dot(starts, middles), -1, 1))
+        radius = np.cos(np.minimum(half + reach, np.pi))
+        segments, cells = np.nonzero(middles @ self._centers.T >= radius[:, None])
+        near = (
+            _segment_distance(self._centers[cells], starts[segments], ends[segments])
+            <= reach
+        )
+        return segments[near], cells[near]
+
+    def _members(self, cells):
+        """
+        Return the points of each cell in a list of cells, concatenated.
+        """
+        counts = self.counts[cells]
+        offsets = np.cumsum(counts) - counts
+        positions = np.repeat(self.starts[cells] - offsets, counts)
+        return self.order[positions + np.arange(counts.sum())]
+
+    def candidates(self, profile, width):
+        """
+        Return the points in cells that may be within a distance of a profile.
+
+        Parameters
+        ----------
+        profile : array-like
+            ``(npoints, 2)`` longitudes and latitudes of the profile vertices.
+        width : float
+            Distance from the profile in km.
+
+        Returns
+        -------
+        indices : numpy.ndarray
+            Sorted indices of the candidate points.
+        """
+        vertices = _profile_vectors(profile)
+        cells = self._near_cells(vertices[:-1], vertices[1:], width)[1]
+        return np.sort(self._members(np.unique(cells)))
+
+    def candidate_pairs(self, starts, ends, width):
+        """
+        Return the candidate points of many segments at once.
+
+        Parameters
+        ----------
+        starts, ends : numpy.ndarray
+            Unit vectors of shape ``(nsegments, 3)`` of the segment ends.
+        width : float
+            Distance from the segments in km.
+
+        Returns
+        -------
+        segments, indices : numpy.ndarray
+            Segment number and point index of each candidate, sorted by
+            segment and then by point.
+        """
+        segments, cells = self._near_cells(starts, ends, width)
+        indices = self._members(cells)
+        segments = np.repeat(segments, self.counts[cells])
+        order = np.lexsort((indices, segments))
+        return segments[order], indices[order]
+
+    def save(self, fname):
+        """
+        Save the index to a ``.npz`` file.
+        """
+        np.savez(
+            fname,
+            cell_size=self.cell_size,
+            checksum=self.checksum,
+            order=self.order,
+            cells=self.cells,
+            starts=self.starts,
+            counts=self.counts,
+        )
+
+    @classmethod
+    def load(cls, fname):
+        """
+        Load an index saved with :meth:`save`.
+        """
+        index = cls.__new__(cls)
+        index._centers = None
+        with np.load(fname) as saved:
+            index.cell_size = float(saved["cell_size"])
+            index.checksum = str(saved["checksum"])
+            for name in ["order", "cells", "starts", "counts"]:
+                setattr(index, name, saved[name])
+        return index
+
+
+def load_index(catalog, fname, cell_size=1.0):
+    """
+    Load the spatial index of a catalog from a file, building it if needed.
+
+    The saved index is rebuilt if it was made for other coordinates or
+    another cell size.
+
+    Parameters
+    ----------
+    catalog : pandas.DataFrame
+        Catalog from :func:`load_catalog`.
+    fname : str
+        The ``.npz`` file that stores the index.
+    cell_size : float
+        Size of the cells in degrees.
+
+    Returns
+    -------
+    index : SpatialIndex
+    """
+    lon, lat = catalog["longitude"].to_numpy(), catalog["latitude"].to_numpy()
+    if os.path.exists(fname):
+        index = SpatialIndex.load(fname)
+        if (
+            index.checksum == SpatialIndex._checksum(lon, lat)
+            and index.cell_size == cell_size
+        ):
+            return index
+    index = SpatialIndex(lon, lat, cell_size=cell_size)
+    index.save(fname)
+    return index
+
+
+def partition(catalog, profile, width, index=None):
+    """
+    Split a catalog into the events inside and outside a profile corridor.
+
+    Equivalent to running ``pygmt.select`` with ``L="profile+d<width>k+p"``
+    once normally and once with ``reverse="l"``.
+
+    Parameters
+    ----------
+    catalog : pandas.DataFrame
+        Catalog from :func:`load_catalog`.
+    profile : array-like
+        ``(npoints, 2)`` longitudes and latitudes of the profile vertices.
+    width : float
+        Half-width of the corridor in km.
+    index : SpatialIndex or None
+        Index of the catalog. Without it, every event is checked.
+
+    Returns
+    -------
+    inside, outside : pandas.DataFrame
+        The events inside and outside the corridor, in catalog order.
+    """
+    if index is None:
+        candidates = np.arange(len(catalog))
+    else:
+        candidates = index.candidates(profile, width)
+    lon = catalog["longitude"].to_numpy()[candidates]
+    lat = catalog["latitude"].to_numpy()[candidates]
+    inside = np.zeros(len(catalog), dtype=bool)
+    inside[candidates[corridor_mask(lon, lat, profile, width)]] = True
+    return catalog[inside], catalog[~inside]
+
+
+def cross_sections(catalog, profiles, width, index=None):
+    """
+    Select the events along many cross-section profiles at once.
+
+    The candidate events of all profiles are gathered into one table of
+    (profile, event) pairs and their along-track distance and across-track
+    offset are computed in a single vectorized pass. No files are written.
+
+    Parameters
+    ----------
+    catalog : pandas.DataFrame
+        Catalog from :func:`load_catalog`.
+    profiles : array-like
+        ``(nprofiles, 4)`` start longitude, start latitude, end longitude and
+        end latitude of each profile (the ``-Aa`` arguments of ``coupe``).
+    width : float
+        Half-width of the corridors in km.
+    index : SpatialIndex or None
+        Index of the catalog. Without it, every event is checked against
+        every profile.
+
+    Yields
+    ------
+    section : pandas.DataFrame
+        For each profile in order, the events within ``width`` km whose
+        projection falls on the profile, in catalog order. The catalog
+        columns come first (select them with ``section[catalog.columns]``
+        for ``coupe`` and ``meca``), followed by ``distance`` along the
+        profile and signed ``offset`` to its left, both in km.
+    """
+    profiles = np.asarray(profiles, dtype="float64").reshape(-1, 4)
+    starts = unit_vectors(profiles[:, 0], profiles[:, 1])
+    ends = unit_vectors(profiles[:, 2], profiles[:, 3])
+    if index is None:
+        pairs = np.repeat(np.arange(len(profiles)), len(catalog))
+        events = np.tile(np.arange(len(catalog)), len(profiles))
+    else:
+        pairs, events = index.candidate_pairs(starts, ends, width)
+    points = unit_vectors(
+        catalog["longitude"].to_numpy()[events], catalog["latitude"].to_numpy()[events]
+    )
+    along, across, length = segment_geometry(points, starts[pairs], ends[pairs])
+    inside = (np.abs(across) * EARTH_RADIUS <= width) & (along >= 0) & (along <= length)
+    pairs, events = pairs[inside], events[inside]
+    along, across = along[inside] * EARTH_RADIUS, across[inside] * EARTH_RADIUS
+    bounds = np.searchsorted(pairs, np.arange(len(profiles) + 1))
+    for first, last in zip(bounds[:-1], bounds[1:]):
+        yield catalog.iloc[events[first:last]].assign(
+            distance=along[first:last], offset=across[first:last]
+        )
@@ -19,22 +19,36 @@
 # This example is based on the Generic Mapping Tool's example 33 (https://docs.generic-mapping-tools.org/latest/gallery/ex33.html).
 #
 # Data from Tozer et al., 2019 (http://dx.doi.org/10.1029/2019EA000658) provided via `earth_relief_01m`.
-#
-# import numpy as np
-# import pandas as pd
 
 # %%
+import numpy as np
 import pygmt
 
+from cache import cached_grdcut, cached_shading
+from profiles import (
+    cross_profiles,
+    envelope,
+    nan_separated,
+    sample_bilinear,
+    stack_profiles,
+)
+
 # %%
-# Extract a subset of earth_relief_01m for the East Pacific Rise
-grid = pygmt.grdcut("@earth_relief_01m", region=[-118, -107, -49, -42])
+# Extract a subset of earth_relief_01m for the East Pacific Rise (the cut is kept
+# in the local cache for the next runs)
+grid = cached_grdcut("@earth_relief_01m", region=[-118, -107, -49, -42])
 
 # %%
 # Plot the grid subset
 fig = pygmt.Figure()
 pygmt.makecpt(cmap="bukavu", series=[-5000, -2000])
-fig.grdimage(grid=grid, projection="M15c", shading="a15+ne0.75", frame=True)
+# The illumination is read from the local cache when the grid has not changed
+fig.grdimage(
+    grid=grid,
+    projection="M15c",
+    shading=cached_shading(grid, "a15+ne0.75"),
+    frame=True,
+)
 fig.text(
     text=r"Data from Tozer et al., 2019",
     position="cBR",
@@ -56,40 +70,31 @@ fig.show()
 
 # %%
 # Generate cross-profiles 400 km long, spaced 10 km, samped every 2km and stack these using the median
-pygmt.grdtrack(
-    points=points,
-    grid=grid,
-    crossprofile="400k/2k/10k+v",
-    stack='m+s"stack.txt"',
-    outfile="profiles.txt",
-)
+lon, lat, distance = cross_profiles(points, length=400, step=2, spacing=10)
+values = sample_bilinear(grid, lon, lat)
+stack = stack_profiles(values, distance, method="median")
 
 # %%
 # Plot the cross-profiles
-fig.plot(data="profiles.txt", pen="0.75p")
+x, y = nan_separated(lon, lat)
+fig.plot(x=x, y=y, pen="0.75p")
 fig.show()
 
 # %%
 # Create an envelope
-upper = pd.read_csv(
-    "stack.txt", sep="\t", header=None, usecols=[0, 5], names=["Distance", "Value"]
-)
-lower = pd.read_csv(
-    "stack.txt", sep="\t", header=None, usecols=[0, 6], names=["Distance", "Value"]
-)
-envelope = pd.concat([upper, lower[::-1]], ignore_index=True)
+polygon = envelope(stack)
 
 # %%
 fig.shift_origin(yshift="h+2c")
 fig.plot(
-    data=envelope,
+    data=polygon,
     region=[-200, 200, -3500, -2000],
     projection="X15c/7.5c",
     color="lightgrey",
     frame=['xafg1000+l"Distance from ridge (km)"', 'yaf+l"Depth (m)"', "WSNE"],
 )
 fig.plot(
-    data="stack.txt",
+    data=stack[["distance", "value"]],
     region=[-200, 200, -3500, -2000],
     projection="X15c/7.5c",
     pen="3p",
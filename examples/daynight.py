@@ -0,0 +1,405 @@
+"""
+Blend the NASA day and night images in memory.
+
+This replaces the ``gmt grdmath ... DAYNIGHT``, ``gmt grdmath ... MUL`` and
+``gmt grdmix`` steps of the abstract and background examples, which write
+full global grids to disk only to read them straight back. Every stage here
+takes and returns xarray DataArrays and the blended image is handed to
+``grdimage`` through virtual files.
+"""
+import contextlib
+import struct
+import zlib
+
+import numpy as np
+import pygmt
+import xarray as xr
+
+from cache import cached_grdgradient
+from gridserver import cut
+
+# GMT defaults used by grdimage/grdmix to apply an intensity to a color
+COLOR_HSV_MAX_S = 0.1
+COLOR_HSV_MIN_S = 1.0
+COLOR_HSV_MAX_V = 1.0
+COLOR_HSV_MIN_V = 0.3
+
+# Pixels blended at a time (whole rows), which bounds the size of the float32
+# temporaries of the color conversions
+BLEND_PIXELS = 2**22
+
+# First PyGMT release whose grdimage takes a three-band DataArray image
+RGB_GRDIMAGE_VERSION = (0, 10)
+
+
+def daynight(lon, lat, sun_lon, sun_lat, transition=2):
+    """
+    Compute day/night weights like ``gmt grdmath ... DAYNIGHT``.
+
+    The weight is 1 where the sun shines and 0 elsewhere, with a smooth
+    arctangent step centred on the terminator (90 degrees from the sub-solar
+    point).
+
+    Parameters
+    ----------
+    lon, lat : array-like
+        1-D longitude and latitude coordinates of the output grid, in
+        degrees.
+    sun_lon, sun_lat : float
+        Location of the sub-solar point, e.g. from ``gmt solar -C -o0:1``.
+    transition : float
+        Width of the transition across the terminator, in degrees. Use 0 for
+        a sharp boundary.
+
+    Returns
+    -------
+    weights : xarray.DataArray
+        Float32 grid with dimensions ``(lat, lon)``.
+    """
+    lon = np.asarray(lon, dtype="float64")
+    lat = np.asarray(lat, dtype="float64")
+    rlat = np.deg2rad(lat)[:, np.newaxis]
+    dlon = np.deg2rad(lon - sun_lon)[np.newaxis, :]
+    rsun = np.deg2rad(sun_lat)
+    # Cosine of the angular distance to the sub-solar point, as separable
+    # row and column terms so that the full grid is only built once
+    cosdist = (np.sin(rlat) * np.sin(rsun)).astype("float32") + (
+        np.cos(rlat) * np.cos(rsun)
+    ).astype("float32") * np.cos(dlon).astype("float32")
+    # 90 degrees minus the distance is the sun's elevation above the horizon
+    elevation = np.rad2deg(np.arcsin(np.clip(cosdist, -1, 1, out=cosdist)))
+    if transition == 0:
+        weights = (elevation >= 0).astype("float32")
+    else:
+        weights = 0.5 + np.arctan(elevation / transition) / np.float32(np.pi)
+    return xr.DataArray(
+        weights.astype("float32", copy=False),
+        coords={"lat": lat, "lon": lon},
+        dims=("lat", "lon"),
+        name="weights",
+    )
+
+
+def ocean_intensity(intensity, mask):
+    """
+    Keep the intensity over the oceans and set it to NaN on land.
+
+    Equivalent to ``gmt grdmath mask 0 EQ 0 NAN intensity MUL``.
+
+    Parameters
+    ----------
+    intensity : xarray.DataArray
+        Intensity grid, e.g. from :func:`pygmt.grdgradient`.
+    mask : xarray.DataArray
+        A grid of the same shape from ``@earth_mask`` (0 is ocean).
+
+    Returns
+    -------
+    intensity : xarray.DataArray
+        The masked intensity.
+    """
+    _check_shape(intensity, mask)
+    values = np.where(np.asarray(mask) == 0, np.asarray(intensity), np.nan)
+    return intensity.copy(data=values.astype(intensity.dtype, copy=False))
+
+
+def _rgb_to_hsv(rgb):
+    """
+    Convert an array of RGB values in [0, 1] on the first axis to HSV.
+    """
+    zero, one = np.zeros(1, dtype=rgb.dtype), np.ones(1, dtype=rgb.dtype)
+    red, green, blue = rgb
+    vmax = rgb.max(axis=0)
+    delta = vmax - rgb.min(axis=0)
+    safe = np.where(delta == 0, one, delta)
+    hue = np.select(
+        [vmax == red, vmax == green],
+        [(green - blue) / safe, 2 + (blue - red) / safe],
+        4 + (red - green) / safe,
+    )
+    hue = np.where(delta == 0, zero, (hue / 6) % 1)
+    saturation = np.where(vmax == 0, zero, delta / np.where(vmax == 0, one, vmax))
+    return np.stack([hue, saturation, vmax])
+
+
+def _hsv_to_rgb(hsv):
+    """
+    Convert an array of HSV values on the first axis back to RGB in [0, 1].
+    """
+    hue, saturation, value = hsv
+    sector = np.floor(hue * 6)
+    frac = hue * 6 - sector
+    sector = sector.astype("int8") % 6
+    p = value * (1 - saturation)
+    q = value * (1 - saturation * frac)
+    t = value * (1 - saturation * (1 - frac))
+    choices = [
+        (value, t, p),
+        (q, value, p),
+        (p, value, t),
+        (p, q, value),
+        (t, p, value),
+        (value, p, q),
+    ]
+    return np.stack(
+        [np.choose(sector, [choice[band] for choice in choices]) for band in range(3)]
+    )
+
+
+def illuminate(rgb, intensity):
+    """
+    Lighten or darken colors by an intensity the way GMT does.
+
+    Positive intensities move the color towards ``COLOR_HSV_MAX_S`` and
+    ``COLOR_HSV_MAX_V``, negative ones towards ``COLOR_HSV_MIN_S`` and
+    ``COLOR_HSV_MIN_V``. NaN intensities leave the color unchanged.
+
+    Parameters
+    ----------
+    rgb : numpy.ndarray
+        Float32 array of shape ``(3, nlat, nlon)`` with values in [0, 1].
+    intensity : numpy.ndarray
+        Array of shape ``(nlat, nlon)``, clipped to [-1, 1].
+
+    Returns
+    -------
+    rgb : numpy.ndarray
+        The illuminated colors as float32.
+    """
+    rgb = np.asarray(rgb, dtype="float32")
+    intensity = np.nan_to_num(np.asarray(intensity, dtype="float32"), nan=0.0)
+    intensity = np.clip(intensity, -1, 1, out=intensity)
+    hsv = _rgb_to_hsv(rgb)
+    brighter = intensity > 0
+    # Weight of the target value and of the original value for each node
+    strength = np.abs(intensity)
+    keep = 1 - strength
+    target_s = np.where(
+        brighter, np.float32(COLOR_HSV_MAX_S), np.float32(COLOR_HSV_MIN_S)
+    )
+    target_v = np.where(
+        brighter, np.float32(COLOR_HSV_MAX_V), np.float32(COLOR_HSV_MIN_V)
+    )
+    hsv[1] = np.where(hsv[1] != 0, keep * hsv[1] + strength * target_s, hsv[1])
+    hsv[2] = keep * hsv[2] + strength * target_v
+    return _hsv_to_rgb(np.clip(hsv, 0, 1, out=hsv))
+
+
+def blend(day, night, weights, intensity=None):
+    """
+    Blend the day and night images and adjust the colors by an intensity.
+
+    Equivalent to ``gmt grdmix day night -Wweights -Iintensity``: the result
+    is the day image where the weight is 1 and the night image where it is 0.
+
+    Parameters
+    ----------
+    day, night : xarray.DataArray
+        RGB images with dimensions ``(band, lat, lon)``, e.g. from
+        :func:`load_image`.
+    weights : xarray.DataArray
+        Grid from :func:`daynight` with the same ``(lat, lon)`` shape.
+    intensity : xarray.DataArray or None
+        Optional intensity grid with the same shape, e.g. from
+        :func:`ocean_intensity`.
+
+    Returns
+    -------
+    rgb : xarray.DataArray
+        The blended uint8 image with the coordinates of ``day``.
+
+    Notes
+    -----
+    The colors are computed in float32, in blocks of rows of about
+    ``BLEND_PIXELS`` pixels, so the temporaries have the size of one block
+    whatever the size of the images.
+    """
+    _check_shape(day, night)
+    _check_shape(day[0], weights)
+    if intensity is not None:
+        _check_shape(weights, intensity)
+    day_values, night_values = np.asarray(day), np.asarray(night)
+    weight = np.asarray(weights, dtype="float32")
+    rgb = np.empty(day.shape, dtype="uint8")
+    nrows = max(1, BLEND_PIXELS // rgb.shape[2])
+    for start in range(0, rgb.shape[1], nrows):
+        rows = slice(start, start + nrows)
+        block = day_values[:, rows].astype("float32")
+        block *= weight[rows]
+        block += (1 - weight[rows]) * night_values[:, rows]
+        block /= 255
+        if intensity is not None:
+            block = illuminate(block, np.asarray(intensity[rows], dtype="float32"))
+        block *= 255
+        rgb[:, rows] = np.rint(block, out=block)
+    return day.copy(data=rgb)
+
+
+def load_image(name, region=None):
+    """
+    Read the three bands of an RGB image (e.g. ``@earth_day_02m``).
+
+    Parameters
+    ----------
+    name : str
+        A remote dataset name or any file GMT reads through GDAL. Bands
+        served by :mod:`gridserver` are read from shared memory.
+    region : str or list or None
+        Subregion to cut. Reads the whole image if None.
+
+    Returns
+    -------
+    rgb : xarray.DataArray
+        Uint8 array with dimensions ``(band, lat, lon)``.
+    """
+    bands = [cut(f"{name}+b{band}", region=region or "d") for band in range(3)]
+    rgb = xr.concat(bands, dim="band").astype("uint8")
+    return rgb.assign_coords(band=[0, 1, 2])
+
+
+def save_png(rgb, fname):
+    """
+    Write an RGB image to a PNG file, north up.
+
+    The rows are compressed in blocks of about ``BLEND_PIXELS`` pixels, so
+    images memory-mapped from disk (e.g. from :func:`tiling.blend_tiled`) are
+    never read into memory at once.
+
+    Parameters
+    ----------
+    rgb : xarray.DataArray
+        Uint8 image with dimensions ``(band, lat, lon)``.
+    fname : str
+        The PNG file.
+    """
+    _, nrows, ncols = rgb.shape
+    values = rgb.values if rgb.lat[0] > rgb.lat[-1] else rgb.values[:, ::-1]
+    compressor = zlib.compressobj()
+
+    def chunk(kind, data):
+        crc = zlib.crc32(data, zlib.crc32(kind))
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", crc)
+
+    with open(fname, "wb") as png:
+        png.write(b"\x89PNG\r\n\x1a\n")
+        png.write(chunk(b"IHDR", struct.pack(">IIBBBBB", ncols, nrows, 8, 2, 0, 0, 0)))
+        block = max(1, BLEND_PIXELS // ncols)
+        for start in range(0, nrows, block):
+            rows = values[:, start : start + block]
+            # Each row starts with the byte of the "None" filter
+            lines = np.zeros((rows.shape[1], 3 * ncols + 1), dtype="uint8")
+            lines[:, 1:] = rows.transpose(1, 2, 0).reshape(rows.shape[1], -1)
+            png.write(chunk(b"IDAT", compressor.compress(lines.tobytes())))
+        png.write(chunk(b"IDAT", compressor.flush()))
+        png.write(chunk(b"IEND", b""))
+
+
+def blend_region(
+    res,
+    region,
+    sun_lon,
+    sun_lat,
+    transition=2,
+    azimuth=45,
+    normalize="t0.5",
+    halo_region=None,
+):
+    """
+    Run the whole day/night pipeline for one region.
+
+    Loads the day and night images, computes the weights, an ocean intensity
+    from the ``grdgradient`` of ``@earth_relief`` and blends them.
+
+    Parameters
+    ----------
+    res : str
+        Resolution of the remote datasets (e.g. ``"02m"``).
+    region : list
+        ``[west, east, south, north]`` of the output.
+    sun_lon, sun_lat : float
+        Location of the sub-solar point.
+    transition : float
+        Width of the day/night transition in degrees.
+    azimuth : float
+        Illumination azimuth for ``grdgradient``.
+    normalize : str
+        Normalization passed to ``grdgradient`` (its ``-N`` option).
+    halo_region : list or None
+        A larger region to compute the gradient on before trimming it to
+        ``region``, so that the gradient at the edges does not depend on
+        where the region was cut.
+
+    Returns
+    -------
+    rgb : xarray.DataArray
+        The blended uint8 image with dimensions ``(band, lat, lon)``.
+    """
+    west, east, south, north = region
+    day = load_image(f"@earth_day_{res}", region=region)
+    night = load_image(f"@earth_night_{res}", region=region)
+    weights = daynight(day.lon, day.lat, sun_lon, sun_lat, transition=transition)
+    relief = cut(f"@earth_relief_{res}", region=halo_region or region)
+    intens = cached_grdgradient(relief, normalize=normalize, azimuth=azimuth, f="g")
+    intens = intens.sel(lon=slice(west, east), lat=slice(south, north))
+    mask = cut(f"@earth_mask_{res}", region=region)
+    return blend(day, night, weights, ocean_intensity(intens, mask))
+
+
+def grdimage_rgb(fig, rgb, projection=None, region=None, frame=None, verbose=None):
+    """
+    Plot an in-memory RGB image on a figure.
+
+    PyGMT releases before ``RGB_GRDIMAGE_VERSION`` cannot plot an image held
+    in memory, so with them the three bands are passed to ``grdimage`` as
+    red, green and blue virtual grids on the figure made current with the
+    private ``Figure._activate_figure``. Later releases plot the image with
+    the public :meth:`pygmt.Figure.grdimage` (which needs ``rioxarray``).
+
+    Parameters
+    ----------
+    fig : pygmt.Figure
+        The figure to plot on.
+    rgb : xarray.DataArray
+        Image with dimensions ``(band, lat, lon)``, e.g. from :func:`blend`.
+    projection, region, frame, verbose : str or None
+        The ``-J``, ``-R``, ``-B`` and ``-V`` options of ``grdimage``.
+    """
+    if _pygmt_version() >= RGB_GRDIMAGE_VERSION:
+        fig.grdimage(
+            grid=rgb.rename(lat="y", lon="x"),
+            projection=projection,
+            region=region,
+            frame=frame,
+            verbose=verbose,
+        )
+        return
+    options = [
+        f"-{flag}{value}"
+        for flag, value in zip("JRBV", (projection, region, frame, verbose))
+        if value is not None
+    ]
+    fig._activate_figure()  # pylint: disable=protected-access
+    with pygmt.clib.Session() as lib, contextlib.ExitStack() as stack:
+        bands = [
+            stack.enter_context(lib.virtualfile_from_grid(rgb[band]))
+            for band in range(3)
+        ]
+        lib.call_module("grdimage", " ".join(bands + options))
+
+
+def _pygmt_version():
+    """
+    Return the major and minor version of PyGMT (e.g. ``(0, 5)``).
+    """
+    major, minor = pygmt.__version__.lstrip("v").split(".")[:2]
+    return int(major), int(minor)
+
+
+def _check_shape(first, second):
+    """
+    Raise an error if two grids do not have the same shape.
+    """
+    if np.shape(first) != np.shape(second):
+        raise ValueError(
+            f"Grid shapes {np.shape(first)} and {np.shape(second)} do not match."
+        )
@@ -27,26 +27,24 @@
 import pandas as pd
 import pygmt
 
+from catalog import load_index, moment_magnitude, partition, virtualfile_from_catalog
+from gcmtstore import cached_catalog
+from lod import decimate
+from resolution import resolve_grid
+
 # %%
 # Select points for the cross section
 profile = pd.DataFrame(data={"x": [-75.02, -63.65], "y": [-33.5, -31]})
-profile.to_csv("profile.txt", sep=",", header=None, index=False)
 # np.array([[-111.6, -43.0], [-113.3, -47.5]])
-# profile.tofile('profile.txt', sep=',')
-# Extract data inside/outside profile
-pygmt.select(
-    data="@GCMT_1976-2017_meca.gmt",
-    L="profile.txt+d100k+p",
-    coltypes="g",
-    outfile="GCMT_1976-2017_meca_in.txt",
-)
-pygmt.select(
-    data="@GCMT_1976-2017_meca.gmt",
-    L="profile.txt+d100k+p",
-    coltypes="g",
-    reverse="l",
-    outfile="GCMT_1976-2017_meca_out.txt",
+# Read the events between 0 and 190 km deep (the range of the colormap) from a binary
+# columnar copy of the catalog, made on the first run (see gcmtstore.py).
+catalog = cached_catalog(
+    "@GCMT_1976-2017_meca.gmt", "GCMT_1976-2017_meca.store", depth=(0, 190)
 )
+# Extract data inside/outside profile in one pass. The spatial index of the
+# catalog is saved so that other profiles only check the nearby events.
+index = load_index(catalog, "GCMT_1976-2017_meca_index.npz")
+meca_in, meca_out = partition(catalog, profile.to_numpy(), width=100, index=index)
 
 # %%
 # Create figure
@@ -66,36 +64,50 @@ fig.basemap(
     projection="X22.73i/-2.7i",
     frame=["g25", "wESn", 'xaf+l"Distance (km)"', 'yaf+l"Depth (km)"'],
 )
-# Plot the focal mechanism cross-sections
+# Plot the focal mechanism cross-sections. The selected events are passed to
+# GMT as virtual files that point to the DataFrame columns.
 with pygmt.clib.Session() as lib:
-    file_context = lib.virtualfile_from_data(
-        check_kind="vector",
-        data="GCMT_1976-2017_meca_in.txt",
-        x=None,
-        y=None,
-        extra_arrays=None,
-    )
-    with file_context as fname:
+    with virtualfile_from_catalog(lib, meca_in) as fname:
         lib.call_module(
             "coupe",
             f"{fname} -Aa-75.02/-33.5/-63.65/-31+w100k -Q -Sc0.5c+f0 -C -Wfaint",
         )
 # Shift the plot origin to create a new subplot
 fig.shift_origin(yshift="h+0.3i")
-# Plot earth relief data for the region
+# Plot earth relief data for the region, at the resolution of the saved figure but
+# without the SRTM tiles
+map_region = [-75.1, -63, -34.44, -30.35]
+map_projection = "M22.73i"
 fig.grdimage(
-    grid="@earth_relief",
+    grid=resolve_grid("earth_relief", map_region, map_projection, finest="15s"),
     cmap="oleron",
     shading="+nt1.2",
-    region=[-75.1, -63, -34.44, -30.35],
-    projection="M22.73i",
+    region=map_region,
+    projection=map_projection,
     frame=["wsNE", "a2f1"],
 )
 # Create a colormap for earthquake depths
 pygmt.makecpt(series=[0, 190], cmap="hot", reverse=True)
+# Keep only the events on the map and, in every 8x8 pixel cell of the saved
+# figure, the largest one (the others would be hidden below it)
+meca_in, meca_out = (
+    decimate(
+        events,
+        "longitude",
+        "latitude",
+        priority=moment_magnitude(events),
+        region=map_region,
+        projection=map_projection,
+        cell=8,
+    )
+    for events in (meca_in, meca_out)
+)
 # Plot the earthquake focal mechanisms
-fig.meca(spec="GCMT_1976-2017_meca_in.txt", C=True, convention="gcmt", scale="0.5c+f0")
-fig.meca(spec="GCMT_1976-2017_meca_out.txt", convention="gcmt", scale="0.5c+f0")
+with pygmt.clib.Session() as lib:
+    with virtualfile_from_catalog(lib, meca_in) as fname:
+        lib.call_module("meca", f"{fname} -Sc0.5c+f0 -C")
+    with virtualfile_from_catalog(lib, meca_out) as fname:
+        lib.call_module("meca", f"{fname} -Sc0.5c+f0")
 # Add citations
 fig.text(
     text=r"Based on GMT Animation 14 by F. Esteban (https://youtu.be/Wk58r72g_nk)",
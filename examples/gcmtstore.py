@@ -0,0 +1,382 @@
+"""
+Store the GCMT focal mechanism catalog in a binary columnar format.
+
+:func:`catalog.load_catalog` parses the whole text catalog (about 50,000
+events) on every run, although the examples only plot a range of depths, a
+time window or the larger events. :func:`write_store` converts a catalog to a
+directory with one raw binary file per column, the events sorted by the time
+in their name, and a ``meta.json`` with the smallest and largest time, depth
+and moment magnitude of every block of ``block_size`` events.
+:func:`read_store` only reads the slices of the column files of the blocks
+whose ranges overlap the requested ones, then filters their rows.
+:func:`append_events` adds new events (e.g. a monthly GCMT release) at the end
+of the column files, skipping the events already stored. Only the last block
+is rewritten if it was not full.
+
+Event names give the centroid time to the minute (``C201709080449A``), or
+the day with a two-digit year for the older ones (``B010176A``). Events
+without a name in either form have no time and are only read when no time
+range is given.
+
+Convert a catalog with ``python gcmtstore.py convert
+@GCMT_1976-2017_meca.gmt GCMT_1976-2017_meca.store`` and add events with
+``python gcmtstore.py append new_events.gmt GCMT_1976-2017_meca.store``.
+"""
+import argparse
+import json
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+from catalog import COLUMNS, load_catalog, moment_magnitude
+
+# Number of events per block of statistics
+BLOCK_SIZE = 4096
+
+# Data type of the stored columns, names as fixed width bytes
+DTYPES = {
+    **{name: "<f8" for name in COLUMNS[:-1]},
+    "event_name": "S16",
+    "time": "<M8[s]",
+}
+
+# Names of events since 2006 (YYYYMMDDhhmm) and before (MMDDYY)
+NEW_NAME = re.compile(r"^[A-Z]?(\d{4})(\d{2})(\d{2})(\d{2})(\d{2})[A-Z]$")
+OLD_NAME = re.compile(r"^[A-Z]?(\d{2})(\d{2})(\d{2})[A-Z]$")
+
+
+def _name_time(name):
+    """
+    Return the time in a GCMT event name as an ISO string, or ``"NaT"``.
+    """
+    if not isinstance(name, str):
+        return "NaT"
+    match = NEW_NAME.match(name)
+    if match:
+        year, month, day, hour, minute = match.groups()
+        return f"{year}-{month}-{day}T{hour}:{minute}"
+    match = OLD_NAME.match(name)
+    if match:
+        month, day, year = match.groups()
+        # The catalog starts in 1976
+        century = "19" if int(year) >= 76 else "20"
+        return f"{century}{year}-{month}-{day}"
+    return "NaT"
+
+
+def event_times(names):
+    """
+    Get the centroid times of events from their GCMT names.
+
+    Parameters
+    ----------
+    names : array-like
+        Event names such as ``"C201709080449A"`` or ``"B010176A"``.
+
+    Returns
+    -------
+    times : numpy.ndarray
+        ``datetime64[s]`` array, NaT where the name cannot be parsed.
+    """
+    return np.array([_name_time(name) for name in names], dtype="datetime64[s]")
+
+
+def _column_path(path, name):
+    """
+    Return the path of the file of a column in a store.
+    """
+    return os.path.join(path, f"{name}.bin")
+
+
+def _read_meta(path):
+    """
+    Read the metadata of a store.
+    """
+    with open(os.path.join(path, "meta.json")) as meta_json:
+        return json.load(meta_json)
+
+
+def _write_meta(path, meta):
+    """
+    Atomically write the metadata of a store.
+    """
+    metafile = os.path.join(path, "meta.json")
+    with open(metafile + ".tmp", "w") as meta_json:
+        json.dump(meta, meta_json)
+    os.replace(metafile + ".tmp", metafile)
+
+
+def _range(values):
+    """
+    Return ``[min, max]`` of the valid values, or None if there are none.
+    """
+    if np.issubdtype(values.dtype, np.datetime64):
+        values = values[~np.isnat(values)].astype("int64")
+    else:
+        values = values[~np.isnan(values)]
+    if values.size == 0:
+        return None
+    return [values.min().item(), values.max().item()]
+
+
+def _append_rows(path, meta, catalog):
+    """
+    Sort events by time and write them at the end of the store, in new
+    blocks.
+    """
+    if "event_name" in catalog:
+        times = event_times(catalog["event_name"])
+    else:
+        times = np.full(len(catalog), "NaT", dtype="datetime64[s]")
+    order = np.argsort(times, kind="stable")
+    catalog, times = catalog.iloc[order], times[order]
+    magnitude = moment_magnitude(catalog)
+    depth = catalog["depth"].to_numpy(dtype="float64")
+    for name, dtype in meta["columns"].items():
+        fname = _column_path(path, name)
+        values = times if name == "time" else catalog[name].to_numpy()
+        with open(fname, "ab") as column:
+            # Drop what an interrupted update left after the stored rows
+            column.truncate(meta["rows"] * np.dtype(dtype).itemsize)
+            np.ascontiguousarray(values).astype(dtype).tofile(column)
+    for start in range(0, len(catalog), meta["block_size"]):
+        rows = slice(start, start + meta["block_size"])
+        meta["blocks"].append(
+            dict(
+                start=meta["rows"] + start,
+                stop=meta["rows"] + min(rows.stop, len(catalog)),
+                time=_range(times[rows]),
+                depth=_range(depth[rows]),
+                magnitude=_range(magnitude[rows]),
+            )
+        )
+    meta["rows"] += len(catalog)
+    _write_meta(path, meta)
+
+
+def write_store(catalog, path, block_size=BLOCK_SIZE):
+    """
+    Convert a catalog to a columnar store, replacing any previous one.
+
+    Parameters
+    ----------
+    catalog : pandas.DataFrame
+        Catalog from :func:`catalog.load_catalog`.
+    path : str
+        The store directory.
+    block_size : int
+        Number of events per block of statistics.
+    """
+    os.makedirs(path, exist_ok=True)
+    for entry in os.listdir(path):
+        os.remove(os.path.join(path, entry))
+    names = [name for name in COLUMNS if name in catalog] + ["time"]
+    meta = dict(
+        block_size=block_size,
+        rows=0,
+        columns={name: DTYPES[name] for name in names},
+        blocks=[],
+    )
+    _append_rows(path, meta, catalog)
+
+
+def _read_rows(path, meta, runs, columns):
+    """
+    Read the rows of runs of blocks from the column files.
+    """
+    arrays = {}
+    for name in columns:
+        dtype = np.dtype(meta["columns"][name])
+        with open(_column_path(path, name), "rb") as column:
+            arrays[name] = np.concatenate(
+                [np.empty(0, dtype=dtype)]
+                + [
+                    np.fromfile(
+                        column,
+                        dtype=dtype,
+                        count=stop - start,
+                        offset=start * dtype.itemsize - column.tell(),
+                    )
+                    for start, stop in runs
+                ]
+            )
+    if "event_name" in arrays:
+        arrays["event_name"] = arrays["event_name"].astype(str)
+    return pd.DataFrame(arrays)
+
+
+def _overlaps(stats, low, high):
+    """
+    Check if a block with ``[min, max]`` statistics may have values in a
+    range. Blocks without statistics only match when there is no range.
+    """
+    if low is None and high is None:
+        return True
+    if stats is None:
+        return False
+    return (low is None or stats[1] >= low) and (high is None or stats[0] <= high)
+
+
+def _bounds(limits):
+    """
+    Split a ``(low, high)`` tuple (or None) into its bounds.
+    """
+    return (None, None) if limits is None else tuple(limits)
+
+
+def _seconds(time):
+    """
+    Convert a time to integer seconds, or None.
+    """
+    if time is None:
+        return None
+    return int(np.datetime64(time, "s").astype("int64"))
+
+
+def read_store(path, start=None, end=None, depth=None, magnitude=None):
+    """
+    Read the events of a store in time and depth ranges, above a magnitude.
+
+    Only the blocks whose statistics overlap all the ranges are read.
+
+    Parameters
+    ----------
+    path : str
+        The store directory.
+    start, end : str or numpy.datetime64 or None
+        Keep the events from ``start`` (inclusive) to ``end`` (exclusive),
+        e.g. ``"2010-01"``. Open if None.
+    depth : tuple or None
+        ``(low, high)`` depth range in km, inclusive. Either bound can be
+        None.
+    magnitude : tuple or None
+        ``(low, high)`` moment magnitude range, inclusive. Either bound can be
+        None.
+
+    Returns
+    -------
+    catalog : pandas.DataFrame
+        The events in time order, with the same columns as
+        :func:`catalog.load_catalog`.
+    """
+    meta = _read_meta(path)
+    start, end = _seconds(start), _seconds(end)
+    # Times are stored to the second, so the exclusive end is one second less
+    end = None if end is None else end - 1
+    depth, magnitude = _bounds(depth), _bounds(magnitude)
+    runs = []
+    for block in meta["blocks"]:
+        if not (
+            _overlaps(block["time"], start, end)
+            and _overlaps(block["depth"], *depth)
+            and _overlaps(block["magnitude"], *magnitude)
+        ):
+            continue
+        if runs and runs[-1][1] == block["start"]:
+            runs[-1][1] = block["stop"]
+        else:
+            runs.append([block["start"], block["stop"]])
+    catalog = _read_rows(path, meta, runs, list(meta["columns"]))
+    times = catalog.pop("time").to_numpy().astype("datetime64[s]")
+    keep = np.ones(len(catalog), dtype=bool)
+    if start is not None:
+        keep &= times >= np.datetime64(start, "s")
+    if end is not None:
+        keep &= times <= np.datetime64(end, "s")
+    for values, (low, high) in [
+        (catalog["depth"].to_numpy(), depth),
+        (moment_magnitude(catalog), magnitude),
+    ]:
+        if low is not None:
+            keep &= values >= low
+        if high is not None:
+            keep &= values <= high
+    return catalog[keep].reset_index(drop=True)
+
+
+def append_events(catalog, path):
+    """
+    Add events to a store without rewriting it.
+
+    Events whose name is already in the store are skipped. The new events
+    are sorted by time and written at the end of the store, together with
+    the events of the last block if it was not full.
+
+    Parameters
+    ----------
+    catalog : pandas.DataFrame
+        The new events, e.g. from :func:`catalog.load_catalog`.
+    path : str
+        The store directory.
+
+    Returns
+    -------
+    added : int
+        Number of events added.
+    """
+    meta = _read_meta(path)
+    if "event_name" in meta["columns"]:
+        stored = _read_rows(path, meta, [[0, meta["rows"]]], ["event_name"])
+        catalog = catalog[~catalog["event_name"].isin(stored["event_name"])]
+    if catalog.empty:
+        return 0
+    added = len(catalog)
+    last = meta["blocks"][-1] if meta["blocks"] else None
+    if last and last["stop"] - last["start"] < meta["block_size"]:
+        names = [name for name in meta["columns"] if name != "time"]
+        tail = _read_rows(path, meta, [[last["start"], last["stop"]]], names)
+        catalog = pd.concat([tail, catalog[names]], ignore_index=True)
+        meta["rows"] = last["start"]
+        meta["blocks"].pop()
+    _append_rows(path, meta, catalog)
+    return added
+
+
+def cached_catalog(data, path, start=None, end=None, depth=None, magnitude=None):
+    """
+    Read events from the store of a catalog, converting the catalog first if
+    there is no store yet.
+
+    Parameters
+    ----------
+    data : str
+        The text catalog, see :func:`catalog.load_catalog`.
+    path : str
+        The store directory.
+    start, end, depth, magnitude
+        See :func:`read_store`.
+
+    Returns
+    -------
+    catalog : pandas.DataFrame
+    """
+    if not os.path.exists(os.path.join(path, "meta.json")):
+        write_store(load_catalog(data), path)
+    return read_store(path, start=start, end=end, depth=depth, magnitude=magnitude)
+
+
+def main():
+    """
+    Convert a catalog to a store or append events to a store.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("command", choices=["convert", "append"])
+    parser.add_argument("catalog", help="text catalog in the GMT meca format")
+    parser.add_argument("store", help="the store directory")
+    parser.add_argument(
+        "--block-size", type=int, default=BLOCK_SIZE, help="events per block"
+    )
+    args = parser.parse_args()
+    catalog = load_catalog(args.catalog)
+    if args.command == "convert":
+        write_store(catalog, args.store, block_size=args.block_size)
+        print(f"Wrote {len(catalog)} events to {args.store}")
+    else:
+        added = append_events(catalog, args.store)
+        print(f"Added {added} of {len(catalog)} events to {args.store}")
+
+
+if __name__ == "__main__":
+    main()
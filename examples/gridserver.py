@@ -0,0 +1,252 @@
+"""
+Serve the base grids of the tiled pipelines from shared memory.
+
+Run in many worker processes, the pipelines cut ``@earth_relief``,
+``@earth_mask`` and the bands of ``@earth_day`` and ``@earth_night`` in every
+process. A :class:`GridServer` loads each of them once into a ``.npy`` file in
+``/dev/shm`` (RAM shared by all processes, or the temporary directory where
+there is none). Processes attach to the files as read-only memory maps and
+get zero-copy :class:`xarray.DataArray` views, so the base grids take the
+same memory for any number of workers. The subsets cut from the views are
+handed to GMT through virtual files like any other DataArray.
+
+Grids are served to the process that created the server and to the workers
+forked from it. Other processes call :func:`register` with the ``specs`` of
+the server. :func:`cut` reads from the served grids and falls back to
+:func:`cache.cached_grdcut` for the others.
+"""
+import collections
+import contextlib
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import xarray as xr
+
+from cache import cached_grdcut, cut_path
+from resolution import parse_region
+
+# Rows copied at a time from the cached cut into shared memory
+BLOCK_ROWS = 1024
+
+# A served grid: the .npy file and what is needed to rebuild the DataArray
+GridSpec = collections.namedtuple(
+    "GridSpec", ["path", "dims", "coords", "registration", "gtype"]
+)
+
+# Grids served to this process (and to the workers forked from it), by name
+_SERVED = {}
+# Memory maps of the served grids opened by this process, by path
+_ATTACHED = {}
+
+
+def _shared_dir():
+    """
+    Return the directory of memory backed files, or the temporary directory.
+    """
+    return "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+
+class GridServer:
+    """
+    Load grids once into shared memory for all processes.
+
+    Use it as a context manager. The files are removed when it exits.
+
+    Examples
+    --------
+    >>> with GridServer() as server:  # doctest: +SKIP
+    ...     server.serve("@earth_relief_05m", region="d")
+    ...     relief = cut("@earth_relief_05m", region=[0, 30, 0, 30])
+    ...
+    """
+
+    def __init__(self):
+        self.specs = {}
+        self.directory = tempfile.mkdtemp(prefix="agu2021-grids-", dir=_shared_dir())
+
+    def serve(self, grid, region="d"):
+        """
+        Load a region of a grid into shared memory.
+
+        The region goes through :func:`cache.cut_path`, so it is read from the
+        local cache when it was cut before.
+
+        Parameters
+        ----------
+        grid : str
+            A remote dataset (e.g. ``"@earth_day_05m+b0"``) or a grid file.
+        region : str or list
+            The region to serve. Cut it with the halo of the tiles, or serve a
+            region spanning 360 degrees of longitude to wrap the halos around.
+
+        Returns
+        -------
+        spec : GridSpec
+        """
+        path = os.path.join(self.directory, f"{len(self.specs)}.npy")
+        with xr.open_dataarray(cut_path(grid, region=region)) as source:
+            values = np.lib.format.open_memmap(
+                path, mode="w+", dtype=source.dtype, shape=source.shape
+            )
+            for start in range(0, source.shape[0], BLOCK_ROWS):
+                rows = slice(start, start + BLOCK_ROWS)
+                values[rows] = source[rows].to_numpy()
+            values.flush()
+            del values
+            spec = GridSpec(
+                path=path,
+                dims=source.dims,
+                coords={dim: source[dim].to_numpy() for dim in source.dims},
+                registration=source.gmt.registration,
+                gtype=source.gmt.gtype,
+            )
+        self.specs[grid] = spec
+        _SERVED[grid] = spec
+        return spec
+
+    def close(self):
+        """
+        Stop serving the grids and remove their files.
+        """
+        for grid, spec in self.specs.items():
+            _SERVED.pop(grid, None)
+            _ATTACHED.pop(spec.path, None)
+        self.specs.clear()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+@contextlib.contextmanager
+def serve(grids, region="d"):
+    """
+    Serve grids from shared memory for the duration of the context.
+
+    Parameters
+    ----------
+    grids : list of str
+        The grids to serve. Nothing is served if empty.
+    region : str or list
+        The region to serve, see :meth:`GridServer.serve`.
+    """
+    if not grids:
+        yield None
+        return
+    with GridServer() as server:
+        for grid in grids:
+            server.serve(grid, region=region)
+        yield server
+
+
+def register(specs):
+    """
+    Serve the grids of a server in another process, e.g. in the initializer
+    of a spawned process pool.
+
+    Parameters
+    ----------
+    specs : dict
+        The ``specs`` of a :class:`GridServer`.
+    """
+    _SERVED.update(specs)
+
+
+def attach(spec):
+    """
+    Return a read-only, zero-copy view of a served grid.
+
+    Returns
+    -------
+    grid : xarray.DataArray
+    """
+    values = _ATTACHED.get(spec.path)
+    if values is None:
+        values = _ATTACHED[spec.path] = np.load(spec.path, mmap_mode="r")
+    grid = xr.DataArray(values, coords=spec.coords, dims=spec.dims)
+    grid.gmt.registration = spec.registration
+    grid.gmt.gtype = spec.gtype
+    return grid
+
+
+def _subset(grid, spec, region):
+    """
+    Select the nodes or pixels of a grid in a region, like ``grdcut``.
+
+    Longitudes are wrapped around grids spanning 360 degrees when the region
+    extends past them. The result is a view unless it had to be wrapped.
+    """
+    west, east, south, north = parse_region(region)
+    lon, lat = spec.coords["lon"], spec.coords["lat"]
+    tolerance = 1e-6 * abs(lon[1] - lon[0])
+    rows = np.flatnonzero((lat >= south - tolerance) & (lat <= north + tolerance))
+    rows = slice(rows[0], rows[-1] + 1)
+    # Gridline registered global grids repeat the first column at the end
+    unique = lon if spec.registration == 1 else lon[:-1]
+    wraps = abs(unique.size * abs(lon[1] - lon[0]) - 360) < tolerance
+    if not wraps or (west >= lon[0] - tolerance and east <= lon[-1] + tolerance):
+        cols = np.flatnonzero((lon >= west - tolerance) & (lon <= east + tolerance))
+        subset = grid.isel(lat=rows, lon=slice(cols[0], cols[-1] + 1))
+    else:
+        shifted = np.concatenate([unique - 360, unique, unique + 360])
+        index = np.tile(np.arange(unique.size), 3)
+        keep = (shifted >= west - tolerance) & (shifted <= east + tolerance)
+        subset = grid.isel(lat=rows, lon=index[keep]).assign_coords(lon=shifted[keep])
+    subset.gmt.registration = spec.registration
+    subset.gmt.gtype = spec.gtype
+    return subset
+
+
+def _cut_wrapped(grid, region):
+    """
+    Cut a region spanning more than 360 degrees of longitude from a global
+    grid, which ``grdcut`` cannot do, by wrapping a 360 degree cut around.
+    """
+    west, east, south, north = parse_region(region)
+    center = (west + east) / 2
+    full = cached_grdcut(grid=grid, region=[center - 180, center + 180, south, north])
+    spec = GridSpec(
+        path=None,
+        dims=full.dims,
+        coords={dim: full[dim].to_numpy() for dim in full.dims},
+        registration=full.gmt.registration,
+        gtype=full.gmt.gtype,
+    )
+    return _subset(full, spec, region)
+
+
+def cut(grid, region=None):
+    """
+    Cut a grid from shared memory if it is served, or with
+    :func:`cache.cached_grdcut` otherwise.
+
+    Regions spanning more than 360 degrees of longitude (e.g. a global region
+    with a halo) wrap around global grids.
+
+    Parameters
+    ----------
+    grid : str
+        A remote dataset or a grid file.
+    region : str or list or None
+        The region to cut. Keeps the whole grid if None.
+
+    Returns
+    -------
+    subset : xarray.DataArray
+        Read-only if served.
+    """
+    spec = _SERVED.get(grid)
+    if spec is None:
+        west, east = parse_region(region)[:2] if region is not None else (0, 0)
+        if east - west > 360:
+            return _cut_wrapped(grid, region)
+        return cached_grdcut(grid=grid, region=region)
+    view = attach(spec)
+    if region is None:
+        return view
+    return _subset(view, spec, region)
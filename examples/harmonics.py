@@ -0,0 +1,346 @@
+"""
+Evaluate spherical harmonic models for several truncations in one pass.
+
+``pygmt.sph2grd`` reads the coefficients and evaluates every associated
+Legendre function again for each filter. Here the coefficients are read once
+and the Legendre functions are computed once per latitude, while the
+filtered partial sums of all requested truncations are accumulated side by
+side.
+
+The synthesis works on blocks of latitudes so that memory does not grow with
+the number of rows. Within a block, the Legendre recurrence runs over degree
+for all orders and latitudes at once, and each latitude ring is summed over
+order with an inverse real FFT. This costs about ``O(L**2 * nlat + nlat * nlon
+* log(nlon))`` instead of ``O(L**2 * nlat * nlon)``.
+
+Run ``python harmonics.py`` to compare the grids with those of ``sph2grd``
+for the filters of ``venus_harmonics.py`` (values, coordinates, registration
+and grid type). The exit status is 1 if any of them differs.
+"""
+import argparse
+import math
+import sys
+
+import numpy as np
+import pygmt
+import xarray as xr
+
+from cache import cached_which
+
+
+def read_coefficients(data):
+    """
+    Read spherical harmonic coefficients in the ``sph2grd`` input format.
+
+    Parameters
+    ----------
+    data : str
+        File with columns degree, order, cosine and sine coefficient. Remote
+        files (e.g. ``"@VenusTopo180.txt"``) are downloaded first (see
+        :func:`cache.cached_which`).
+
+    Returns
+    -------
+    cos, sin : numpy.ndarray
+        Arrays of shape ``(lmax + 1, lmax + 1)`` indexed by ``[degree,
+        order]``.
+    """
+    table = np.loadtxt(cached_which(data), comments=("#", ">"), ndmin=2)
+    degree = table[:, 0].astype(int)
+    order = table[:, 1].astype(int)
+    lmax = degree.max()
+    cos = np.zeros((lmax + 1, lmax + 1))
+    sin = np.zeros((lmax + 1, lmax + 1))
+    cos[degree, order] = table[:, 2]
+    sin[degree, order] = table[:, 3]
+    return cos, sin
+
+
+def cosine_filter(spec, lmax):
+    """
+    Compute the degree weights of a ``sph2grd`` band-pass filter.
+
+    Parameters
+    ----------
+    spec : str
+        The ``lc/lp/hp/hc`` argument of the ``F`` option of ``sph2grd``.
+        Degrees below ``lc`` and above ``hc`` are removed and a cosine taper
+        is applied between ``lc`` and ``lp`` and between ``hp`` and ``hc``.
+    lmax : int
+        Maximum degree of the model.
+
+    Returns
+    -------
+    weights : numpy.ndarray
+        Weight of each degree from 0 to ``lmax``.
+    """
+    lc, lp, hp, hc = (float(value) for value in spec.split("/"))
+    degree = np.arange(lmax + 1, dtype="float64")
+    weights = np.ones_like(degree)
+    weights[(degree < lc) | (degree > hc)] = 0
+    low = (degree >= lc) & (degree < lp)
+    weights[low] = 0.5 * (1 - np.cos(np.pi * (degree[low] - lc) / (lp - lc)))
+    high = (degree > hp) & (degree <= hc)
+    weights[high] = 0.5 * (1 + np.cos(np.pi * (degree[high] - hp) / (hc - hp)))
+    return weights
+
+
+def _recurrence_coefficients(lmax):
+    """
+    Return the coefficients of the fully normalized Legendre recurrence.
+
+    For order m < n, ``P[n, m] = a[n, m] * t * P[n - 1, m] - b[n, m] * P[n -
+    2, m]`` with t the sine of the latitude.
+    """
+    n = np.arange(lmax + 1, dtype="float64")[:, np.newaxis]
+    m = np.arange(lmax + 1, dtype="float64")[np.newaxis, :]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        a = np.sqrt((2 * n - 1) * (2 * n + 1) / ((n - m) * (n + m)))
+        b = np.sqrt(
+            (2 * n + 1) * (n + m - 1) * (n - m - 1) / ((n - m) * (n + m) * (2 * n - 3))
+        )
+    valid = m < n
+    return np.where(valid, a, 0), np.where(valid & (m < n - 1), b, 0)
+
+
+# The Legendre recurrence is run on values multiplied by this factor so that
+# the sectoral terms (which shrink like cos(lat)**m) do not underflow before
+# the higher degrees grow back to significant values (Holmes and
+# Featherstone, 2002). This keeps the recurrence stable to degree ~2700.
+SCALE = 1e280
+
+
+def legendre_sums(cos, sin, weights, lat):
+    """
+    Accumulate the filtered Legendre sums of each order for every latitude.
+
+    The fully normalized (geodesy convention, no Condon-Shortley phase)
+    associated Legendre functions are computed with the standard three-term
+    recurrence over degree, for all orders and latitudes at once, on values
+    scaled by ``SCALE``. Each degree is visited once and added to the sums of
+    every filter.
+
+    Parameters
+    ----------
+    cos, sin : numpy.ndarray
+        Coefficients from :func:`read_coefficients`.
+    weights : numpy.ndarray
+        Degree weights of shape ``(nfilters, lmax + 1)``.
+    lat : numpy.ndarray
+        Latitudes in degrees.
+
+    Returns
+    -------
+    sum_cos, sum_sin : numpy.ndarray
+        Arrays of shape ``(nfilters, lmax + 1, nlat)`` with the sums over
+        degree of the weighted cosine and sine coefficients times the
+        Legendre functions, for each order.
+    """
+    lmax = cos.shape[0] - 1
+    t = np.sin(np.deg2rad(lat))
+    u = np.cos(np.deg2rad(lat))
+    a, b = _recurrence_coefficients(lmax)
+    sum_cos = np.zeros((len(weights), lmax + 1, t.size))
+    sum_sin = np.zeros_like(sum_cos)
+    previous = np.zeros((lmax + 1, t.size))
+    current = np.zeros_like(previous)
+    sectoral = np.full_like(t, SCALE)
+    for n in range(lmax + 1):
+        if n >= 1:
+            sectoral = sectoral * u * np.sqrt((2 * n + 1) / (2 * n if n > 1 else 1))
+        # Orders below n from the two previous degrees, order n from the
+        # sectoral recurrence. Orders above n are zero and skipped.
+        following = np.zeros_like(current)
+        following[:n] = (
+            a[n, :n, np.newaxis] * t * current[:n] - b[n, :n, np.newaxis] * previous[:n]
+        )
+        following[n] = sectoral
+        previous, current = current, following
+        if not weights[:, n].any():
+            continue
+        legendre = current[: n + 1] / SCALE
+        degree_weights = weights[:, n, np.newaxis, np.newaxis]
+        sum_cos[:, : n + 1] += degree_weights * (cos[n, : n + 1, np.newaxis] * legendre)
+        sum_sin[:, : n + 1] += degree_weights * (sin[n, : n + 1, np.newaxis] * legendre)
+    return sum_cos, sum_sin
+
+
+def synthesize(cos, sin, weights, lat, nlon, block=128):
+    """
+    Evaluate filtered spherical harmonic models on full latitude rings.
+
+    Parameters
+    ----------
+    cos, sin : numpy.ndarray
+        Coefficients from :func:`read_coefficients`.
+    weights : numpy.ndarray
+        Degree weights of shape ``(nfilters, lmax + 1)``.
+    lat : numpy.ndarray
+        Latitudes in degrees.
+    nlon : int
+        Number of equally spaced longitudes from 0 to 360 (excluded).
+    block : int
+        Number of latitudes processed at a time. Apart from the output,
+        memory use grows with ``block * nfilters * max(lmax, nlon)`` and not
+        with the number of latitudes.
+
+    Returns
+    -------
+    grids : numpy.ndarray
+        Array of shape ``(nfilters, nlat, nlon)``.
+    """
+    lmax = cos.shape[0] - 1
+    # Oversample the FFT if the model has orders above the Nyquist order of
+    # the output and keep every factor-th longitude
+    factor = max(1, math.ceil(2 * lmax / nlon))
+    nfft = nlon * factor
+    grids = np.empty((len(weights), len(lat), nlon))
+    for start in range(0, len(lat), block):
+        rows = slice(start, start + block)
+        sum_cos, sum_sin = legendre_sums(cos, sin, weights, lat[rows])
+        # x[k] = sum_m A_m cos(2 pi m k / N) + B_m sin(2 pi m k / N) is the
+        # inverse real FFT of N/2 (A_m - i B_m), with N A_0 for m = 0
+        spectrum = np.zeros((len(weights), nfft // 2 + 1, sum_cos.shape[2]), complex)
+        spectrum[:, : lmax + 1] = (sum_cos - 1j * sum_sin) * (nfft / 2)
+        spectrum[:, 0] *= 2
+        if nfft % 2 == 0 and lmax >= nfft // 2:
+            # The Nyquist term is real and only its cosine part survives
+            spectrum[:, nfft // 2] = spectrum[:, nfft // 2].real * 2
+        rings = np.fft.irfft(spectrum, n=nfft, axis=1)
+        grids[:, rows] = rings[:, ::factor].transpose(0, 2, 1)
+    return grids
+
+
+def sph2grd_multi(data, filters, spacing=1):
+    """
+    Evaluate a spherical harmonic model on a global grid for several filters.
+
+    Equivalent to calling ``pygmt.sph2grd(data=data, spacing=spacing,
+    region="g", N="g", F=spec)`` for every filter, but the coefficients are
+    read once and the Legendre functions evaluated once for all filters.
+
+    Parameters
+    ----------
+    data : str
+        File with the coefficients (see :func:`read_coefficients`).
+    filters : list of str
+        ``lc/lp/hp/hc`` band-pass filters (see :func:`cosine_filter`).
+    spacing : float
+        Grid spacing in degrees.
+
+    Returns
+    -------
+    grids : list of xarray.DataArray
+        One gridline-registered global grid for each filter, marked as
+        geographic for GMT.
+    """
+    cos, sin = read_coefficients(data)
+    lmax = cos.shape[0] - 1
+    weights = np.array([cosine_filter(spec, lmax) for spec in filters])
+    lat = np.linspace(-90, 90, round(180 / spacing) + 1)
+    lon = np.linspace(0, 360, round(360 / spacing) + 1)
+    nlon = round(360 / spacing)
+    if not math.isclose(nlon * spacing, 360):
+        raise ValueError(f"Spacing {spacing} does not divide 360 degrees.")
+    grids = synthesize(cos, sin, weights, lat, nlon)
+    # Repeat the first column at 360 degrees for a gridline-registered grid
+    grids = np.concatenate([grids, grids[:, :, :1]], axis=2)
+    results = []
+    for values in grids:
+        grid = xr.DataArray(
+            values, coords={"lat": lat, "lon": lon}, dims=("lat", "lon")
+        )
+        # Like the grids read back from sph2grd: geographic and gridline registered
+        grid.gmt.gtype = 1
+        grid.gmt.registration = 0
+        results.append(grid)
+    return results
+
+
+def compare_sph2grd(data, filters, spacing=1, tolerance=1e-5):
+    """
+    Compare :func:`sph2grd_multi` with ``sph2grd -Rg -Ng -F<filter>``.
+
+    Parameters
+    ----------
+    data : str
+        File with the coefficients (see :func:`read_coefficients`).
+    filters : list of str
+        ``lc/lp/hp/hc`` band-pass filters.
+    spacing : float
+        Grid spacing in degrees.
+    tolerance : float
+        Largest difference allowed, as a fraction of the range of the
+        ``sph2grd`` grid.
+
+    Returns
+    -------
+    comparisons : list of dict
+        For each filter, the largest and RMS differences, the range of the
+        ``sph2grd`` grid, and whether the coordinates, the registration and
+        grid type, and the values (within the tolerance) match.
+    """
+    grids = sph2grd_multi(data, filters, spacing=spacing)
+    comparisons = []
+    for spec, grid in zip(filters, grids):
+        reference = pygmt.sph2grd(
+            data=cached_which(data), spacing=spacing, region="g", N="g", F=spec
+        )
+        same_coords = reference.shape == grid.shape and all(
+            np.allclose(reference[dim], grid[dim]) for dim in ("lat", "lon")
+        )
+        same_type = (reference.gmt.registration, reference.gmt.gtype) == (
+            grid.gmt.registration,
+            grid.gmt.gtype,
+        )
+        spread = float(reference.max() - reference.min())
+        if same_coords:
+            difference = np.abs(grid.values - reference.values)
+            max_diff = float(difference.max())
+            rms_diff = float(np.sqrt(np.mean(difference**2)))
+        else:
+            max_diff = rms_diff = math.inf
+        comparisons.append(
+            dict(
+                filter=spec,
+                max_diff=max_diff,
+                rms_diff=rms_diff,
+                range=spread,
+                same_coords=same_coords,
+                same_type=same_type,
+                same_values=max_diff <= tolerance * spread,
+            )
+        )
+    return comparisons
+
+
+def main():
+    """
+    Compare :func:`sph2grd_multi` with ``sph2grd`` and print the differences.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("data", nargs="?", default="@VenusTopo180.txt")
+    parser.add_argument(
+        "--filters", nargs="+", default=["1/1/25/30", "1/1/25/90", "1/1/25/180"]
+    )
+    parser.add_argument("--spacing", type=float, default=1)
+    parser.add_argument("--tolerance", type=float, default=1e-5)
+    args = parser.parse_args()
+    comparisons = compare_sph2grd(
+        args.data, args.filters, spacing=args.spacing, tolerance=args.tolerance
+    )
+    checks = dict(same_coords="coordinates", same_type="type", same_values="values")
+    print(f"{'filter':<12}{'max diff':>12}{'rms diff':>12}{'range':>12}  result")
+    failed = False
+    for item in comparisons:
+        problems = [name for key, name in checks.items() if not item[key]]
+        failed = failed or bool(problems)
+        print(
+            f"{item['filter']:<12}{item['max_diff']:>12.4g}{item['rms_diff']:>12.4g}"
+            f"{item['range']:>12.4g}  {' '.join(problems) or 'ok'}"
+        )
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""
+Thin out dense symbol layers to what the output resolution can show.
+
+``fig.plot`` and ``fig.meca`` draw every row they are given, even where
+hundreds of symbols land on the same pixels of the saved figure. Each symbol
+still adds to the size of the PostScript and to the time it takes to
+rasterize it. Here the points are projected to plot coordinates with GMT's
+``mapproject`` (using the region and projection of the map, which includes
+its width), binned into square cells of a few pixels at the DPI of the
+output, and only the most important point of every cell is kept, e.g. the
+largest earthquake or the fastest station.
+
+The number of symbols is bounded by the number of cells of the map. A
+``max_symbols`` limit can be set on top: the cells are made coarser until the
+selection fits, so the kept points stay spread over the map.
+"""
+import numpy as np
+import pygmt
+from pygmt.helpers import GMTTempFile
+
+
+def _region_arg(region):
+    """
+    Format a region as the argument of ``-R``.
+    """
+    if isinstance(region, str):
+        return region
+    return "/".join(str(value) for value in region)
+
+
+def screen_coordinates(x, y, region, projection):
+    """
+    Project points to plot coordinates with ``mapproject``.
+
+    Points outside of the region are dropped.
+
+    Parameters
+    ----------
+    x, y : array-like
+        Longitudes and latitudes (or Cartesian coordinates).
+    region : str or list
+        The region of the map.
+    projection : str
+        The projection of the map, with its width (e.g. ``"M22.73i"``).
+
+    Returns
+    -------
+    index : numpy.ndarray
+        Positions of the points inside the map in the input arrays.
+    px, py : numpy.ndarray
+        Their plot coordinates in inches.
+    """
+    x = np.ascontiguousarray(x, dtype="float64")
+    y = np.ascontiguousarray(y, dtype="float64")
+    index = np.arange(x.size, dtype="float64")
+    with pygmt.clib.Session() as lib, GMTTempFile(suffix=".bin") as tmpfile:
+        with lib.virtualfile_from_vectors(x, y, index) as vfile:
+            lib.call_module(
+                "mapproject",
+                f"{vfile} -R{_region_arg(region)} -J{projection} -Di -S -bo3d "
+                f"->{tmpfile.name}",
+            )
+        projected = np.fromfile(tmpfile.name, dtype="float64").reshape(-1, 3)
+    return projected[:, 2].astype("int64"), projected[:, 0], projected[:, 1]
+
+
+def select_cells(px, py, priority, cell, max_symbols=None):
+    """
+    Keep the point with the highest priority in each cell of a square grid.
+
+    Parameters
+    ----------
+    px, py : numpy.ndarray
+        Plot coordinates of the points.
+    priority : numpy.ndarray
+        Importance of the points. Ties are broken by the input order.
+    cell : float
+        Size of the cells, in the units of the coordinates.
+    max_symbols : int or None
+        If the selection has more points, the cell size is doubled until it
+        fits.
+
+    Returns
+    -------
+    keep : numpy.ndarray
+        Sorted positions of the selected points.
+    """
+    priority = np.asarray(priority, dtype="float64")
+    if px.size == 0:
+        return np.arange(0)
+    while True:
+        col = np.floor((px - px.min()) / cell).astype("int64")
+        row = np.floor((py - py.min()) / cell).astype("int64")
+        key = row * (col.max() + 1) + col
+        # Sort by cell, then by decreasing priority: the first of every cell
+        # is its representative
+        order = np.lexsort((-priority, key))
+        first = np.ones(order.size, dtype=bool)
+        first[1:] = key[order[1:]] != key[order[:-1]]
+        keep = np.sort(order[first])
+        if max_symbols is None or keep.size <= max_symbols or keep.size == 1:
+            return keep
+        cell *= 2
+
+
+def decimate(
+    data, x, y, priority, region, projection, dpi=300, cell=4, max_symbols=None
+):
+    """
+    Select the rows of a table that are worth plotting on a map.
+
+    Parameters
+    ----------
+    data : pandas.DataFrame
+        The table to plot.
+    x, y : str
+        Names of the columns with the coordinates of the symbols.
+    priority : str or array-like
+        Column name or values ranking the rows (e.g. the magnitude). The
+        highest of every cell is kept.
+    region, projection : str or list
+        The region and projection (with the width) of the map.
+    dpi : int
+        Resolution of the output figure.
+    cell : float
+        Size of the cells in pixels at ``dpi``.
+    max_symbols : int or None
+        Upper limit of the number of rows returned.
+
+    Returns
+    -------
+    selection : pandas.DataFrame
+        The kept rows, in their original order.
+    """
+    if isinstance(priority, str):
+        priority = data[priority]
+    index, px, py = screen_coordinates(data[x], data[y], region, projection)
+    keep = select_cells(
+        px,
+        py,
+        np.asarray(priority, dtype="float64")[index],
+        cell=cell / dpi,
+        max_symbols=max_symbols,
+    )
+    return data.iloc[index[keep]]
@@ -0,0 +1,475 @@
+"""
+Sample and stack cross-profiles of a grid in memory.
+
+``pygmt.grdtrack(crossprofile=..., stack=...)`` writes the profiles and the
+stack to text files that have to be parsed again before plotting. Here the
+cross-profiles are laid out with great-circle geometry, all samples are taken
+at once by bilinear interpolation on the xarray grid, and the stack and its
+envelope are computed from the resulting ``(profiles, samples)`` matrix.
+
+For long lines such as whole ridge systems, :func:`stack_cross_profiles`
+samples the profiles in blocks and accumulates them in a
+:class:`StreamingStack`, so that memory does not grow with the number of
+profiles.
+"""
+import numpy as np
+import pandas as pd
+
+from catalog import EARTH_RADIUS, unit_vectors
+
+# Scale that turns the median absolute deviation into a standard deviation
+# for normally distributed data (GMT's "L1 scale")
+MAD_SCALE = 1.4826
+
+
+def _to_lonlat(vectors):
+    """
+    Convert unit vectors of shape ``(..., 3)`` to longitudes and latitudes.
+    """
+    lon = np.rad2deg(np.arctan2(vectors[..., 1], vectors[..., 0]))
+    lat = np.rad2deg(np.arcsin(np.clip(vectors[..., 2], -1, 1)))
+    return lon, lat
+
+
+def _polyline_centers(points, spacing):
+    """
+    Place points every ``spacing`` km along a polyline given as unit vectors.
+
+    Returns the points and the unit normal of the segment each one is on.
+    """
+    # Consecutive duplicate vertices would make zero-length segments
+    keep = np.append(True, np.any(points[1:] != points[:-1], axis=1))
+    points = points[keep]
+    if len(points) < 2:
+        raise ValueError("A line needs at least two distinct points.")
+    starts, ends = points[:-1], points[1:]
+    normals = np.cross(starts, ends)
+    sines = np.linalg.norm(normals, axis=1)
+    normals /= sines[:, None]
+    lengths = np.arctan2(sines, np.einsum("ij,ij->i", starts, ends)) * EARTH_RADIUS
+    offsets = np.append(0, np.cumsum(lengths))
+    along = np.arange(0, offsets[-1] + 1e-6, spacing)
+    segment = np.clip(np.searchsorted(offsets, along, side="right") - 1, 0, None)
+    segment = np.minimum(segment, len(starts) - 1)
+    angle = ((along - offsets[segment]) / EARTH_RADIUS)[:, None]
+    forward = np.cross(normals[segment], starts[segment])
+    centers = np.cos(angle) * starts[segment] + np.sin(angle) * forward
+    return centers, normals[segment]
+
+
+def profile_centers(points, spacing, orient=True):
+    """
+    Compute the centers and directions of cross-profiles along lines.
+
+    Profiles are placed every ``spacing`` km along each line, starting at
+    its first point and measured along the great-circle segments between
+    the vertices. Each profile crosses its segment at a right angle.
+
+    Parameters
+    ----------
+    points : array-like or list of array-like
+        ``(npoints, 2)`` longitudes and latitudes of the vertices of a line,
+        or a list of such lines (e.g. the segments of a ridge system).
+    spacing : float
+        Distance between cross-profiles along the lines in km.
+    orient : bool
+        Orient all profiles from west to east, like the ``+v`` modifier. If
+        False, the profiles point to the left of the line.
+
+    Returns
+    -------
+    centers, directions : numpy.ndarray
+        Unit vectors of shape ``(nprofiles, 3)`` of the profile centers and
+        of the direction of the profiles at their center.
+    """
+    lines = [points] if np.ndim(points[0]) == 1 else points
+    centers, directions = zip(
+        *[
+            _polyline_centers(
+                unit_vectors(*np.asarray(line, dtype="float64").T), spacing
+            )
+            for line in lines
+        ]
+    )
+    centers = np.concatenate(centers)
+    directions = np.concatenate(directions)
+    if orient:
+        east = np.stack(
+            [-centers[:, 1], centers[:, 0], np.zeros(len(centers))], axis=-1
+        )
+        directions[np.einsum("ij,ij->i", directions, east) < 0] *= -1
+    return centers, directions
+
+
+def profile_distance(length, step):
+    """
+    Return the distances of the samples from the center of a cross-profile.
+    """
+    half = round(length / 2 / step)
+    return step * np.arange(-half, half + 1, dtype="float64")
+
+
+def profile_samples(centers, directions, distance):
+    """
+    Compute the coordinates of the samples of cross-profiles.
+
+    Parameters
+    ----------
+    centers, directions : numpy.ndarray
+        Profile centers and directions from :func:`profile_centers`.
+    distance : numpy.ndarray
+        Distances of the samples from the centers in km.
+
+    Returns
+    -------
+    lon, lat : numpy.ndarray
+        Sample coordinates of shape ``(nprofiles, nsamples)``.
+    """
+    angle = distance / EARTH_RADIUS
+    samples = (
+        np.cos(angle)[None, :, None] * centers[:, None, :]
+        + np.sin(angle)[None, :, None] * directions[:, None, :]
+    )
+    return _to_lonlat(samples)
+
+
+def cross_profiles(points, length, step, spacing, orient=True):
+    """
+    Lay out cross-profiles like ``grdtrack -C<length>/<step>/<spacing>``.
+
+    The profiles cross the line at right angles, every ``spacing`` km
+    starting at the first point, and are sampled every ``step`` km. For
+    lines with many profiles, use :func:`stack_cross_profiles` to avoid
+    holding all the samples in memory.
+
+    Parameters
+    ----------
+    points : array-like or list of array-like
+        Vertices of one or several lines (see :func:`profile_centers`).
+    length : float
+        Total length of each cross-profile in km.
+    step : float
+        Distance between samples along the cross-profiles in km.
+    spacing : float
+        Distance between cross-profiles along the lines in km.
+    orient : bool
+        Orient all profiles from west to east, like the ``+v`` modifier.
+
+    Returns
+    -------
+    lon, lat : numpy.ndarray
+        Sample coordinates of shape ``(nprofiles, nsamples)``.
+    distance : numpy.ndarray
+        Distance of the samples from the center of the profiles in km.
+    """
+    centers, directions = profile_centers(points, spacing, orient=orient)
+    distance = profile_distance(length, step)
+    lon, lat = profile_samples(centers, directions, distance)
+    return lon, lat, distance
+
+
+def sample_bilinear(grid, lon, lat):
+    """
+    Interpolate a grid at arbitrary points with bilinear interpolation.
+
+    Parameters
+    ----------
+    grid : xarray.DataArray
+        A regular grid with ``lat`` and ``lon`` dimensions, e.g. from
+        ``pygmt.grdcut``.
+    lon, lat : numpy.ndarray
+        Coordinates of the points, of any matching shape. Longitudes are
+        wrapped to the range of the grid.
+
+    Returns
+    -------
+    values : numpy.ndarray
+        Interpolated values with the shape of ``lon``. Points outside of the
+        grid are NaN.
+    """
+    grid = grid.transpose("lat", "lon")
+    if grid.lat[0] > grid.lat[-1]:
+        grid = grid.isel(lat=slice(None, None, -1))
+    x = grid.lon.to_numpy()
+    y = grid.lat.to_numpy()
+    data = grid.to_numpy()
+    lon = (np.asarray(lon) - x[0]) % 360 + x[0]
+    col = (lon - x[0]) / (x[1] - x[0])
+    row = (np.asarray(lat) - y[0]) / (y[1] - y[0])
+    outside = (col < 0) | (col > x.size - 1) | (row < 0) | (row > y.size - 1)
+    col0 = np.clip(np.floor(col).astype("int64"), 0, x.size - 2)
+    row0 = np.clip(np.floor(row).astype("int64"), 0, y.size - 2)
+    dx = col - col0
+    dy = row - row0
+    values = (
+        data[row0, col0] * (1 - dx) * (1 - dy)
+        + data[row0, col0 + 1] * dx * (1 - dy)
+        + data[row0 + 1, col0] * (1 - dx) * dy
+        + data[row0 + 1, col0 + 1] * dx * dy
+    )
+    return np.where(outside, np.nan, values)
+
+
+def stack_profiles(values, distance, method="median", factor=2):
+    """
+    Stack cross-profiles like ``grdtrack -S``.
+
+    Parameters
+    ----------
+    values : numpy.ndarray
+        Samples of shape ``(nprofiles, nsamples)``. NaNs are ignored.
+    distance : numpy.ndarray
+        Distance of each sample along the profiles.
+    method : str or float
+        ``"mean"`` (deviation is the standard deviation), ``"median"``
+        (deviation is the scaled median absolute deviation) or a percentile
+        between 0 and 100 (deviation as for the median).
+    factor : float
+        The envelope is the stacked value plus and minus ``factor`` times the
+        deviation, like the ``+c`` modifier.
+
+    Returns
+    -------
+    stack : pandas.DataFrame
+        The columns of the ``grdtrack`` stack file: ``distance``, ``value``,
+        ``deviation``, ``min``, ``max``, ``lower`` and ``upper``.
+    """
+    if method == "mean":
+        value = np.nanmean(values, axis=0)
+        deviation = np.nanstd(values, axis=0, ddof=1)
+    else:
+        q = 50 if method == "median" else float(method)
+        if not 0 <= q <= 100:
+            raise ValueError(f"Unknown stacking method '{method}'.")
+        value = np.nanpercentile(values, q, axis=0)
+        deviation = MAD_SCALE * np.nanmedian(np.abs(values - value), axis=0)
+    return pd.DataFrame(
+        {
+            "distance": distance,
+            "value": value,
+            "deviation": deviation,
+            "min": np.nanmin(values, axis=0),
+            "max": np.nanmax(values, axis=0),
+            "lower": value - factor * deviation,
+            "upper": value + factor * deviation,
+        }
+    )
+
+
+class StreamingStack:
+    """
+    Stack cross-profiles block by block in bounded memory.
+
+    Each sample position keeps a histogram of the values added so far, along
+    with running counts, sums, sums of squares, minima and maxima. The
+    median, percentiles and median absolute deviation are read from the
+    histograms, so they are exact to within about one bin width (``(vmax -
+    vmin) / bins``) and the deviation to within a few. Memory depends on the
+    number of samples per profile and bins, not on the number of profiles.
+
+    Parameters
+    ----------
+    distance : numpy.ndarray
+        Distance of each sample along the profiles.
+    vmin, vmax : float
+        Range of the histograms. Values outside of it are counted in the
+        first or last bin.
+    bins : int
+        Number of histogram bins.
+    """
+
+    def __init__(self, distance, vmin, vmax, bins=4096):
+        self.distance = np.asarray(distance, dtype="float64")
+        self.edges = np.linspace(vmin, vmax, bins + 1)
+        nsamples = self.distance.size
+        self.counts = np.zeros((nsamples, bins), dtype="int64")
+        # Sums are taken relative to the middle of the range to limit the
+        # loss of precision in the variance
+        self.shift = (vmin + vmax) / 2
+        self.total = np.zeros(nsamples)
+        self.squares = np.zeros(nsamples)
+        self.min = np.full(nsamples, np.inf)
+        self.max = np.full(nsamples, -np.inf)
+
+    def add(self, values):
+        """
+        Add a block of profiles of shape ``(nprofiles, nsamples)``.
+
+        NaNs are ignored.
+        """
+        values = np.asarray(values, dtype="float64")
+        bins = self.counts.shape[1]
+        valid = np.isfinite(values)
+        column = np.broadcast_to(np.arange(values.shape[1]), values.shape)[valid]
+        finite = values[valid]
+        index = np.clip(
+            np.searchsorted(self.edges, finite, side="right") - 1, 0, bins - 1
+        )
+        self.counts += np.bincount(
+            column * bins + index, minlength=self.counts.size
+        ).reshape(self.counts.shape)
+        shifted = np.where(valid, values - self.shift, 0)
+        self.total += shifted.sum(axis=0)
+        self.squares += np.square(shifted).sum(axis=0)
+        self.min = np.fmin(self.min, np.nanmin(values, axis=0, initial=np.inf))
+        self.max = np.fmax(self.max, np.nanmax(values, axis=0, initial=-np.inf))
+
+    @staticmethod
+    def _percentile(counts, edges, q):
+        """
+        Estimate the q-th percentile of each row of histograms.
+
+        Uses the same definition as ``numpy.percentile``, with the values of
+        a bin spread evenly across it.
+        """
+        cumulative = np.cumsum(counts, axis=1)
+        rows = np.arange(len(counts))
+        rank = q / 100 * np.maximum(cumulative[:, -1] - 1, 0)
+
+        def ranked(rank):
+            # Value of the sample with the given (integer) rank in each row
+            index = np.argmax(cumulative > rank[:, None], axis=1)
+            before = np.where(index > 0, cumulative[rows, index - 1], 0)
+            fraction = (rank - before + 0.5) / np.maximum(counts[rows, index], 1)
+            lower = edges[rows, index] if edges.ndim == 2 else edges[index]
+            upper = edges[rows, index + 1] if edges.ndim == 2 else edges[index + 1]
+            return lower + fraction * (upper - lower)
+
+        below = np.floor(rank)
+        above = np.minimum(below + 1, np.maximum(cumulative[:, -1] - 1, 0))
+        weight = rank - below
+        return (1 - weight) * ranked(below) + weight * ranked(above)
+
+    def result(self, method="median", factor=2):
+        """
+        Compute the stack of all profiles added so far.
+
+        Parameters
+        ----------
+        method, factor
+            As in :func:`stack_profiles`.
+
+        Returns
+        -------
+        stack : pandas.DataFrame
+            The same columns as :func:`stack_profiles`.
+        """
+        count = self.counts.sum(axis=1).astype("float64")
+        with np.errstate(divide="ignore", invalid="ignore"):
+            if method == "mean":
+                mean = self.total / count
+                value = mean + self.shift
+                deviation = np.sqrt(
+                    np.maximum(self.squares - count * mean**2, 0) / (count - 1)
+                )
+            else:
+                q = 50 if method == "median" else float(method)
+                if not 0 <= q <= 100:
+                    raise ValueError(f"Unknown stacking method '{method}'.")
+                value = self._percentile(self.counts, self.edges, q)
+                # Absolute deviations of the bin centers, sorted per sample
+                centers = (self.edges[:-1] + self.edges[1:]) / 2
+                spread = np.abs(centers[None, :] - value[:, None])
+                order = np.argsort(spread, axis=1)
+                spread = np.take_along_axis(spread, order, axis=1)
+                counts = np.take_along_axis(self.counts, order, axis=1)
+                half_width = (self.edges[1] - self.edges[0]) / 2
+                edges = np.hstack([spread - half_width, spread[:, -1:] + half_width])
+                deviation = MAD_SCALE * np.maximum(
+                    self._percentile(counts, edges, 50), 0
+                )
+        empty = count == 0
+        value[empty] = np.nan
+        deviation[empty] = np.nan
+        return pd.DataFrame(
+            {
+                "distance": self.distance,
+                "value": value,
+                "deviation": deviation,
+                "min": np.where(empty, np.nan, self.min),
+                "max": np.where(empty, np.nan, self.max),
+                "lower": value - factor * deviation,
+                "upper": value + factor * deviation,
+            }
+        )
+
+
+def stack_cross_profiles(
+    grid,
+    points,
+    length,
+    step,
+    spacing,
+    orient=True,
+    method="median",
+    factor=2,
+    block=1024,
+    bins=4096,
+):
+    """
+    Sample and stack the cross-profiles of many lines in bounded memory.
+
+    The profile geometry of all lines is computed at once. Profiles are then
+    sampled in blocks of neighboring profiles, which read from a compact
+    part of the grid, and each block is added to a :class:`StreamingStack`
+    before the next one is sampled. Time grows linearly with the number of
+    profiles and memory does not grow with it.
+
+    Parameters
+    ----------
+    grid : xarray.DataArray
+        The grid to sample (see :func:`sample_bilinear`).
+    points : array-like or list of array-like
+        Vertices of one or several lines (see :func:`profile_centers`).
+    length, step, spacing, orient
+        As in :func:`cross_profiles`.
+    method, factor
+        As in :func:`stack_profiles`.
+    block : int
+        Number of profiles sampled at a time.
+    bins : int
+        Number of histogram bins of the streaming stack.
+
+    Returns
+    -------
+    stack : pandas.DataFrame
+        The same columns as :func:`stack_profiles`.
+    """
+    centers, directions = profile_centers(points, spacing, orient=orient)
+    distance = profile_distance(length, step)
+    values = grid.to_numpy()
+    stack = StreamingStack(distance, np.nanmin(values), np.nanmax(values), bins=bins)
+    for start in range(0, len(centers), block):
+        rows = slice(start, start + block)
+        lon, lat = profile_samples(centers[rows], directions[rows], distance)
+        stack.add(sample_bilinear(grid, lon, lat))
+    return stack.result(method=method, factor=factor)
+
+
+def envelope(stack):
+    """
+    Return the polygon between the lower and upper bounds of a stack.
+
+    The result has ``distance`` and ``value`` columns and can be plotted as a
+    filled polygon.
+    """
+    return pd.DataFrame(
+        {
+            "distance": np.concatenate([stack["distance"], stack["distance"][::-1]]),
+            "value": np.concatenate([stack["upper"], stack["lower"][::-1]]),
+        }
+    )
+
+
+def nan_separated(lon, lat):
+    """
+    Join the rows of two arrays into single vectors separated by NaNs.
+
+    GMT breaks lines at NaN records, so the result plots every profile as a
+    separate line in a single ``plot`` call.
+    """
+    gap = np.full((len(lon), 1), np.nan)
+    return (
+        np.hstack([lon, gap]).ravel()[:-1],
+        np.hstack([lat, gap]).ravel()[:-1],
+    )
@@ -0,0 +1,154 @@
+"""
+Pick the resolution of the remote Earth datasets from the size of the map.
+
+A remote grid is only worth loading at the resolution the printed map can
+show. The map scale is measured with GMT's ``mapproject``: points on a grid
+over the region are projected with the projection of the map (which sets its
+width, e.g. ``M22.73i`` or ``G-138/40/20i+z1000...``) together with points a
+small step to the East and to the North. The largest number of plot inches
+per degree, times the DPI of the output, gives the pixel density the grid
+must reach, and the coarsest resolution of the dataset with at least one cell
+per pixel is used. Together with the region, GMT then only downloads the
+tiles of that resolution that cover the map.
+"""
+import numpy as np
+
+from lod import screen_coordinates
+
+# Grid spacing in degrees of the remote dataset resolutions
+RESOLUTIONS = {
+    "01d": 1,
+    "30m": 1 / 2,
+    "20m": 1 / 3,
+    "15m": 1 / 4,
+    "10m": 1 / 6,
+    "06m": 1 / 10,
+    "05m": 1 / 12,
+    "04m": 1 / 15,
+    "03m": 1 / 20,
+    "02m": 1 / 30,
+    "01m": 1 / 60,
+    "30s": 1 / 120,
+    "15s": 1 / 240,
+    "03s": 1 / 1200,
+    "01s": 1 / 3600,
+}
+
+# Resolutions of the remote datasets in GMT 6.3, from coarse to fine
+DATASETS = {
+    "earth_relief": list(RESOLUTIONS),
+    "earth_mask": list(RESOLUTIONS)[:13],
+    "earth_day": list(RESOLUTIONS)[:12],
+    "earth_night": list(RESOLUTIONS)[:12],
+}
+
+
+def res_to_degrees(res):
+    """
+    Convert a remote dataset resolution (e.g. ``"30s"``) to degrees.
+    """
+    try:
+        return RESOLUTIONS[res]
+    except KeyError:
+        raise ValueError(f"Unknown resolution '{res}'.") from None
+
+
+def parse_region(region):
+    """
+    Convert a region to a ``[west, east, south, north]`` list of floats.
+
+    Accepts ``"d"``, ``"g"``, ``"west/east/south/north"`` strings and lists.
+    """
+    if region == "d":
+        return [-180.0, 180.0, -90.0, 90.0]
+    if region == "g":
+        return [0.0, 360.0, -90.0, 90.0]
+    if isinstance(region, str):
+        region = region.split("/")
+    return [float(value) for value in region]
+
+
+def pixels_per_degree(region, projection, dpi=300, samples=8):
+    """
+    Find the largest pixel density of a map, in pixels per degree.
+
+    Parameters
+    ----------
+    region : str or list
+        The region of the map.
+    projection : str
+        The projection of the map, with its width.
+    dpi : int
+        Resolution of the output.
+    samples : int
+        The scale is measured at ``samples x samples`` points of the region.
+
+    Returns
+    -------
+    density : float
+    """
+    west, east, south, north = parse_region(region)
+    dlon, dlat = (east - west) / samples, (north - south) / samples
+    lon, lat = np.meshgrid(
+        west + dlon * (np.arange(samples) + 0.5),
+        south + dlat * (np.arange(samples) + 0.5),
+    )
+    lon, lat = lon.ravel(), lat.ravel()
+    # Small enough to stay in the region (and on the visible side of the Earth)
+    step = 0.01 * min(dlon, dlat)
+    index, px, py = screen_coordinates(
+        np.concatenate([lon, lon + step, lon]),
+        np.concatenate([lat, lat, lat + step]),
+        region,
+        projection,
+    )
+    plot = np.full((3 * lon.size, 2), np.nan)
+    plot[index] = np.column_stack([px, py])
+    plot = plot.reshape(3, lon.size, 2)
+    offsets = plot[1:] - plot[0]
+    scale = np.hypot(offsets[..., 0], offsets[..., 1]) / step
+    if np.isnan(scale).all():
+        raise ValueError(f"No part of region {region} is visible on the map.")
+    return np.nanmax(scale) * dpi
+
+
+def pick_resolution(dataset, region, projection, dpi=300, finest=None):
+    """
+    Pick the coarsest resolution of a dataset with a cell for every pixel.
+
+    Parameters
+    ----------
+    dataset : str
+        One of the ``DATASETS``, e.g. ``"earth_relief"``.
+    region, projection : str or list
+        The region and projection (with the width) of the map.
+    dpi : int
+        Resolution of the output.
+    finest : str or None
+        Never pick a finer resolution than this one, e.g. ``"15s"`` to avoid
+        downloading the SRTM tiles of ``earth_relief``.
+
+    Returns
+    -------
+    res : str
+        The resolution, e.g. ``"05m"``. The finest allowed one if none is fine
+        enough.
+    """
+    resolutions = DATASETS[dataset]
+    if finest is not None:
+        resolutions = resolutions[: resolutions.index(finest) + 1]
+    spacing = 1 / pixels_per_degree(region, projection, dpi=dpi)
+    for res in resolutions:
+        if res_to_degrees(res) <= spacing:
+            return res
+    return resolutions[-1]
+
+
+def resolve_grid(dataset, region, projection, dpi=300, finest=None):
+    """
+    Name the remote grid to plot on a map, e.g. ``"@earth_relief_05m"``.
+
+    See :func:`pick_resolution` for the parameters.
+    """
+    res = pick_resolution(dataset, region, projection, dpi=dpi, finest=finest)
+    return f"@{dataset}_{res}"
@@ -0,0 +1,490 @@
+"""
+Render the day/night blend in overlapping tiles.
+
+A global ``grdgradient`` plus blend at ``30s`` does not fit comfortably in
+memory. The functions here split the region into tiles, run the gradient,
+mask and blend on each tile with a halo of extra cells around it, and stitch
+the trimmed tiles into an image memory-mapped from disk. Peak memory depends
+on the tile size instead of the size of the global grid.
+
+The ``t`` normalization of ``grdgradient`` depends on the mean and spread of
+the gradients of the whole grid. The raw gradients are computed by GMT, their
+statistics are accumulated over all tiles in a first pass, and every tile is
+normalized with them in NumPy (:func:`normalize_gradient`) in the second pass.
+The raw gradients are cached, so the second pass does not compute them again.
+
+Tiles are independent GMT calls, so they can be spread over a process pool
+with ``workers``. The tiles and the order in which their results are combined
+do not depend on the number of workers. With a single worker,
+:func:`ocean_intensity_tiled` runs the gradient over the whole region at once,
+with the halo of the tiles and statistics added up over the same tiles, so its
+output is the same as with the tiles. With ``shared=True`` the base grids are
+loaded once into shared memory (see ``gridserver.py``), so memory does not
+grow with the number of workers.
+"""
+import collections
+import concurrent.futures
+import functools
+import multiprocessing
+
+import numpy as np
+import xarray as xr
+
+from cache import cached_grdcut, cached_grdgradient
+from daynight import blend, daynight, load_image, ocean_intensity
+from gridserver import cut, serve
+from resolution import parse_region, res_to_degrees
+
+Tile = collections.namedtuple("Tile", ["region", "halo_region", "rows", "cols"])
+
+
+def iter_tiles(region, spacing, tile_size, halo=2):
+    """
+    Split a pixel-registered region into tiles with overlapping halos.
+
+    Parameters
+    ----------
+    region : str or list
+        The region to split (see :func:`resolution.parse_region`).
+    spacing : float
+        Grid spacing in degrees.
+    tile_size : float
+        Width and height of the tiles in degrees (the tiles at the east and
+        north edges may be smaller).
+    halo : int
+        Number of extra cells on each side of a tile. Latitudes are clipped to
+        the poles and longitudes may extend past the region (the remote
+        datasets are global and GMT wraps them around).
+
+    Yields
+    ------
+    tile : Tile
+        The tile ``region`` and ``halo_region`` as ``[west, east, south,
+        north]`` lists, and the ``rows`` and ``cols`` slices of the tile in the
+        stitched grid (rows counted from the south).
+    """
+    west, east, south, north = parse_region(region)
+    ncols = round((east - west) / spacing)
+    nrows = round((north - south) / spacing)
+    step = max(1, round(tile_size / spacing))
+    for row in range(0, nrows, step):
+        rows = slice(row, min(row + step, nrows))
+        for col in range(0, ncols, step):
+            cols = slice(col, min(col + step, ncols))
+            inner = [
+                west + cols.start * spacing,
+                west + cols.stop * spacing,
+                south + rows.start * spacing,
+                south + rows.stop * spacing,
+            ]
+            outer = [
+                inner[0] - halo * spacing,
+                inner[1] + halo * spacing,
+                max(inner[2] - halo * spacing, -90.0),
+                min(inner[3] + halo * spacing, 90.0),
+            ]
+            yield Tile(inner, outer, rows, cols)
+
+
+def run_pool(func, items, workers=1):
+    """
+    Apply a function to items, optionally in a pool of worker processes.
+
+    Results are yielded in the order of ``items`` whatever the number of
+    workers, as soon as they are ready. Workers are forked so that scripts
+    run without a ``__main__`` guard.
+
+    Parameters
+    ----------
+    func : callable
+        A module-level function taking one item.
+    items : list
+        The items to process.
+    workers : int
+        Number of processes. Runs in the current process if 1 or less.
+
+    Yields
+    ------
+    result
+        The return value of ``func`` for each item.
+    """
+    if workers <= 1:
+        yield from map(func, items)
+        return
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context("fork")
+    ) as pool:
+        yield from pool.map(func, items)
+
+
+def _cut(job):
+    """
+    Run one ``grdcut`` job from :func:`cut_grids`.
+    """
+    grid, region, outgrid = job
+    return cached_grdcut(grid=grid, region=region, outgrid=outgrid)
+
+
+def cut_grids(jobs, workers=1):
+    """
+    Run several ``grdcut`` calls at the same time.
+
+    Cuts go through :func:`cache.cached_grdcut`, so repeated runs copy them
+    from the local cache.
+
+    Parameters
+    ----------
+    jobs : list of tuple
+        ``(grid, region, outgrid)`` for every cut. Give ``outgrid=None`` to
+        get the cut back as a DataArray (it is pickled back from the worker).
+    workers : int
+        Number of processes.
+
+    Returns
+    -------
+    results : list
+        The return value of each ``grdcut`` call.
+    """
+    return list(run_pool(_cut, jobs, workers=workers))
+
+
+def _base_grids(res, images=False):
+    """
+    Return the remote grids read by the tiles at a resolution.
+    """
+    grids = [f"@earth_relief_{res}", f"@earth_mask_{res}"]
+    if images:
+        grids += [
+            f"@earth_{name}_{res}+b{band}"
+            for name in ("day", "night")
+            for band in range(3)
+        ]
+    return grids
+
+
+def _served_region(region, spacing, halo):
+    """
+    Return the region of the base grids read by tiles with halos.
+
+    Regions spanning 360 degrees of longitude are kept as they are, as the
+    halos wrap around.
+    """
+    west, east, south, north = parse_region(region)
+    if east - west < 360:
+        west, east = west - halo * spacing, east + halo * spacing
+    return [
+        west,
+        east,
+        max(south - halo * spacing, -90.0),
+        min(north + halo * spacing, 90.0),
+    ]
+
+
+def _tile_gradient(res, tile, azimuth):
+    """
+    Compute the raw gradient of ``@earth_relief`` on a tile and trim the halo.
+    """
+    west, east, south, north = tile.region
+    relief = cut(f"@earth_relief_{res}", region=tile.halo_region)
+    gradient = cached_grdgradient(relief, azimuth=azimuth, f="g")
+    return gradient.sel(lon=slice(west, east), lat=slice(south, north))
+
+
+def _stats(values):
+    """
+    Return the count, sum and sum of squares of the finite values.
+    """
+    values = np.asarray(values)
+    values = values[np.isfinite(values)].astype("float64")
+    return values.size, values.sum(), np.square(values).sum()
+
+
+def _combine_stats(stats):
+    """
+    Add up the statistics of the tiles into the offset and sigma.
+    """
+    count, total, squares = 0, 0.0, 0.0
+    for tile_count, tile_total, tile_squares in stats:
+        count += tile_count
+        total += tile_total
+        squares += tile_squares
+    offset = total / count
+    sigma = np.sqrt(max(squares / count - offset**2, 0.0))
+    return offset, sigma
+
+
+def _tile_stats(tile, res, azimuth):
+    """
+    Return the count, sum and sum of squares of the gradients on a tile.
+    """
+    return _stats(_tile_gradient(res, tile, azimuth).values)
+
+
+def gradient_stats(res, tiles, azimuth=45, workers=1):
+    """
+    Compute the offset and sigma used by the ``t`` gradient normalization.
+
+    GMT uses the mean of the gradients as the offset and the L2 norm of the
+    offset gradients as sigma. Both are accumulated tile by tile.
+
+    Parameters
+    ----------
+    res : str
+        Resolution of ``@earth_relief``.
+    tiles : list of Tile
+        Tiles from :func:`iter_tiles`.
+    azimuth : float
+        Illumination azimuth for ``grdgradient``.
+    workers : int
+        Number of processes.
+
+    Returns
+    -------
+    offset, sigma : float
+    """
+    return _combine_stats(
+        run_pool(
+            functools.partial(_tile_stats, res=res, azimuth=azimuth), tiles, workers
+        )
+    )
+
+
+def normalize_gradient(gradient, amplitude, offset, sigma):
+    """
+    Apply the ``t`` normalization of ``grdgradient`` to raw gradients.
+
+    Computes ``2 * amplitude / pi * arctan((gradient - offset) / sigma)`` in
+    float32, like ``normalize=f"t{amplitude}+o{offset}+s{sigma}"``. Every
+    value only depends on its own gradient, so normalizing tiles or the whole
+    grid gives the same values.
+
+    Parameters
+    ----------
+    gradient : xarray.DataArray
+        Raw gradients from ``grdgradient`` without ``normalize``.
+    amplitude : float
+        Amplitude of the normalization.
+    offset, sigma : float
+        Statistics of the gradients, e.g. from :func:`gradient_stats`.
+
+    Returns
+    -------
+    intensity : xarray.DataArray
+        Float32 grid with the coordinates of ``gradient``.
+    """
+    values = np.asarray(gradient, dtype="float32") - np.float32(offset)
+    values /= np.float32(sigma)
+    np.arctan(values, out=values)
+    values *= np.float32(2 * amplitude / np.pi)
+    return gradient.copy(data=values)
+
+
+def _intensity(res, tile, gradient, amplitude, offset, sigma):
+    """
+    Normalize the gradient of a tile and mask it on land.
+    """
+    mask = cut(f"@earth_mask_{res}", region=tile.region)
+    return ocean_intensity(normalize_gradient(gradient, amplitude, offset, sigma), mask)
+
+
+def _tile_intensity(tile, res, azimuth, amplitude, offset, sigma):
+    """
+    Return the values of the ocean intensity on a tile.
+    """
+    gradient = _tile_gradient(res, tile, azimuth)
+    return _intensity(res, tile, gradient, amplitude, offset, sigma).values
+
+
+def ocean_intensity_tiled(
+    res,
+    region,
+    tile_size=30,
+    halo=2,
+    azimuth=45,
+    amplitude=0.5,
+    workers=1,
+    shared=False,
+):
+    """
+    Compute the ocean intensity of ``@earth_relief`` in tiles.
+
+    Equivalent to ``grdgradient`` with ``normalize=f"t{amplitude}"`` followed
+    by :func:`daynight.ocean_intensity`, but split into tiles that can be
+    processed in parallel. The raw gradients are normalized with
+    :func:`normalize_gradient` using the statistics of all the tiles.
+
+    With a single worker (and ``shared=False``) the whole region is done in
+    one untiled pass instead: one cut with the same halo as the tiles and
+    one ``grdgradient``, whose statistics are added up over the same tiles.
+    The output is the same for any number of workers.
+
+    Parameters
+    ----------
+    res : str
+        Resolution of the remote datasets.
+    region : str or list
+        Region of the output grid.
+    tile_size : float
+        Width and height of the tiles in degrees.
+    halo : int
+        Number of extra cells around each tile for the gradient.
+    azimuth : float
+        Illumination azimuth for ``grdgradient``.
+    amplitude : float
+        Amplitude of the ``t`` gradient normalization.
+    workers : int
+        Number of processes.
+    shared : bool
+        Load the relief and mask once into shared memory for all the workers
+        (see :mod:`gridserver`) instead of cutting them for every tile.
+
+    Returns
+    -------
+    intensity : xarray.DataArray
+        Float32 grid with dimensions ``(lat, lon)``.
+    """
+    spacing = res_to_degrees(res)
+    tiles = list(iter_tiles(region, spacing, tile_size, halo))
+    lon, lat = _pixel_coords(region, spacing)
+    if workers <= 1 and not shared:
+        whole = _whole_region(region, spacing, halo)
+        gradient = _tile_gradient(res, whole, azimuth)
+        offset, sigma = _combine_stats(
+            _stats(gradient.values[tile.rows, tile.cols]) for tile in tiles
+        )
+        intensity = _intensity(res, whole, gradient, amplitude, offset, sigma).values
+        return xr.DataArray(
+            intensity, coords={"lat": lat, "lon": lon}, dims=("lat", "lon")
+        )
+    intensity = np.empty((lat.size, lon.size), dtype="float32")
+    grids = _base_grids(res) if shared else []
+    with serve(grids, region=_served_region(region, spacing, halo)):
+        offset, sigma = gradient_stats(res, tiles, azimuth=azimuth, workers=workers)
+        results = run_pool(
+            functools.partial(
+                _tile_intensity,
+                res=res,
+                azimuth=azimuth,
+                amplitude=amplitude,
+                offset=offset,
+                sigma=sigma,
+            ),
+            tiles,
+            workers,
+        )
+        for tile, values in zip(tiles, results):
+            intensity[tile.rows, tile.cols] = values
+    return xr.DataArray(intensity, coords={"lat": lat, "lon": lon}, dims=("lat", "lon"))
+
+
+def _whole_region(region, spacing, halo):
+    """
+    Return the whole region as a single tile, with the halo of the tiles.
+    """
+    return next(iter_tiles(region, spacing, tile_size=360, halo=halo))
+
+
+def _pixel_coords(region, spacing):
+    """
+    Return the longitudes and latitudes of pixel centers in a region.
+    """
+    west, east, south, north = parse_region(region)
+    lon = west + spacing * (np.arange(round((east - west) / spacing)) + 0.5)
+    lat = south + spacing * (np.arange(round((north - south) / spacing)) + 0.5)
+    return lon, lat
+
+
+def _tile_blend(tile, res, lon, lat, sun_lon, sun_lat, transition, azimuth, stats):
+    """
+    Blend the day and night images on a tile.
+
+    The weights are computed on the coordinates of the whole image, sliced to
+    the tile, so that they do not depend on the tiles.
+    """
+    day = load_image(f"@earth_day_{res}", region=tile.region)
+    night = load_image(f"@earth_night_{res}", region=tile.region)
+    weights = daynight(
+        lon[tile.cols], lat[tile.rows], sun_lon, sun_lat, transition=transition
+    )
+    intens = _intensity(res, tile, _tile_gradient(res, tile, azimuth), *stats)
+    return blend(day, night, weights, intens).values
+
+
+def blend_tiled(
+    res,
+    sun_lon,
+    sun_lat,
+    region="d",
+    tile_size=30,
+    halo=2,
+    outfile="view.npy",
+    transition=2,
+    azimuth=45,
+    amplitude=0.5,
+    workers=1,
+    shared=False,
+):
+    """
+    Blend the day and night images tile by tile into a memory-mapped image.
+
+    Parameters
+    ----------
+    res : str
+        Resolution of the remote datasets (e.g. ``"30s"``).
+    sun_lon, sun_lat : float
+        Location of the sub-solar point.
+    region : str or list
+        Region of the output image.
+    tile_size : float
+        Width and height of the tiles in degrees.
+    halo : int
+        Number of extra cells around each tile for the gradient.
+    outfile : str
+        The ``.npy`` file that holds the stitched image.
+    transition : float
+        Width of the day/night transition in degrees.
+    azimuth : float
+        Illumination azimuth for ``grdgradient``.
+    amplitude : float
+        Amplitude of the ``t`` gradient normalization.
+    workers : int
+        Number of processes.
+    shared : bool
+        Load the relief, mask and images once into shared memory for all the
+        workers (see :mod:`gridserver`) instead of cutting them for every
+        tile.
+
+    Returns
+    -------
+    rgb : xarray.DataArray
+        The uint8 image with dimensions ``(band, lat, lon)``, backed by
+        ``outfile``.
+    """
+    spacing = res_to_degrees(res)
+    tiles = list(iter_tiles(region, spacing, tile_size, halo))
+    lon, lat = _pixel_coords(region, spacing)
+    image = np.lib.format.open_memmap(
+        outfile, mode="w+", dtype="uint8", shape=(3, lat.size, lon.size)
+    )
+    grids = _base_grids(res, images=True) if shared else []
+    with serve(grids, region=_served_region(region, spacing, halo)):
+        offset, sigma = gradient_stats(res, tiles, azimuth=azimuth, workers=workers)
+        blend_tile = functools.partial(
+            _tile_blend,
+            res=res,
+            lon=lon,
+            lat=lat,
+            sun_lon=sun_lon,
+            sun_lat=sun_lat,
+            transition=transition,
+            azimuth=azimuth,
+            stats=(amplitude, offset, sigma),
+        )
+        for tile, rgb in zip(tiles, run_pool(blend_tile, tiles, workers)):
+            image[:, tile.rows, tile.cols] = rgb
+    image.flush()
+    return xr.DataArray(
+        image,
+        coords={"band": [0, 1, 2], "lat": lat, "lon": lon},
+        dims=("band", "lat", "lon"),
+    )
@@ -0,0 +1,299 @@
+"""
+Trace the GMT module calls of an example in the Chrome trace format.
+
+Tracing is opt-in. Run an example with ``python tracing.py background.py
+[arguments of the example]`` or wrap code in :func:`trace`. The result opens
+in ``chrome://tracing``, https://ui.perfetto.dev or https://www.speedscope.app
+as a flame graph.
+
+Three kinds of spans are recorded, nested by time:
+
+``pygmt``
+    Every :class:`pygmt.Figure` method and ``pygmt`` function, e.g.
+    ``Figure.grdimage``. The time of a span not covered by its children is
+    spent in Python, converting arguments and data.
+``module``
+    Every ``Session.call_module``, named after the GMT module and with its
+    argument string. The arguments also give the bytes passed in through
+    virtual files, the size of the files named in the arguments (temporary
+    files of PyGMT separately) and the bytes the process read and wrote
+    during the call (from ``/proc/self/io``, Linux only).
+``virtualfile``
+    Handing arrays to GMT with ``Session.virtualfile_from_*``, with the size
+    of the data.
+
+Only the calling process is traced, so run the tiled pipelines with one
+worker.
+"""
+import argparse
+import collections
+import contextlib
+import functools
+import inspect
+import json
+import os
+import runpy
+import sys
+import tempfile
+import threading
+import time
+
+VIRTUALFILE_METHODS = [
+    "virtualfile_from_grid",
+    "virtualfile_from_matrix",
+    "virtualfile_from_vectors",
+]
+
+
+def _io_counters():
+    """
+    Return the bytes read and written by this process so far, or None.
+    """
+    try:
+        with open("/proc/self/io") as status:
+            counters = dict(line.split(": ") for line in status.read().splitlines())
+    except OSError:
+        return None
+    return int(counters["rchar"]), int(counters["wchar"])
+
+
+def _nbytes(values):
+    """
+    Return the total size of arrays, DataArrays and Series in bytes.
+    """
+    total = 0
+    for value in values:
+        nbytes = getattr(value, "nbytes", None)
+        total += nbytes if nbytes is not None else sys.getsizeof(value)
+    return total
+
+
+def _file_sizes(args):
+    """
+    Return the total size of the files named in a module argument string and
+    of the temporary files of PyGMT among them.
+    """
+    files, temporary = 0, 0
+    for token in args.split():
+        path = token[2:] if token.startswith("-") else token
+        path = path.split("=")[0].split("+")[0]
+        if not path or not os.path.isfile(path):
+            continue
+        size = os.path.getsize(path)
+        files += size
+        if os.path.basename(path).startswith("pygmt-") or path.startswith(
+            tempfile.gettempdir()
+        ):
+            temporary += size
+    return files, temporary
+
+
+class Tracer:
+    """
+    Record spans around the PyGMT calls of this process.
+
+    Call :meth:`install` to start recording and :meth:`uninstall` to restore
+    the original functions. :meth:`save` writes the Chrome trace.
+    """
+
+    def __init__(self):
+        self.events = []
+        self.virtualfiles = {}
+        self._origin = time.perf_counter_ns()
+        self._patches = []
+
+    def _now(self):
+        """
+        Return the time since the tracer was created in microseconds.
+        """
+        return (time.perf_counter_ns() - self._origin) / 1000
+
+    @contextlib.contextmanager
+    def span(self, name, category, args=None):
+        """
+        Record a complete event around the context.
+
+        Yields the ``args`` dictionary of the event so that it can be
+        extended once the traced call returned.
+        """
+        args = {} if args is None else args
+        start = self._now()
+        try:
+            yield args
+        finally:
+            self.events.append(
+                dict(
+                    name=name,
+                    cat=category,
+                    ph="X",
+                    ts=start,
+                    dur=self._now() - start,
+                    pid=os.getpid(),
+                    tid=threading.get_ident(),
+                    args=args,
+                )
+            )
+
+    def _patch(self, owner, name, replacement):
+        self._patches.append((owner, name, getattr(owner, name)))
+        setattr(owner, name, replacement)
+
+    def _traced(self, func, name):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with self.span(name, "pygmt"):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    def _traced_call_module(self, call_module):
+        @functools.wraps(call_module)
+        def wrapper(session, module, args):
+            before = _io_counters()
+            with self.span(module, "module", dict(args=args)) as info:
+                result = call_module(session, module, args)
+                after = _io_counters()
+                info["virtualfile_bytes"] = sum(
+                    nbytes for name, nbytes in self.virtualfiles.items() if name in args
+                )
+                info["file_bytes"], info["temp_file_bytes"] = _file_sizes(args)
+                if before and after:
+                    info["io_read_bytes"] = after[0] - before[0]
+                    info["io_write_bytes"] = after[1] - before[1]
+            return result
+
+        return wrapper
+
+    def _traced_virtualfile(self, method, name):
+        @functools.wraps(method)
+        @contextlib.contextmanager
+        def wrapper(session, *args, **kwargs):
+            nbytes = _nbytes(args)
+            with contextlib.ExitStack() as stack:
+                with self.span(name, "virtualfile", dict(bytes=nbytes)) as info:
+                    vfname = stack.enter_context(method(session, *args, **kwargs))
+                    info["vfname"] = vfname
+                self.virtualfiles[vfname] = nbytes
+                try:
+                    yield vfname
+                finally:
+                    self.virtualfiles.pop(vfname, None)
+
+        return wrapper
+
+    def install(self):
+        """
+        Wrap the PyGMT functions, Figure methods and Session methods.
+        """
+        import pygmt  # pylint: disable=import-outside-toplevel
+
+        session = pygmt.clib.Session
+        self._patch(
+            session, "call_module", self._traced_call_module(session.call_module)
+        )
+        for name in VIRTUALFILE_METHODS:
+            self._patch(
+                session, name, self._traced_virtualfile(getattr(session, name), name)
+            )
+        for name, method in list(vars(pygmt.Figure).items()):
+            if not name.startswith("_") and inspect.isfunction(method):
+                self._patch(pygmt.Figure, name, self._traced(method, f"Figure.{name}"))
+        for name, func in list(vars(pygmt).items()):
+            if inspect.isfunction(func) and func.__module__.startswith("pygmt.src"):
+                self._patch(pygmt, name, self._traced(func, f"pygmt.{name}"))
+
+    def uninstall(self):
+        """
+        Restore the original functions.
+        """
+        while self._patches:
+            owner, name, original = self._patches.pop()
+            setattr(owner, name, original)
+
+    def save(self, fname):
+        """
+        Write the events as a Chrome trace (JSON object format).
+        """
+        with open(fname, "w") as output:
+            json.dump(dict(traceEvents=self.events, displayTimeUnit="ms"), output)
+
+    def summary(self, top=15):
+        """
+        Sum the time of the spans by name, excluding the time of their
+        children, and return the ``top`` ones as lines of text.
+        """
+        totals = collections.defaultdict(lambda: [0, 0.0, 0.0])
+        for thread in {event["tid"] for event in self.events}:
+            events = sorted(
+                (event for event in self.events if event["tid"] == thread),
+                key=lambda event: (event["ts"], -event["dur"]),
+            )
+            stack = []
+            for event in events:
+                while stack and stack[-1][0]["ts"] + stack[-1][0]["dur"] <= event["ts"]:
+                    stack.pop()
+                if stack:
+                    stack[-1][1][2] -= event["dur"]
+                total = totals[(event["cat"], event["name"])]
+                total[0] += 1
+                total[1] += event["dur"]
+                total[2] += event["dur"]
+                stack.append((event, total))
+        lines = [f"{'span':<32}{'calls':>7}{'total [s]':>11}{'self [s]':>10}"]
+        for (category, name), (calls, total, own) in sorted(
+            totals.items(), key=lambda item: -item[1][2]
+        )[:top]:
+            lines.append(
+                f"{category + ':' + name:<32}{calls:>7}{total / 1e6:>11.3f}"
+                f"{own / 1e6:>10.3f}"
+            )
+        return lines
+
+
+@contextlib.contextmanager
+def trace(fname):
+    """
+    Trace the PyGMT calls made in the context and save them to a file.
+
+    Parameters
+    ----------
+    fname : str
+        The Chrome trace to write (e.g. ``"abstract.trace.json"``).
+
+    Examples
+    --------
+    >>> with trace("coast.trace.json"):  # doctest: +SKIP
+    ...     fig = pygmt.Figure()
+    ...     fig.coast(region="g", projection="W15c", land="gray")
+    ...
+    """
+    tracer = Tracer()
+    tracer.install()
+    try:
+        yield tracer
+    finally:
+        tracer.uninstall()
+        tracer.save(fname)
+
+
+def main():
+    """
+    Run an example script under the tracer.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("example", help="the example script, e.g. background.py")
+    parser.add_argument("--output", help="trace file [<example>.trace.json]")
+    parser.add_argument("--top", type=int, default=15, help="spans in the summary")
+    args, rest = parser.parse_known_args()
+    output = args.output or os.path.splitext(args.example)[0] + ".trace.json"
+    # Do not open the figures of Figure.show in an external viewer
+    os.environ.setdefault("PYGMT_USE_EXTERNAL_DISPLAY", "false")
+    sys.argv = [args.example, *rest]
+    with trace(output) as tracer:
+        runpy.run_path(args.example, run_name="__main__")
+    print("\n".join(tracer.summary(top=args.top)))
+    print(f"Wrote {len(tracer.events)} spans to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,315 @@
+"""
+Read GAGE ``.vel`` GNSS velocity files with a columnar on-disk cache.
+
+The first read of a ``.vel`` file parses only the requested columns, in
+chunks, and stores each column as a ``.npy`` file in a ``<fname>.cache``
+directory next to the source. Later reads memory-map those files instead of
+parsing the text again. The cache is invalidated when the size or the
+content hash of the source file changes; the hash is only recomputed when the
+modification time differs from the recorded one.
+"""
+import hashlib
+import json
+import os
+from urllib.parse import quote
+
+import numpy as np
+import pandas as pd
+
+# Columns that are not floating point numbers in the GAGE format
+DTYPES = {
+    "Dot#": str,
+    "Name": str,
+    "Ref_epoch": "int64",
+    "first_epoch": "int64",
+    "last_epoch": "int64",
+}
+
+# Columns of the rotated ellipse format of ``velo -Sr``
+VELO_COLUMNS = [
+    "lon",
+    "lat",
+    "velocity_east",
+    "velocity_north",
+    "semi_major",
+    "semi_minor",
+    "angle",
+]
+
+
+def find_header(fname):
+    """
+    Locate the column header line of a GAGE ``.vel`` file.
+
+    The header is the first line starting with ``*`` after the field
+    description block. Column names are returned without the leading ``*``
+    and without trailing dots (``Ref_Up...`` becomes ``Ref_Up``).
+
+    Parameters
+    ----------
+    fname : str
+        Path to the ``.vel`` file.
+
+    Returns
+    -------
+    lineno : int
+        Zero-based line number of the header line.
+    names : list of str
+        The column names.
+    """
+    with open(fname) as vel:
+        for lineno, line in enumerate(vel):
+            if line.startswith("*"):
+                names = [name.rstrip(".") for name in line[1:].split()]
+                return lineno, names
+    raise ValueError(f"No column header found in '{fname}'.")
+
+
+def _file_hash(fname, blocksize=2**20):
+    """
+    Return the SHA-256 hex digest of a file.
+    """
+    digest = hashlib.sha256()
+    with open(fname, "rb") as source:
+        for block in iter(lambda: source.read(blocksize), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _column_path(cachedir, name):
+    """
+    Return the ``.npy`` path used to cache a column.
+    """
+    return os.path.join(cachedir, quote(name, safe="") + ".npy")
+
+
+def _valid_cache(fname, cachedir):
+    """
+    Check that the cache directory belongs to the current version of fname.
+
+    Size and modification time are checked first. If only the modification
+    time differs, the content hash decides and the stored metadata is
+    refreshed so that the next check is cheap again.
+    """
+    metafile = os.path.join(cachedir, "meta.json")
+    if not os.path.exists(metafile):
+        return False
+    with open(metafile) as meta_json:
+        meta = json.load(meta_json)
+    stat = os.stat(fname)
+    if meta["size"] != stat.st_size:
+        return False
+    if meta["mtime_ns"] != stat.st_mtime_ns:
+        if meta["sha256"] != _file_hash(fname):
+            return False
+        meta["mtime_ns"] = stat.st_mtime_ns
+        _write_meta(cachedir, meta)
+    return True
+
+
+def _write_meta(cachedir, meta):
+    """
+    Atomically write the cache metadata file.
+    """
+    metafile = os.path.join(cachedir, "meta.json")
+    with open(metafile + ".tmp", "w") as meta_json:
+        json.dump(meta, meta_json)
+    os.replace(metafile + ".tmp", metafile)
+
+
+def _reset_cache(fname, cachedir):
+    """
+    Empty the cache directory and record the current version of fname.
+    """
+    os.makedirs(cachedir, exist_ok=True)
+    for entry in os.listdir(cachedir):
+        os.remove(os.path.join(cachedir, entry))
+    stat = os.stat(fname)
+    _write_meta(
+        cachedir,
+        dict(size=stat.st_size, mtime_ns=stat.st_mtime_ns, sha256=_file_hash(fname)),
+    )
+
+
+def _parse_columns(fname, columns, chunksize):
+    """
+    Parse selected columns of a ``.vel`` file in chunks.
+
+    Returns a dict mapping column names to NumPy arrays.
+    """
+    lineno, names = find_header(fname)
+    unknown = set(columns) - set(names)
+    if unknown:
+        raise ValueError(f"Unknown columns {sorted(unknown)} in '{fname}'.")
+    chunks = {name: [] for name in columns}
+    reader = pd.read_csv(
+        fname,
+        sep=r"\s+",
+        skiprows=lineno + 1,
+        header=None,
+        names=names,
+        usecols=columns,
+        dtype={name: DTYPES.get(name, "float64") for name in columns},
+        chunksize=chunksize,
+    )
+    for chunk in reader:
+        for name in columns:
+            chunks[name].append(chunk[name].to_numpy())
+    arrays = {}
+    for name in columns:
+        values = np.concatenate(chunks[name]) if chunks[name] else np.empty(0)
+        if DTYPES.get(name) is str:
+            values = values.astype(str)
+        arrays[name] = values
+    return arrays
+
+
+def read_vel(fname, columns=None, chunksize=100_000, cache=True):
+    """
+    Read a GAGE ``.vel`` velocity file into a DataFrame.
+
+    The header line is detected automatically and only the requested columns
+    are parsed. With ``cache=True``, parsed columns are stored as ``.npy``
+    files in ``<fname>.cache`` and memory-mapped on later calls. Columns
+    missing from a valid cache are parsed and added to it.
+
+    Parameters
+    ----------
+    fname : str
+        Path to the ``.vel`` file.
+    columns : list of str or None
+        Names of the columns to read, as given in the file header (e.g.
+        ``"Ref_Nlat"`` or ``"dE/dt"``). Reads all columns if None.
+    chunksize : int
+        Number of rows parsed at a time.
+    cache : bool
+        Whether to read from and write to the columnar cache.
+
+    Returns
+    -------
+    data : pandas.DataFrame
+        The requested columns in the order given.
+    """
+    if columns is None:
+        columns = find_header(fname)[1]
+    columns = list(columns)
+    if not cache:
+        return pd.DataFrame(_parse_columns(fname, columns, chunksize))
+
+    cachedir = fname + ".cache"
+    if not _valid_cache(fname, cachedir):
+        _reset_cache(fname, cachedir)
+    missing = [
+        name for name in columns if not os.path.exists(_column_path(cachedir, name))
+    ]
+    if missing:
+        for name, values in _parse_columns(fname, missing, chunksize).items():
+            path = _column_path(cachedir, name)
+            with open(path + ".tmp", "wb") as npy:
+                np.save(npy, values)
+            os.replace(path + ".tmp", path)
+    arrays = {
+        name: np.load(_column_path(cachedir, name), mmap_mode="r") for name in columns
+    }
+    return pd.DataFrame(arrays, copy=False)
+
+
+def deduplicate_stations(data, method="latest"):
+    """
+    Reduce a ``.vel`` table to one velocity solution per station.
+
+    GAGE files list several solutions per station (one for each span between
+    equipment changes or earthquakes). Stations are identified by ``Dot#``.
+
+    Parameters
+    ----------
+    data : pandas.DataFrame
+        Table from :func:`read_vel` that includes the ``Dot#`` column. The
+        ``"latest"`` method also needs ``Ref_epoch`` and ``last_epoch``; the
+        ``"weighted"`` method needs ``SNd`` and ``SEd``.
+    method : str
+        ``"latest"`` keeps the solution with the latest ``Ref_epoch``,
+        breaking ties with ``last_epoch``. ``"weighted"`` averages the
+        numeric columns of all solutions of a station, weighting ``dN/dt``
+        by ``1/SNd**2``, ``dE/dt`` by ``1/SEd**2`` and everything else by
+        ``1/(SNd**2 + SEd**2)``. The uncertainties are averaged rather than
+        reduced because the solutions of a station share most of their data.
+
+    Returns
+    -------
+    reduced : pandas.DataFrame
+        One row per station, sorted by ``Dot#``.
+    """
+    stations = data["Dot#"].to_numpy()
+    if method == "latest":
+        order = np.lexsort(
+            (data["last_epoch"].to_numpy(), data["Ref_epoch"].to_numpy(), stations)
+        )
+        sorted_stations = stations[order]
+        # The last row of each run of equal station IDs is the latest solution
+        last = np.append(sorted_stations[1:] != sorted_stations[:-1], True)
+        return data.iloc[order[last]].reset_index(drop=True)
+    if method != "weighted":
+        raise ValueError(f"Unknown deduplication method '{method}'.")
+
+    order = np.argsort(stations, kind="stable")
+    sorted_stations = stations[order]
+    starts = np.flatnonzero(
+        np.insert(sorted_stations[1:] != sorted_stations[:-1], 0, True)
+    )
+    var_north = data["SNd"].to_numpy()[order] ** 2
+    var_east = data["SEd"].to_numpy()[order] ** 2
+    weights = {
+        "dN/dt": 1 / var_north,
+        "dE/dt": 1 / var_east,
+        None: 1 / (var_north + var_east),
+    }
+    sums = {key: np.add.reduceat(value, starts) for key, value in weights.items()}
+
+    reduced = data.iloc[order[starts]].reset_index(drop=True)
+    for name in data.columns:
+        if not pd.api.types.is_float_dtype(data[name]):
+            continue
+        key = name if name in weights else None
+        values = data[name].to_numpy()[order]
+        reduced[name] = np.add.reduceat(weights[key] * values, starts) / sums[key]
+    return reduced
+
+
+def velocity_ellipses(data):
+    """
+    Compute the velocity vectors and error ellipses of all stations.
+
+    The 1-sigma error ellipse of a station has the eigenvalues of the
+    covariance matrix of its East and North velocities as squared semi-axes,
+    with the covariance ``Rne * SEd * SNd``. Everything is computed with
+    whole-column NumPy operations written into one array.
+
+    Parameters
+    ----------
+    data : pandas.DataFrame
+        Table from :func:`read_vel` with the ``Ref_Elong``, ``Ref_Nlat``,
+        ``dE/dt``, ``dN/dt``, ``SEd``, ``SNd`` and ``Rne`` columns.
+
+    Returns
+    -------
+    ellipses : pandas.DataFrame
+        The ``VELO_COLUMNS`` in the format of ``velo -Sr``: position,
+        velocity, semi-major and semi-minor axes (in the units of the
+        velocities) and the counter-clockwise angle from East to the major
+        axis in degrees. All columns share one float64 array.
+    """
+    east, north = data["SEd"].to_numpy() ** 2, data["SNd"].to_numpy() ** 2
+    covariance = data["Rne"].to_numpy() * data["SEd"].to_numpy() * data["SNd"]
+    covariance = np.asarray(covariance, dtype="float64")
+    mean = (east + north) / 2
+    radius = np.hypot((east - north) / 2, covariance)
+    values = np.empty((len(data), len(VELO_COLUMNS)), dtype="float64")
+    values[:, 0] = data["Ref_Elong"]
+    values[:, 1] = data["Ref_Nlat"]
+    values[:, 2] = data["dE/dt"]
+    values[:, 3] = data["dN/dt"]
+    np.sqrt(mean + radius, out=values[:, 4])
+    np.sqrt(np.maximum(mean - radius, 0), out=values[:, 5])
+    np.degrees(np.arctan2(2 * covariance, east - north) / 2, out=values[:, 6])
+    return pd.DataFrame(values, columns=VELO_COLUMNS, copy=False)
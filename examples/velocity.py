@@ -23,36 +23,56 @@
 # ## Process the data to make it easier to plot
 
 # %%
+import time
+
 import numpy as np
-import pandas as pd
 import pygmt
 
+from cache import cached_grdcut, cached_shading
+from lod import decimate
+from resolution import resolve_grid
+from velfile import (
+    VELO_COLUMNS,
+    deduplicate_stations,
+    read_vel,
+    velocity_ellipses,
+)
+
 # %%
-data = pd.read_csv("data/cwu.final_nam14.vel", skiprows=35, delim_whitespace=True)
+# Read only the columns we need; later runs load them from data/*.vel.cache
+data = read_vel(
+    "data/cwu.final_nam14.vel",
+    columns=[
+        "Dot#",
+        "Ref_epoch",
+        "last_epoch",
+        "Ref_Nlat",
+        "Ref_Elong",
+        "dN/dt",
+        "dE/dt",
+        "SNd",
+        "SEd",
+        "Rne",
+    ],
+)
 data.head()
 
 # %%
-# Remove the large East velocities
-data = data[data["dE/dt"].abs() < 0.05]
+# Keep only the latest solution for stations with several rows so that we do not
+# draw overlapping copies of the same vector
+nrows = len(data)
+data = deduplicate_stations(data, method="latest")
+print(f"Removed {nrows - len(data)} duplicate solutions, {len(data)} stations left")
 
 # %%
-# Calculate azimuth and intensity
-azimuth = np.rad2deg(np.arctan2(data["dE/dt"], data["dN/dt"]))
-velocity = np.hypot(data["dE/dt"], data["dN/dt"])
+# Remove the large East velocities
+data = data[data["dE/dt"].abs() < 0.05]
 
 # %%
-# Store result in a DataFrame
-data = pd.DataFrame(
-    dict(
-        lon=data.Ref_Elong,
-        lat=data.Ref_Nlat,
-        velocity_east=data["dE/dt"],
-        velocity_north=data["dN/dt"],
-        azimuth=azimuth,
-        velocity=velocity,
-    ),
-    columns="lon lat velocity_east velocity_north azimuth velocity".split(),
-)
+# Compute the velocity vectors and the semi-axes and orientation of their error
+# ellipses from the standard deviations and the correlation, for all stations at once
+data = velocity_ellipses(data)
+data["velocity"] = np.hypot(data.velocity_east, data.velocity_north)
 data.head()
 
 # %% [markdown]
@@ -65,26 +85,38 @@ proj = "G{lon}/{lat}/20i+z{alt}+a{azim}+t{tilt}+w{twist}+v{width}/{height}".form
 )
 
 # %%
-# Start a new figure
+# Keep the fastest station in every 4x4 pixel cell of the saved figure, as the
+# vectors of the others would be drawn on top of each other
+region = [-140, -110, 20, 60]
+vectors = decimate(
+    data, "lon", "lat", priority="velocity", region=region, projection=proj, cell=4
+)
+print(f"Plotting {len(vectors)} of {len(data)} vectors")
+
+# %%
+# Start a new figure, timing the rendering until the figure is saved
+start = time.perf_counter()
 fig = pygmt.Figure()
 # Configure the background color
 pygmt.config(PS_PAGE_COLOR="#efeeee", GMT_VERBOSE="e")
-# Plot a hill shaded image of the builtin topography data
+# Plot a hill shaded image of the builtin topography data, at the resolution of the
+# saved figure. The cut and its illumination are read from the local cache after the
+# first run.
+relief = cached_grdcut(resolve_grid("earth_relief", region, proj), region=region)
 fig.grdimage(
-    "@earth_relief",
-    region=[-140, -110, 20, 60],
+    relief,
+    region=region,
     projection=proj,
     cmap="ocean",
-    shading="+a120+nt1.5",
+    shading=cached_shading(relief, "+a120+nt1.5", projection=proj),
 )
 # Fill in the continents with a gray color
 fig.coast(land="#444444", resolution="i", area_thresh="0/0/1")
-# Plot the velocity as vectors given an azimuth and length
-fig.plot(
-    x=data.lon,
-    y=data.lat,
-    direction=(data.azimuth, data.velocity * 50),
-    style="V0.03i+e",
+# Plot the velocity vectors (50 cm per m/yr) with their 95% confidence ellipses
+fig.velo(
+    data=vectors[VELO_COLUMNS],
+    spec="r50c/0.95/0",
+    vector="0.03i+e",
     color="#eeeeee",
     pen="thinnest,#eeeeee,solid",
 )
@@ -109,3 +141,4 @@ fig.show(width="100%")
 # %%
 # Save the example figure
 fig.savefig("figures/vectors.png")
+print(f"Rendered {len(vectors)} vectors in {time.perf_counter() - start:.1f} s")
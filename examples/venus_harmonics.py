@@ -22,17 +22,16 @@
 # %%
 import pygmt
 
+from cache import cached_grd2cpt, cached_shading
+from harmonics import sph2grd_multi
+
 # %%
 # Evaluate the global grid based on a spherical harmonic model for the topography of Venus based on Wieczorek (2007)
-# Use three sets of upper order/degrees (30, 90, and 180)
-grid_30d = pygmt.sph2grd(
-    data="@VenusTopo180.txt", spacing=1, region="g", N="g", F="1/1/25/30"
-)
-grid_90d = pygmt.sph2grd(
-    data="@VenusTopo180.txt", spacing=1, region="g", N="g", F="1/1/25/90"
-)
-grid_180d = pygmt.sph2grd(
-    data="@VenusTopo180.txt", spacing=1, region="g", N="g", F="1/1/25/180"
+# Use three sets of upper order/degrees (30, 90, and 180), evaluated together in one pass
+grid_30d, grid_90d, grid_180d = sph2grd_multi(
+    data="@VenusTopo180.txt",
+    filters=["1/1/25/30", "1/1/25/90", "1/1/25/180"],
+    spacing=1,
 )
 
 # %%
@@ -40,17 +39,19 @@ grid_180d = pygmt.sph2grd(
 fig = pygmt.Figure()
 # Configure the background color to match the AGU poster
 pygmt.config(PS_PAGE_COLOR="#efeeee", GMT_VERBOSE="e")
-# Create a colormap based on the 90 order/degrees model
-pygmt.grd2cpt(cmap="vik+h0", grid=grid_90d, nlevels=True)
+# Create a colormap based on the 90 order/degrees model. The colormap and the
+# illumination of the grids are kept in the local cache, so restyling the figure
+# only costs the plotting.
+cpt = cached_grd2cpt(grid_90d, cmap="vik+h0", nlevels=True)
 # Plot the first example on the bottom right
 fig.shift_origin(xshift="7.5c")
 fig.grdimage(
     grid=grid_30d,
-    shading="a45+nt0.75",
+    shading=cached_shading(grid_30d, "a45+nt0.75", projection="G90/30/12c"),
     projection="G90/30/12c",
     frame="g",
     region="g",
-    cmap=True,
+    cmap=cpt,
 )
 # Add citation
 fig.text(
@@ -61,19 +62,24 @@ fig.text(
     no_clip=True,
 )
 # Create a colorbar
-fig.colorbar(frame=["xaf", 'y+l"m"'], position="x3c/-0.5c+jTC+w13c/0.25c+h")
+fig.colorbar(cmap=cpt, frame=["xaf", 'y+l"m"'], position="x3c/-0.5c+jTC+w13c/0.25c+h")
 # Plot the second example shifted upwards with a title
 fig.shift_origin(xshift="-3c", yshift="5c")
 pygmt.config(MAP_TITLE_OFFSET="5.5c")
 fig.grdimage(
     grid=grid_90d,
-    shading="a45+nt0.75",
+    shading=cached_shading(grid_90d, "a45+nt0.75"),
     frame=["g", '+t"Venus Spherical Harmonic Model"'],
-    cmap=True,
+    cmap=cpt,
 )
 # Plot the third example shifted updwards
 fig.shift_origin(xshift="-3c", yshift="5c")
-fig.grdimage(grid=grid_180d, shading="a45+nt0.75", frame="g", cmap=True)
+fig.grdimage(
+    grid=grid_180d,
+    shading=cached_shading(grid_180d, "a45+nt0.75"),
+    frame="g",
+    cmap=cpt,
+)
 fig.show()
 
 # %%